@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import math
+import re
+from collections import Counter
+
+# Words and numbers, snake_case identifiers are split into their parts
+TOKEN_PATTERN = re.compile(r'[^\W_]+', re.UNICODE)
+
+# Common English function words, they carry no meaning for relevance
+STOP_WORDS = frozenset((
+    'a', 'about', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'could', 'do', 'does', 'for', 'from', 'get',
+    'give', 'have', 'how', 'i', 'if', 'in', 'into', 'is', 'it', 'its', 'me', 'my', 'no', 'not', 'of', 'on', 'or',
+    'please', 'should', 'show', 'so', 'tell', 'that', 'the', 'their', 'then', 'there', 'these', 'this', 'to', 'use',
+    'was', 'we', 'what', 'when', 'where', 'which', 'who', 'why', 'will', 'with', 'would', 'you', 'your',
+))
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Splits a text into lowercase terms
+    """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 and token not in STOP_WORDS]
+
+
+class BM25Index:
+    """
+    A small in-memory inverted index ranking documents with Okapi BM25
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, dict] = {}  # {term: {doc_id: term_frequency}}
+        self.doc_lengths: dict = {}  # {doc_id: number_of_terms}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def add(self, doc_id, text: str):
+        """
+        Indexes a document, replacing any document with the same id
+        """
+        if doc_id in self.doc_lengths:
+            self.remove(doc_id)
+        terms = Counter(tokenize(text))
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = frequency
+        length = sum(terms.values())
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+
+    def remove(self, doc_id):
+        """
+        Removes a document from the index
+        """
+        length = self.doc_lengths.pop(doc_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for term in [term for term, postings in self.postings.items() if doc_id in postings]:
+            del self.postings[term][doc_id]
+            if len(self.postings[term]) == 0:
+                del self.postings[term]
+
+    def search(self, query: str, top_k: int = 5) -> list[tuple]:
+        """
+        Ranks the documents matching at least one query term.
+        :param query: The query text
+        :param top_k: Maximum number of results
+        :return: A list of (doc_id, score) tuples sorted by decreasing score
+        """
+        if len(self.doc_lengths) == 0:
+            return []
+        doc_count = len(self.doc_lengths)
+        average_length = self.total_length / doc_count or 1.0
+        scores: dict = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                length_norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / average_length
+                scores[doc_id] = scores.get(doc_id, 0.0) + \
+                    idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
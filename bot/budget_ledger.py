@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+
+class BudgetLedger:
+    """
+    Budget reserved by the requests in flight, per budget account (a user, or all guests).
+    A request reserves its estimated cost before it is sent, and releases the reservation once its actual
+    usage is recorded, so that the concurrent requests of a user share the remaining budget instead of
+    all passing the budget check before any of them is recorded.
+    Reservations are made and released on the event loop without awaiting in between, which makes them atomic
+    without a lock, and without serialising the requests of a user.
+    """
+
+    def __init__(self):
+        self.reserved: dict = {}  # {account: reserved cost}
+        self.reservations = 0
+        self.capped = 0
+        self.rejected = 0
+
+    def reserve(self, account, remaining_budget: float, cost: float, min_cost: float = 0.0) -> float | None:
+        """
+        Reserves the estimated cost of a request from the remaining budget of an account.
+        :param account: The budget account, a user ID or 'guests'
+        :param remaining_budget: The budget left after the recorded usage of the account
+        :param cost: The estimated cost of the request
+        :param min_cost: The lowest cost worth sending the request for, e.g. the cost of its prompt
+        :return: The reserved cost, lower than the estimate when the budget is nearly exhausted,
+                 or None if not even the minimum cost is left
+        """
+        available = remaining_budget - self.reserved.get(account, 0.0)
+        if available <= 0 or available < min_cost:
+            self.rejected += 1
+            return None
+        if cost > available:
+            self.capped += 1
+            cost = available
+        self.reserved[account] = self.reserved.get(account, 0.0) + cost
+        self.reservations += 1
+        return cost
+
+    def release(self, account, cost: float):
+        """
+        Releases a reservation, once the actual usage of the request is recorded or the request failed
+        """
+        reserved = self.reserved.get(account, 0.0) - cost
+        if reserved > 1e-12:
+            self.reserved[account] = reserved
+        else:
+            self.reserved.pop(account, None)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the counters of the ledger
+        """
+        return {
+            'in_flight_accounts': len(self.reserved),
+            'reserved_cost': sum(self.reserved.values()),
+            'reservations': self.reservations,
+            'capped': self.capped,
+            'rejected': self.rejected,
+        }
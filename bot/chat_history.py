@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+HISTORY_STRATEGIES = ('summarise', 'window', 'hybrid')
+
+
+def trim_to_window(history: list, max_tokens: int, max_messages: int, count_message_tokens, keep: int = 1) -> list:
+    """
+    Trims a conversation in place to its first messages (the system prompt) and the newest turns
+    that fit a token budget. No network call is made, so this is fast enough to run on every request.
+    :param history: The conversation history
+    :param max_tokens: The token budget of the trimmed history
+    :param max_messages: The maximum number of messages of the trimmed history
+    :param count_message_tokens: A function returning the number of tokens of a single message
+    :param keep: The number of leading messages that are always kept
+    :return: The dropped messages, oldest first
+    """
+    head = history[:keep]
+    budget = max_tokens - sum(count_message_tokens(message) for message in head)
+    kept = []
+    # The newest message is the one being answered, it is kept even if it exceeds the budget
+    for message in reversed(history[keep:]):
+        tokens = count_message_tokens(message)
+        if len(kept) > 0 and (tokens > budget or len(head) + len(kept) >= max_messages):
+            break
+        kept.append(message)
+        budget -= tokens
+    kept.reverse()
+    dropped = history[keep:len(history) - len(kept)]
+    history[keep:] = kept
+    return dropped
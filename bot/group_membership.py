@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import asyncio
+
+import telegram
+from telegram import Update, ChatMember
+from telegram.ext import CallbackContext
+
+from ttl_cache import TTLCache, SingleFlight
+
+MEMBER_STATUSES = (ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER)
+
+
+async def is_user_in_group(update: Update, context: CallbackContext, user_id: int) -> bool:
+    """
+    Checks if user_id is a member of the group
+    """
+    try:
+        chat_member = await context.bot.get_chat_member(update.message.chat_id, user_id)
+        return chat_member.status in MEMBER_STATUSES
+    except telegram.error.BadRequest as e:
+        if str(e) == "User not found":
+            return False
+        else:
+            raise e
+    except Exception as e:
+        raise e
+
+
+class GroupMemberships:
+    """
+    Caches whether the allowed and admin users are members of the group chats, which decides whether
+    the other members of a group may use the bot. Memberships are cached per (chat, user) for a time-to-live,
+    and updated as soon as Telegram reports a change with a chat_member update.
+    """
+
+    def __init__(self, ttl: float = 300, max_size: int = 10000, max_concurrency: int = 5):
+        """
+        Initializes the cache.
+        :param ttl: Number of seconds a membership is cached, 0 to disable the cache
+        :param max_size: Maximum number of cached memberships
+        :param max_concurrency: Maximum number of Telegram API calls in flight at the same time
+        """
+        self.memberships = TTLCache(max_size=max_size, ttl=ttl)
+        self.probes = SingleFlight()
+        self.api_calls = 0
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+
+    async def has_any_member(self, update: Update, context: CallbackContext, user_ids) -> bool:
+        """
+        Checks if at least one of the given users is a member of the chat of the update.
+        Cached memberships are used first, the others are checked with concurrent Telegram API calls,
+        at most max_concurrency at a time, until a member is found.
+        :param user_ids: The IDs of the users
+        """
+        chat_id = update.effective_chat.id
+        unknown_user_ids = []
+        for user_id in user_ids:
+            is_member = self.memberships.get((chat_id, str(user_id)))
+            if is_member:
+                return True
+            if is_member is None:
+                unknown_user_ids.append(str(user_id))
+        if not unknown_user_ids:
+            return False
+
+        found = asyncio.Event()
+        probes = [
+            asyncio.ensure_future(self.probes.do((chat_id, user_id),
+                                                 lambda user_id=user_id: self.__probe(update, context, user_id, found)))
+            for user_id in unknown_user_ids
+        ]
+        errors = []
+        try:
+            for probe in asyncio.as_completed(probes):
+                try:
+                    if await probe:
+                        return True
+                except Exception as e:
+                    errors.append(e)
+        finally:
+            # The first member found is enough
+            for probe in probes:
+                probe.cancel()
+        if errors:
+            raise errors[0]
+        return False
+
+    def set_member(self, chat_id, user_id, is_member: bool):
+        """
+        Records a membership change reported by Telegram
+        """
+        self.memberships.set((chat_id, str(user_id)), is_member)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the cache counters and the number of Telegram API calls made
+        """
+        return {**self.memberships.get_stats(), 'api_calls': self.api_calls, 'shared': self.probes.shared}
+
+    async def __probe(self, update: Update, context: CallbackContext, user_id: str,
+                      found: asyncio.Event) -> bool | None:
+        """
+        Checks a membership with the Telegram API, unless a member was found while the probe waited for a slot:
+        the membership is then not needed any more, and None is returned
+        """
+        # Created lazily, so that it is bound to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            if found.is_set():
+                return None
+            self.api_calls += 1
+            is_member = await is_user_in_group(update, context, user_id)
+            if is_member:
+                # Set before the slot is released, so that the probes waiting for it are not sent
+                found.set()
+        self.memberships.set((update.effective_chat.id, user_id), is_member)
+        return is_member
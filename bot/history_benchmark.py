@@ -0,0 +1,127 @@
+"""
+Compares the latency of the chat history strategies (summarise, window, hybrid) on a long conversation.
+
+Usage: python bot/history_benchmark.py [--turns 60] [--simulated-latency 0.8]
+
+Without --simulated-latency the requests are sent to the OpenAI API configured in .env (this costs tokens),
+otherwise every API call is answered locally after the given delay.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from types import SimpleNamespace
+
+from dotenv import load_dotenv
+
+from chat_history import HISTORY_STRATEGIES
+from openai_helper import OpenAIHelper, default_max_tokens
+from plugin_manager import PluginManager
+
+WORDS = ('budget', 'travel', 'weather', 'python', 'recipe', 'music', 'garden', 'invoice', 'meeting', 'train',
+         'holiday', 'report', 'server', 'coffee', 'project', 'deadline', 'family', 'movie', 'market', 'city')
+
+
+class SimulatedCompletions:
+    """
+    Answers chat completion requests locally after a fixed delay
+    """
+
+    def __init__(self, latency: float, answer_words: int):
+        self.latency = latency
+        self.answer_words = answer_words
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        content = ' '.join(random.choices(WORDS, k=self.answer_words))
+        message = SimpleNamespace(content=content, function_call=None)
+        usage = SimpleNamespace(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+def build_config(model: str, strategy: str, max_history_size: int) -> dict:
+    return {
+        'api_key': os.environ.get('OPENAI_API_KEY', ''),
+        'model': model,
+        'max_tokens': default_max_tokens(model=model),
+        'min_max_tokens': 256,
+        'max_history_size': max_history_size,
+        'history_strategy': strategy,
+        'history_window_tokens': 0,
+        'max_conversation_age_minutes': 180,
+        'assistant_prompt': 'You are a helpful assistant.',
+        'enable_functions': False,
+        'temperature': 1.0,
+        'n_choices': 1,
+        'presence_penalty': 0.0,
+        'frequency_penalty': 0.0,
+        'bot_language': 'en',
+        'show_usage': False,
+        'show_plugins_used': False,
+    }
+
+
+async def run_strategy(strategy: str, args) -> dict:
+    random.seed(args.seed)
+    plugin_manager = PluginManager(config={'plugins': [], 'model': args.model})
+    helper = OpenAIHelper(config=build_config(args.model, strategy, args.max_history_size),
+                          plugin_manager=plugin_manager)
+    completions = None
+    if args.simulated_latency is not None:
+        completions = SimulatedCompletions(args.simulated_latency, args.answer_words)
+        helper.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    latencies = []
+    chat_id = 1
+    for _ in range(args.turns):
+        query = ' '.join(random.choices(WORDS, k=args.query_words))
+        started = time.perf_counter()
+        await helper.get_chat_response(chat_id=chat_id, query=query)
+        latencies.append(time.perf_counter() - started)
+
+    # Background summaries are off the critical path, wait for them so that they are counted as calls
+    await asyncio.gather(*helper.summary_tasks.values())
+    await plugin_manager.close()
+
+    latencies.sort()
+    return {
+        'strategy': strategy,
+        'mean': statistics.mean(latencies),
+        'p50': latencies[len(latencies) // 2],
+        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        'max': latencies[-1],
+        'calls': completions.calls if completions is not None else None,
+        'messages': len(helper.conversations[chat_id]),
+    }
+
+
+async def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Compare the latency of the chat history strategies')
+    parser.add_argument('--turns', type=int, default=60, help='number of user messages per strategy')
+    parser.add_argument('--model', default=os.environ.get('OPENAI_MODEL', 'gpt-3.5-turbo'))
+    parser.add_argument('--max-history-size', type=int, default=15)
+    parser.add_argument('--query-words', type=int, default=60)
+    parser.add_argument('--answer-words', type=int, default=150)
+    parser.add_argument('--simulated-latency', type=float, default=None,
+                        help='answer API calls locally after this many seconds instead of calling the API')
+    parser.add_argument('--strategies', default=','.join(HISTORY_STRATEGIES))
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(f'{"strategy":<10} {"mean":>8} {"p50":>8} {"p95":>8} {"max":>8} {"calls":>6} {"messages":>9}')
+    for strategy in args.strategies.split(','):
+        result = await run_strategy(strategy, args)
+        calls = '-' if result['calls'] is None else result['calls']
+        print(f'{result["strategy"]:<10} {result["mean"]:>7.3f}s {result["p50"]:>7.3f}s {result["p95"]:>7.3f}s '
+              f'{result["max"]:>7.3f}s {calls:>6} {result["messages"]:>9}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
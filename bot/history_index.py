@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import pathlib
+
+from bm25 import BM25Index
+from ttl_cache import TTLCache
+
+
+class ChatHistoryIndex:
+    """
+    A local full-text index over all past messages of each chat, used to recall earlier turns
+    that are no longer in the conversation history sent to the model.
+    Messages are appended to a JSON lines file per chat, the BM25 index itself is rebuilt in memory
+    when a chat is first searched, and only the indexes of the most recently active chats are kept loaded.
+    """
+
+    def __init__(self, index_dir: str = 'history_index', max_loaded_chats: int = 64):
+        """
+        Initializes the index.
+        :param index_dir: Directory of the message files, one per chat
+        :param max_loaded_chats: Maximum number of chat indexes kept in memory
+        """
+        self.index_dir = index_dir
+        self.indexes = TTLCache(max_size=max_loaded_chats)  # {chat_id: (BM25Index, messages)}
+        pathlib.Path(index_dir).mkdir(exist_ok=True)
+
+    def add(self, chat_id, role: str, content: str):
+        """
+        Appends a message to the index of a chat
+        """
+        message = {'role': role, 'content': content}
+        try:
+            with open(self.__get_chat_file(chat_id), 'a', encoding='utf-8') as file:
+                file.write(json.dumps(message, ensure_ascii=False) + '\n')
+        except OSError as e:
+            logging.warning(f'Could not persist message of chat ID {chat_id} to the history index: {str(e)}')
+        loaded = self.indexes.get(chat_id)
+        if loaded is not None:
+            index, messages = loaded
+            index.add(len(messages), content)
+            messages.append(message)
+
+    def search(self, chat_id, query: str, top_k: int = 3, exclude=()) -> list[dict]:
+        """
+        Finds the earlier messages of a chat most relevant to a query.
+        :param chat_id: The chat ID
+        :param query: The query text
+        :param top_k: Maximum number of messages
+        :param exclude: Message contents to skip, e.g. the ones still in the conversation history
+        :return: The messages in chronological order
+        """
+        index, messages = self.__load(chat_id)
+        exclude = set(exclude)
+        # Fetch extra results, since the most recent matches are usually still in the history
+        results = index.search(query, top_k=top_k + len(exclude))
+        doc_ids = [doc_id for doc_id, _ in results if messages[doc_id]['content'] not in exclude][:top_k]
+        return [messages[doc_id] for doc_id in sorted(doc_ids)]
+
+    def clear(self, chat_id):
+        """
+        Removes all indexed messages of a chat
+        """
+        self.indexes.pop(chat_id)
+        try:
+            os.remove(self.__get_chat_file(chat_id))
+        except FileNotFoundError:
+            pass
+
+    def __load(self, chat_id) -> tuple:
+        loaded = self.indexes.get(chat_id)
+        if loaded is not None:
+            return loaded
+        index, messages = BM25Index(), []
+        chat_file = self.__get_chat_file(chat_id)
+        if os.path.isfile(chat_file):
+            with open(chat_file, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        message = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A partially written last line, e.g. after a crash
+                        continue
+                    index.add(len(messages), message['content'])
+                    messages.append(message)
+        self.indexes.set(chat_id, (index, messages))
+        return index, messages
+
+    def __get_chat_file(self, chat_id) -> str:
+        return os.path.join(self.index_dir, f'{chat_id}.jsonl')
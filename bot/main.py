@@ -3,9 +3,12 @@ import os
 
 from dotenv import load_dotenv
 
+from chat_history import HISTORY_STRATEGIES
+from usage_store import USAGE_BACKENDS
 from plugin_manager import PluginManager
 from openai_helper import OpenAIHelper, default_max_tokens, are_functions_available
 from telegram_bot import ChatGPTTelegramBot
+from utils import parse_user_ids, parse_user_budgets
 
 
 def main():
@@ -26,6 +29,16 @@ def main():
         logging.error(f'The following environment values are missing in your .env: {", ".join(missing_values)}')
         exit(1)
 
+    history_strategy = os.environ.get('HISTORY_STRATEGY', 'summarise').lower()
+    if history_strategy not in HISTORY_STRATEGIES:
+        logging.error(f'Invalid HISTORY_STRATEGY {history_strategy}, allowed values: {", ".join(HISTORY_STRATEGIES)}')
+        exit(1)
+
+    usage_backend = os.environ.get('USAGE_BACKEND', 'json').lower()
+    if usage_backend not in USAGE_BACKENDS:
+        logging.error(f'Invalid USAGE_BACKEND {usage_backend}, allowed values: {", ".join(USAGE_BACKENDS)}')
+        exit(1)
+
     # Setup configurations
     model = os.environ.get('OPENAI_MODEL', 'gpt-3.5-turbo')
     functions_available = are_functions_available(model=model)
@@ -36,9 +49,23 @@ def main():
         'stream': os.environ.get('STREAM', 'true').lower() == 'true',
         'proxy': os.environ.get('PROXY', None) or os.environ.get('OPENAI_PROXY', None),
         'max_history_size': int(os.environ.get('MAX_HISTORY_SIZE', 15)),
+        'history_strategy': history_strategy,
+        'history_window_tokens': int(os.environ.get('HISTORY_WINDOW_TOKENS', 0)),
+        'enable_history_retrieval': os.environ.get('ENABLE_HISTORY_RETRIEVAL', 'false').lower() == 'true',
+        'history_retrieval_dir': os.environ.get('HISTORY_RETRIEVAL_DIR', 'history_index'),
+        'history_retrieval_top_k': int(os.environ.get('HISTORY_RETRIEVAL_TOP_K', 3)),
+        'history_retrieval_max_tokens': int(os.environ.get('HISTORY_RETRIEVAL_MAX_TOKENS', 500)),
+        'enable_response_cache': os.environ.get('ENABLE_RESPONSE_CACHE', 'false').lower() == 'true',
+        'response_cache_size': int(os.environ.get('RESPONSE_CACHE_SIZE', 1000)),
+        'response_cache_ttl': float(os.environ.get('RESPONSE_CACHE_TTL', 86400)),
+        'response_cache_max_temperature': float(os.environ.get('RESPONSE_CACHE_MAX_TEMPERATURE', 1.0)),
+        'enable_semantic_cache': os.environ.get('ENABLE_SEMANTIC_CACHE', 'false').lower() == 'true',
+        'semantic_cache_size': int(os.environ.get('SEMANTIC_CACHE_SIZE', 10000)),
+        'semantic_cache_threshold': float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.9)),
         'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
         'assistant_prompt': os.environ.get('ASSISTANT_PROMPT', 'You are a helpful assistant.'),
         'max_tokens': int(os.environ.get('MAX_TOKENS', max_tokens_default)),
+        'min_max_tokens': int(os.environ.get('MIN_MAX_TOKENS', 256)),
         'n_choices': int(os.environ.get('N_CHOICES', 1)),
         'temperature': float(os.environ.get('TEMPERATURE', 1.0)),
         'image_model': os.environ.get('IMAGE_MODEL', 'dall-e-2'),
@@ -48,6 +75,7 @@ def main():
         'model': model,
         'enable_functions': os.environ.get('ENABLE_FUNCTIONS', str(functions_available)).lower() == 'true',
         'functions_max_consecutive_calls': int(os.environ.get('FUNCTIONS_MAX_CONSECUTIVE_CALLS', 10)),
+        'functions_selection_turns': int(os.environ.get('FUNCTIONS_SELECTION_TURNS', 3)),
         'presence_penalty': float(os.environ.get('PRESENCE_PENALTY', 0.0)),
         'frequency_penalty': float(os.environ.get('FREQUENCY_PENALTY', 0.0)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
@@ -77,6 +105,9 @@ def main():
         'token': os.environ['TELEGRAM_BOT_TOKEN'],
         'admin_user_ids': os.environ.get('ADMIN_USER_IDS', '-'),
         'allowed_user_ids': os.environ.get('ALLOWED_TELEGRAM_USER_IDS', '*'),
+        'admin_user_id_set': parse_user_ids(os.environ.get('ADMIN_USER_IDS', '-')),
+        'allowed_user_id_set': parse_user_ids(os.environ.get('ALLOWED_TELEGRAM_USER_IDS', '*')),
+        'group_membership_cache_ttl': float(os.environ.get('GROUP_MEMBERSHIP_CACHE_TTL', 300)),
         'enable_quoting': os.environ.get('ENABLE_QUOTING', 'true').lower() == 'true',
         'enable_image_generation': os.environ.get('ENABLE_IMAGE_GENERATION', 'true').lower() == 'true',
         'enable_transcription': os.environ.get('ENABLE_TRANSCRIPTION', 'true').lower() == 'true',
@@ -84,7 +115,16 @@ def main():
         'enable_tts_generation': os.environ.get('ENABLE_TTS_GENERATION', 'true').lower() == 'true',
         'budget_period': os.environ.get('BUDGET_PERIOD', 'monthly').lower(),
         'user_budgets': os.environ.get('USER_BUDGETS', os.environ.get('MONTHLY_USER_BUDGETS', '*')),
+        'user_budget_map': parse_user_budgets(os.environ.get('ALLOWED_TELEGRAM_USER_IDS', '*'),
+                                              os.environ.get('USER_BUDGETS',
+                                                             os.environ.get('MONTHLY_USER_BUDGETS', '*'))),
         'guest_budget': float(os.environ.get('GUEST_BUDGET', os.environ.get('MONTHLY_GUEST_BUDGET', '100.0'))),
+        'usage_flush_interval': float(os.environ.get('USAGE_FLUSH_INTERVAL', 5.0)),
+        'usage_backend': usage_backend,
+        'usage_db_file': os.environ.get('USAGE_DB_FILE', 'usage.db'),
+        'usage_history_days': int(os.environ.get('USAGE_HISTORY_DAYS', 0)),
+        'usage_cache_size': int(os.environ.get('USAGE_CACHE_SIZE', 1000)),
+        'usage_report_ttl': float(os.environ.get('USAGE_REPORT_TTL', 300)),
         'stream': os.environ.get('STREAM', 'true').lower() == 'true',
         'proxy': os.environ.get('PROXY', None) or os.environ.get('TELEGRAM_PROXY', None),
         'voice_reply_transcript': os.environ.get('VOICE_REPLY_WITH_TRANSCRIPT_ONLY', 'false').lower() == 'true',
@@ -103,7 +143,20 @@ def main():
     }
 
     plugin_config = {
-        'plugins': os.environ.get('PLUGINS', '').split(',')
+        'plugins': os.environ.get('PLUGINS', '').split(','),
+        'proxy': os.environ.get('PROXY', None) or os.environ.get('PLUGINS_PROXY', None),
+        'http_timeout': float(os.environ.get('PLUGINS_HTTP_TIMEOUT', 15.0)),
+        'http_max_connections': int(os.environ.get('PLUGINS_HTTP_MAX_CONNECTIONS', 20)),
+        'cache_size': int(os.environ.get('PLUGINS_CACHE_SIZE', 256)),
+        'timeout': float(os.environ.get('PLUGINS_TIMEOUT', 30.0)),
+        'max_concurrency': int(os.environ.get('PLUGINS_MAX_CONCURRENCY', 4)),
+        'breaker_threshold': int(os.environ.get('PLUGINS_BREAKER_THRESHOLD', 3)),
+        'breaker_cooldown': float(os.environ.get('PLUGINS_BREAKER_COOLDOWN', 60.0)),
+        'result_max_tokens': int(os.environ.get('PLUGINS_RESULT_MAX_TOKENS', 1000)),
+        'selection_top_k': int(os.environ.get('FUNCTIONS_SELECTION_TOP_K', 0)),
+        'max_description_length': int(os.environ.get('FUNCTIONS_MAX_DESCRIPTION_LENGTH', 0)),
+        'max_enum_size': int(os.environ.get('FUNCTIONS_MAX_ENUM_SIZE', 0)),
+        'model': model,
     }
 
     # Setup and run ChatGPT and Telegram bot
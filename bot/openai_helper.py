@@ -1,9 +1,10 @@
 from __future__ import annotations
+import asyncio
 import datetime
+import hashlib
 import logging
 import os
-
-import tiktoken
+import time
 
 import openai
 
@@ -17,8 +18,12 @@ from PIL import Image
 
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 
-from utils import is_direct_result, encode_image, decode_image
+from utils import is_direct_result, encode_image, decode_image, get_encoding
 from plugin_manager import PluginManager
+from chat_history import trim_to_window
+from history_index import ChatHistoryIndex
+from semantic_cache import SemanticCache
+from ttl_cache import TTLCache, SingleFlight
 
 # Models can be found here: https://platform.openai.com/docs/models/overview
 GPT_3_MODELS = ("gpt-3.5-turbo", "gpt-3.5-turbo-0301", "gpt-3.5-turbo-0613")
@@ -111,6 +116,20 @@ class OpenAIHelper:
         self.conversations: dict[int: list] = {}  # {chat_id: history}
         self.conversations_vision: dict[int: bool] = {}  # {chat_id: is_vision}
         self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
+        self.history_summaries: dict[int: dict] = {}  # {chat_id: summary_message}
+        self.dropped_turns: dict[int: list] = {}  # {chat_id: messages_waiting_to_be_summarised}
+        self.summary_tasks: dict[int: asyncio.Task] = {}  # {chat_id: background_summary_task}
+        self.message_tokens = TTLCache(max_size=4096)  # {(role, name, content): tokens}
+        self.history_index = ChatHistoryIndex(config['history_retrieval_dir']) \
+            if config.get('enable_history_retrieval', False) else None
+        self.response_cache = TTLCache(max_size=config['response_cache_size'], ttl=config['response_cache_ttl']) \
+            if config.get('enable_response_cache', False) else None
+        self.semantic_cache = SemanticCache(max_size=config['semantic_cache_size'],
+                                            threshold=config['semantic_cache_threshold'],
+                                            ttl=config['response_cache_ttl']) \
+            if config.get('enable_semantic_cache', False) else None
+        self.semantic_cache_hits: dict[int: tuple] = {}  # {chat_id: semantic_cache_entry_of_the_last_answer}
+        self.requests_in_flight = SingleFlight()
 
     def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
         """
@@ -122,17 +141,39 @@ class OpenAIHelper:
             self.reset_chat_history(chat_id)
         return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
 
-    async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
+    def count_prompt_tokens(self, chat_id: int, query: str) -> int:
+        """
+        Estimates the prompt tokens of a chat request from the cached token counts of the history
+        :param chat_id: The chat ID
+        :param query: The query to send to the model
+        :return: The number of tokens of the history, the query and the function specs sent with them
+        """
+        history = self.conversations.get(chat_id) or [{"role": "system", "content": self.config['assistant_prompt']}]
+        messages = history + [{"role": "user", "content": query}]
+        num_tokens = self.__count_tokens(messages)
+        if self.config['enable_functions'] and not self.conversations_vision.get(chat_id, False):
+            num_tokens += self.plugin_manager.count_specs_tokens(self.__get_functions_specs(messages))
+        return num_tokens
+
+    async def get_chat_response(self, chat_id: int, query: str, max_tokens: int | None = None,
+                                token_budget: int | None = None) -> tuple[str, str]:
         """
         Gets a full response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
+        :param max_tokens: Limit of the completion tokens below the configured one, e.g. to stay within a budget
+        :param token_budget: Limit of the tokens of all the requests of the answer, function calls included
         :return: The answer from the model and the number of tokens used
         """
+        cache_namespace = self.__get_response_cache_namespace(chat_id)
+        cached_answer = self.__get_cached_response(chat_id, query, cache_namespace)
+        if cached_answer is not None:
+            return cached_answer, 0
+
         plugins_used = ()
-        response = await self.__common_get_chat_response(chat_id, query)
+        response = await self.__common_get_chat_response(chat_id, query, max_tokens=max_tokens)
         if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-            response, plugins_used = await self.__handle_function_call(chat_id, response)
+            response, plugins_used = await self.__handle_function_call(chat_id, response, token_budget=token_budget)
             if is_direct_result(response):
                 return response, '0'
 
@@ -149,6 +190,8 @@ class OpenAIHelper:
         else:
             answer = response.choices[0].message.content.strip()
             self.__add_to_history(chat_id, role="assistant", content=answer)
+            if len(plugins_used) == 0:
+                self.__cache_response(cache_namespace, query, answer)
 
         bot_language = self.config['bot_language']
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
@@ -165,17 +208,28 @@ class OpenAIHelper:
 
         return answer, response.usage.total_tokens
 
-    async def get_chat_response_stream(self, chat_id: int, query: str):
+    async def get_chat_response_stream(self, chat_id: int, query: str, max_tokens: int | None = None,
+                                       token_budget: int | None = None):
         """
         Stream response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
+        :param max_tokens: Limit of the completion tokens below the configured one, the stream stops when reached
+        :param token_budget: Limit of the tokens of all the requests of the answer, function calls included
         :return: The answer from the model and the number of tokens used, or 'not_finished'
         """
+        cache_namespace = self.__get_response_cache_namespace(chat_id)
+        cached_answer = self.__get_cached_response(chat_id, query, cache_namespace)
+        if cached_answer is not None:
+            yield cached_answer, 'not_finished'
+            yield cached_answer, '0'
+            return
+
         plugins_used = ()
-        response = await self.__common_get_chat_response(chat_id, query, stream=True)
+        response = await self.__common_get_chat_response(chat_id, query, stream=True, max_tokens=max_tokens)
         if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-            response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
+            response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True,
+                                                                       token_budget=token_budget)
             if is_direct_result(response):
                 yield response, '0'
                 return
@@ -190,6 +244,8 @@ class OpenAIHelper:
                 yield answer, 'not_finished'
         answer = answer.strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
+        if len(plugins_used) == 0:
+            self.__cache_response(cache_namespace, query, answer)
         tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
 
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
@@ -209,14 +265,16 @@ class OpenAIHelper:
         wait=wait_fixed(20),
         stop=stop_after_attempt(3)
     )
-    async def __common_get_chat_response(self, chat_id: int, query: str, stream=False):
+    async def __common_get_chat_response(self, chat_id: int, query: str, stream=False, max_tokens: int | None = None):
         """
         Request a response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
+        :param max_tokens: Limit of the completion tokens below the configured one
         :return: The answer from the model and the number of tokens used
         """
         bot_language = self.config['bot_language']
+        max_tokens = self.config['max_tokens'] if max_tokens is None else min(max_tokens, self.config['max_tokens'])
         try:
             if chat_id not in self.conversations or self.__max_age_reached(chat_id):
                 self.reset_chat_history(chat_id)
@@ -225,40 +283,48 @@ class OpenAIHelper:
 
             self.__add_to_history(chat_id, role="user", content=query)
 
+            functions_enabled = self.config['enable_functions'] and not self.conversations_vision[chat_id]
+            functions = self.__get_functions_specs(self.conversations[chat_id]) if functions_enabled else []
+
             # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
+            specs_tokens = self.plugin_manager.count_specs_tokens(functions)
+            token_count = self.__count_tokens(self.conversations[chat_id]) + specs_tokens
+            exceeded_max_tokens = token_count + self.config['min_max_tokens'] > self.__max_model_tokens()
             exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
 
             if exceeded_max_tokens or exceeded_max_history_size:
-                logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
-                try:
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.__add_to_history(chat_id, role="user", content=query)
-                except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                await self.__shorten_history(chat_id, reserved_tokens=specs_tokens + max_tokens)
+                if functions_enabled:
+                    # The selection depends on the recent turns, which have just changed
+                    functions = self.__get_functions_specs(self.conversations[chat_id])
+                    specs_tokens = self.plugin_manager.count_specs_tokens(functions)
+                token_count = self.__count_tokens(self.conversations[chat_id]) + specs_tokens
+
+            recalled = self.__recall_earlier_messages(chat_id, query)
+            recalled_tokens = self.__count_message_tokens(recalled) if recalled is not None else 0
+            max_tokens = self.__get_completion_budget(chat_id, token_count + recalled_tokens,
+                                                      specs_tokens + recalled_tokens, max_tokens)
+
+            messages = self.conversations[chat_id]
+            if recalled is not None:
+                # Not part of the history, the recalled messages depend on each query
+                messages = messages[:-1] + [recalled, messages[-1]]
 
             common_args = {
                 'model': self.config['model'] if not self.conversations_vision[chat_id] else self.config['vision_model'],
-                'messages': self.conversations[chat_id],
+                'messages': messages,
                 'temperature': self.config['temperature'],
                 'n': self.config['n_choices'],
-                'max_tokens': self.config['max_tokens'],
+                'max_tokens': max_tokens,
                 'presence_penalty': self.config['presence_penalty'],
                 'frequency_penalty': self.config['frequency_penalty'],
                 'stream': stream
             }
 
-            if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
-                functions = self.plugin_manager.get_functions_specs()
-                if len(functions) > 0:
-                    common_args['functions'] = self.plugin_manager.get_functions_specs()
-                    common_args['function_call'] = 'auto'
-            return await self.client.chat.completions.create(**common_args)
+            if len(functions) > 0:
+                common_args['functions'] = functions
+                common_args['function_call'] = 'auto'
+            return await self.__create_chat_completion(**common_args)
 
         except openai.RateLimitError as e:
             raise e
@@ -269,7 +335,37 @@ class OpenAIHelper:
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
-    async def __handle_function_call(self, chat_id, response, stream=False, times=0, plugins_used=()):
+    async def __create_chat_completion(self, **kwargs):
+        """
+        Sends a chat completion request. Identical requests in flight at the same time, e.g. the same first
+        message in several chats, share a single upstream request: the response, or the streamed chunks,
+        are handed to every caller. Each caller then updates its own history and usage.
+        """
+        key = self.__get_request_key('chat', kwargs)
+        if kwargs.get('stream', False):
+            return await self.requests_in_flight.stream(key, lambda: self.client.chat.completions.create(**kwargs))
+        return await self.requests_in_flight.do(key, lambda: self.client.chat.completions.create(**kwargs))
+
+    @staticmethod
+    def __get_request_key(kind: str, request: dict) -> str:
+        serialised = json.dumps([kind, request], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(serialised.encode()).hexdigest()
+
+    def get_shared_requests_count(self) -> int:
+        """
+        Returns the number of requests that joined an identical request in flight instead of calling the API
+        """
+        return self.requests_in_flight.shared
+
+    async def __handle_function_call(self, chat_id, response, stream=False, times=0, plugins_used=(),
+                                     token_budget: int | None = None, spent_tokens: int = 0):
+        """
+        Calls the functions requested by the model and sends their results back, until it answers.
+        :param token_budget: Limit of the tokens of all the requests, e.g. the ones reserved from a budget:
+                             once another function call would not fit, the model is asked to answer
+                             within the tokens left
+        :param spent_tokens: The estimated tokens of the requests sent before the one answered by the response
+        """
         function_name = ''
         arguments = ''
         if stream:
@@ -300,6 +396,11 @@ class OpenAIHelper:
             else:
                 return response, plugins_used
 
+        # The request answered by the response, sent with the history as it is now
+        spent_tokens += self.__count_tokens(self.conversations[chat_id]) + \
+            self.plugin_manager.count_specs_tokens(self.__get_functions_specs(self.conversations[chat_id])) + \
+            self.__count_message_tokens({'role': 'assistant', 'content': function_name + arguments})
+
         logging.info(f'Calling function {function_name} with arguments {arguments}')
         function_response = await self.plugin_manager.call_function(function_name, self, arguments)
 
@@ -313,14 +414,130 @@ class OpenAIHelper:
             return function_response, plugins_used
 
         self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name, content=function_response)
-        response = await self.client.chat.completions.create(
-            model=self.config['model'],
-            messages=self.conversations[chat_id],
-            functions=self.plugin_manager.get_functions_specs(),
-            function_call='auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
-            stream=stream
-        )
-        return await self.__handle_function_call(chat_id, response, stream, times + 1, plugins_used)
+        functions = self.__get_functions_specs(self.conversations[chat_id])
+        specs_tokens = self.plugin_manager.count_specs_tokens(functions)
+        self.__trim_history(chat_id, self.__max_model_tokens() - specs_tokens - self.config['min_max_tokens'])
+        follow_up_args = {
+            'model': self.config['model'],
+            'messages': self.conversations[chat_id],
+            'stream': stream
+        }
+        function_call = 'auto' if times < self.config['functions_max_consecutive_calls'] else 'none'
+        if token_budget is not None:
+            min_max_tokens = self.config['min_max_tokens']
+            prompt_tokens = self.__count_tokens(self.conversations[chat_id]) + specs_tokens
+            remaining_tokens = token_budget - spent_tokens - prompt_tokens
+            # Another function call needs room for this completion and for the prompt of one more follow-up
+            if remaining_tokens < prompt_tokens + 2 * min_max_tokens:
+                function_call = 'none'
+            follow_up_args['max_tokens'] = max(min_max_tokens, min(self.config['max_tokens'], remaining_tokens))
+        # No plugin may be selected any more, e.g. when the circuit breaker of the only relevant one just opened
+        if len(functions) > 0:
+            follow_up_args['functions'] = functions
+            follow_up_args['function_call'] = function_call
+        response = await self.__create_chat_completion(**follow_up_args)
+        return await self.__handle_function_call(chat_id, response, stream, times + 1, plugins_used,
+                                                 token_budget, spent_tokens)
+
+    def __get_response_cache_namespace(self, chat_id) -> str | None:
+        """
+        Returns the namespace of the cached answers that may be reused for the next query of a chat,
+        or None if its answer can't be cached: only the first message of a conversation is answered
+        from the cache, as the answer then only depends on the system prompt and the sampling parameters.
+        With the history index, a first message may recall the earlier messages of the chat, even after
+        a max-age reset or a restart: its answer is private to the chat and is never cached
+        """
+        if (self.response_cache is None and self.semantic_cache is None) or self.history_index is not None \
+                or self.config['n_choices'] > 1 \
+                or self.config['temperature'] > self.config['response_cache_max_temperature']:
+            return None
+        if chat_id not in self.conversations or self.__max_age_reached(chat_id):
+            system_prompt = self.config['assistant_prompt']
+        elif len(self.conversations[chat_id]) == 1 and not self.conversations_vision[chat_id]:
+            system_prompt = self.conversations[chat_id][0]['content']
+        else:
+            return None
+        namespace = json.dumps([self.config['model'], system_prompt, self.config['temperature'],
+                                self.config['presence_penalty'], self.config['frequency_penalty'],
+                                self.config['max_tokens']], ensure_ascii=False)
+        return hashlib.sha256(namespace.encode()).hexdigest()
+
+    def __get_cached_response(self, chat_id, query: str, namespace: str | None) -> str | None:
+        """
+        Returns the cached answer to the query, looking up an identical question first and a similar one next,
+        and adds the exchange to the conversation history. Returns None on a cache miss
+        """
+        # A new query: the previous answer can no longer be reported as a false positive
+        self.semantic_cache_hits.pop(chat_id, None)
+        if namespace is None:
+            return None
+        answer = None
+        if self.response_cache is not None:
+            answer = self.response_cache.get(self.__get_response_cache_key(namespace, query))
+        if answer is None and self.semantic_cache is not None:
+            hit = self.semantic_cache.get(namespace, query)
+            if hit is not None:
+                self.semantic_cache_hits[chat_id], answer = hit
+        if answer is None:
+            return None
+
+        logging.info(f'Answering chat ID {chat_id} from the response cache')
+        if chat_id not in self.conversations or self.__max_age_reached(chat_id):
+            self.reset_chat_history(chat_id)
+        self.last_updated[chat_id] = datetime.datetime.now()
+        self.__add_to_history(chat_id, role="user", content=query)
+        self.__add_to_history(chat_id, role="assistant", content=answer)
+        return answer
+
+    def __cache_response(self, namespace: str | None, query: str, answer: str):
+        if namespace is None or not answer:
+            return
+        if self.response_cache is not None:
+            self.response_cache.set(self.__get_response_cache_key(namespace, query), answer)
+        if self.semantic_cache is not None:
+            self.semantic_cache.set(namespace, query, answer)
+
+    @staticmethod
+    def __get_response_cache_key(namespace: str, query: str) -> str:
+        normalised_query = ' '.join(query.split()).casefold()
+        return hashlib.sha256(f'{namespace}:{normalised_query}'.encode()).hexdigest()
+
+    def report_unhelpful_cached_answer(self, chat_id):
+        """
+        Called when the user asks again right after an answer. If that answer came from a similar question
+        in the semantic cache, it is counted as a false positive, removed from the cache and from the history
+        """
+        entry = self.semantic_cache_hits.pop(chat_id, None)
+        if entry is None:
+            return
+        self.semantic_cache.report_false_positive(entry)
+        history = self.conversations.get(chat_id, [])
+        if len(history) == 3:
+            del history[1:]
+
+    def get_semantic_cache_stats(self) -> dict | None:
+        """
+        Returns the semantic cache counters, or None if the cache is disabled
+        """
+        return self.semantic_cache.get_stats() if self.semantic_cache is not None else None
+
+    def get_response_cache_stats(self) -> dict | None:
+        """
+        Returns the response cache counters, or None if the cache is disabled
+        """
+        return self.response_cache.get_stats() if self.response_cache is not None else None
+
+    def __get_functions_specs(self, history: list) -> list:
+        """
+        Gets the function specs relevant to the latest turns of the conversation,
+        always including the functions already called in it
+        :param history: The messages of the conversation
+        """
+        recent_turns = [message['content'] for message in history
+                        if message['role'] in ('user', 'assistant') and isinstance(message['content'], str)]
+        query = ' '.join(recent_turns[-self.config.get('functions_selection_turns', 3):])
+        recently_used = {message['name'] for message in history if message['role'] == 'function'}
+        return self.plugin_manager.select_functions_specs(query, recently_used)
 
     async def generate_image(self, prompt: str) -> tuple[str, str]:
         """
@@ -330,13 +547,17 @@ class OpenAIHelper:
         """
         bot_language = self.config['bot_language']
         try:
-            response = await self.client.images.generate(
-                prompt=prompt,
-                n=1,
-                model=self.config['image_model'],
-                quality=self.config['image_quality'],
-                style=self.config['image_style'],
-                size=self.config['image_size']
+            image_args = {
+                'prompt': prompt,
+                'n': 1,
+                'model': self.config['image_model'],
+                'quality': self.config['image_quality'],
+                'style': self.config['image_style'],
+                'size': self.config['image_size']
+            }
+            response = await self.requests_in_flight.do(
+                self.__get_request_key('image', image_args),
+                lambda: self.client.images.generate(**image_args)
             )
 
             if len(response.data) == 0:
@@ -358,16 +579,20 @@ class OpenAIHelper:
         """
         bot_language = self.config['bot_language']
         try:
-            response = await self.client.audio.speech.create(
-                model=self.config['tts_model'],
-                voice=self.config['tts_voice'],
-                input=text,
-                response_format='opus'
-            )
+            speech_args = {
+                'model': self.config['tts_model'],
+                'voice': self.config['tts_voice'],
+                'input': text,
+                'response_format': 'opus'
+            }
+
+            async def _create_speech():
+                response = await self.client.audio.speech.create(**speech_args)
+                return response.read()
 
-            temp_file = io.BytesIO()
-            temp_file.write(response.read())
-            temp_file.seek(0)
+            audio = await self.requests_in_flight.do(self.__get_request_key('speech', speech_args), _create_speech)
+            # Every caller gets its own file object over the shared audio
+            temp_file = io.BytesIO(audio)
             return temp_file, len(text)
         except Exception as e:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
@@ -417,22 +642,14 @@ class OpenAIHelper:
 
             # Summarize the chat history if it's too long to avoid excessive token usage
             token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
+            exceeded_max_tokens = token_count + self.config['min_max_tokens'] > self.__max_model_tokens()
             exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
 
             if exceeded_max_tokens or exceeded_max_history_size:
-                logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
-                try:
-                    
-                    last = self.conversations[chat_id][-1]
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.conversations[chat_id] += [last]
-                except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                await self.__shorten_history(chat_id, reserved_tokens=self.config['vision_max_tokens'])
+                token_count = self.__count_tokens(self.conversations[chat_id])
+
+            max_tokens = self.__get_completion_budget(chat_id, token_count, 0, self.config['vision_max_tokens'])
 
             message = {'role':'user', 'content':content}
 
@@ -441,7 +658,7 @@ class OpenAIHelper:
                 'messages': self.conversations[chat_id][:-1] + [message],
                 'temperature': self.config['temperature'],
                 'n': 1, # several choices is not implemented yet
-                'max_tokens': self.config['vision_max_tokens'],
+                'max_tokens': max_tokens,
                 'presence_penalty': self.config['presence_penalty'],
                 'frequency_penalty': self.config['frequency_penalty'],
                 'stream': stream
@@ -456,7 +673,7 @@ class OpenAIHelper:
             #         common_args['functions'] = self.plugin_manager.get_functions_specs()
             #         common_args['function_call'] = 'auto'
             
-            return await self.client.chat.completions.create(**common_args)
+            return await self.__create_chat_completion(**common_args)
 
         except openai.RateLimitError as e:
             raise e
@@ -570,6 +787,8 @@ class OpenAIHelper:
             content = self.config['assistant_prompt']
         self.conversations[chat_id] = [{"role": "system", "content": content}]
         self.conversations_vision[chat_id] = False
+        self.history_summaries.pop(chat_id, None)
+        self.dropped_turns.pop(chat_id, None)
 
     def __max_age_reached(self, chat_id) -> bool:
         """
@@ -584,6 +803,110 @@ class OpenAIHelper:
         max_age_minutes = self.config['max_conversation_age_minutes']
         return last_updated < now - datetime.timedelta(minutes=max_age_minutes)
 
+    def __get_completion_budget(self, chat_id, token_count: int, extra_tokens: int, max_tokens: int) -> int:
+        """
+        Sizes the completion to the part of the context window left by the prompt, so that a long prompt
+        gets a shorter answer instead of being rejected. If not even the configured minimum fits,
+        the oldest turns are dropped locally.
+        :param chat_id: The chat ID
+        :param token_count: The prompt tokens, including the extra tokens
+        :param extra_tokens: The tokens sent besides the history, e.g. the function specs
+        :param max_tokens: The configured maximum number of completion tokens
+        :return: The max_tokens value of the request
+        """
+        min_max_tokens = min(self.config['min_max_tokens'], max_tokens)
+        remaining_tokens = self.__max_model_tokens() - token_count
+        if remaining_tokens < min_max_tokens:
+            self.__trim_history(chat_id, self.__max_model_tokens() - extra_tokens - min_max_tokens)
+            remaining_tokens = self.__max_model_tokens() - self.__count_tokens(self.conversations[chat_id]) - \
+                extra_tokens
+        return max(min_max_tokens, min(max_tokens, remaining_tokens))
+
+    async def __shorten_history(self, chat_id, reserved_tokens: int):
+        """
+        Shortens a chat history that grew too long, with the configured strategy:
+        `summarise` replaces it with a summary, `window` drops the oldest turns
+        and `hybrid` drops the oldest turns and summarises them in the background.
+        :param chat_id: The chat ID
+        :param reserved_tokens: The tokens needed besides the history, e.g. function specs and completion
+        """
+        strategy = self.config['history_strategy']
+        if strategy == 'summarise':
+            logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
+            try:
+                history = self.conversations[chat_id]
+                summary = await self.__summarise(history[:-1])
+                logging.debug(f'Summary: {summary}')
+                self.conversations[chat_id] = [history[0], {"role": "assistant", "content": summary}, history[-1]]
+                return
+            except Exception as e:
+                logging.warning(f'Error while summarising chat history: {str(e)}. Trimming it instead...')
+
+        max_tokens = self.__max_model_tokens() - reserved_tokens
+        if self.config['history_window_tokens'] > 0:
+            max_tokens = min(max_tokens, self.config['history_window_tokens'])
+        # Hybrid drops turns in batches, so that the background summary is not updated on every message
+        max_messages = self.config['max_history_size'] // 2 if strategy == 'hybrid' else self.config['max_history_size']
+        self.__trim_history(chat_id, max_tokens, max_messages)
+
+    def __trim_history(self, chat_id, max_tokens: int, max_messages: int | None = None):
+        """
+        Drops the oldest turns after the system prompt (and the background summary, if any)
+        until the history fits the given budget. The latest message is always kept.
+        :param chat_id: The chat ID
+        :param max_tokens: The token budget of the history
+        :param max_messages: The maximum number of messages of the history, defaults to no limit
+        """
+        history = self.conversations[chat_id]
+        if max_messages is None:
+            max_messages = len(history)
+        summary = self.history_summaries.get(chat_id)
+        keep = 2 if len(history) > 2 and history[1] is summary else 1
+        dropped = trim_to_window(history, max_tokens - 3, max(max_messages, keep + 1),
+                                 self.__count_message_tokens, keep)
+        if len(dropped) == 0:
+            return
+        logging.info(f'Dropped the {len(dropped)} oldest messages of chat ID {chat_id} to fit the context window')
+        if self.config['history_strategy'] == 'hybrid':
+            self.__summarise_in_background(chat_id, dropped)
+
+    def __summarise_in_background(self, chat_id, messages: list):
+        """
+        Queues dropped messages to be merged into the chat summary, without delaying the current request
+        """
+        self.dropped_turns.setdefault(chat_id, []).extend(messages)
+        if chat_id in self.summary_tasks:
+            return
+        task = asyncio.create_task(self.__update_history_summary(chat_id))
+        self.summary_tasks[chat_id] = task
+        task.add_done_callback(lambda _: self.summary_tasks.pop(chat_id, None))
+
+    async def __update_history_summary(self, chat_id):
+        """
+        Summarises the queued dropped messages together with the previous summary,
+        and puts the new summary right after the system prompt
+        """
+        while self.dropped_turns.get(chat_id):
+            history = self.conversations[chat_id]
+            previous_summary = self.history_summaries.get(chat_id)
+            dropped = self.dropped_turns.pop(chat_id)
+            try:
+                summary = await self.__summarise(([previous_summary] if previous_summary else []) + dropped)
+            except Exception as e:
+                logging.warning(f'Error while summarising dropped messages of chat ID {chat_id}: {str(e)}')
+                return
+            if self.conversations.get(chat_id) is not history:
+                # The chat was reset or summarised meanwhile
+                return
+            summary_message = {"role": "assistant", "content": summary}
+            # A request in flight may be sending the history: replace it with a new list instead of changing it
+            if previous_summary is not None and len(history) > 1 and history[1] is previous_summary:
+                self.conversations[chat_id] = [history[0], summary_message] + history[2:]
+            else:
+                self.conversations[chat_id] = [history[0], summary_message] + history[1:]
+            self.history_summaries[chat_id] = summary_message
+            logging.debug(f'Background summary of chat ID {chat_id}: {summary}')
+
     def __add_function_call_to_history(self, chat_id, function_name, content):
         """
         Adds a function call to the conversation history
@@ -598,6 +921,46 @@ class OpenAIHelper:
         :param content: The message content
         """
         self.conversations[chat_id].append({"role": role, "content": content})
+        if self.history_index is not None and role in ('user', 'assistant') and isinstance(content, str):
+            self.history_index.add(chat_id, role, content)
+
+    def __recall_earlier_messages(self, chat_id, query: str) -> dict | None:
+        """
+        Finds the earlier messages of the chat relevant to the query that are no longer in the history.
+        :param chat_id: The chat ID
+        :param query: The query to send to the model
+        :return: A system message quoting them, or None
+        """
+        if self.history_index is None:
+            return None
+        history_contents = [message['content'] for message in self.conversations[chat_id]
+                            if isinstance(message['content'], str)]
+        started = time.perf_counter()
+        recalled = self.history_index.search(chat_id, query, top_k=self.config['history_retrieval_top_k'],
+                                             exclude=history_contents)
+        logging.debug(f'Searched the history index of chat ID {chat_id} in '
+                      f'{(time.perf_counter() - started) * 1000:.2f} ms')
+        if len(recalled) == 0:
+            return None
+
+        encoding = get_encoding(self.config['model'])
+        budget = self.config['history_retrieval_max_tokens']
+        lines = []
+        for message in recalled:
+            tokens = encoding.encode(f"{message['role']}: {message['content']}")[:budget]
+            lines.append(encoding.decode(tokens))
+            budget -= len(tokens)
+            if budget <= 0:
+                break
+        return {"role": "system",
+                "content": "Earlier messages of this conversation that may be relevant:\n" + "\n".join(lines)}
+
+    def clear_history_index(self, chat_id):
+        """
+        Forgets the earlier messages of a chat indexed for recall
+        """
+        if self.history_index is not None:
+            self.history_index.clear(chat_id)
 
     async def __summarise(self, conversation) -> str:
         """
@@ -641,11 +1004,26 @@ class OpenAIHelper:
         :param messages: the messages to send
         :return: the number of tokens required
         """
+        num_tokens = sum(self.__count_message_tokens(message) for message in messages)
+        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        return num_tokens
+
+    def __count_message_tokens(self, message) -> int:
+        """
+        Counts the number of tokens of a single message. Text messages are cached,
+        since the whole history is counted again on every request.
+        :param message: the message
+        :return: the number of tokens of the message
+        """
+        cache_key = None
+        if isinstance(message.get('content'), str) and 'function_call' not in message:
+            cache_key = (message['role'], message.get('name'), message['content'])
+            num_tokens = self.message_tokens.get(cache_key)
+            if num_tokens is not None:
+                return num_tokens
+
         model = self.config['model']
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("gpt-3.5-turbo")
+        encoding = get_encoding(model)
 
         if model in GPT_3_MODELS + GPT_3_16K_MODELS:
             tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
@@ -655,25 +1033,32 @@ class OpenAIHelper:
             tokens_per_name = 1
         else:
             raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}.""")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                if key == 'content':
-                    if isinstance(value, str):
-                        num_tokens += len(encoding.encode(value))
-                    else:
-                        for message1 in value:
-                            if message1['type'] == 'image_url':
-                                image = decode_image(message1['image_url']['url'])
-                                num_tokens += self.__count_tokens_vision(image)
-                            else:
-                                num_tokens += len(encoding.encode(message1['text']))
-                else:
+        num_tokens = tokens_per_message
+        for key, value in message.items():
+            if value is None:
+                continue
+            if key == 'content':
+                if isinstance(value, str):
                     num_tokens += len(encoding.encode(value))
-                    if key == "name":
-                        num_tokens += tokens_per_name
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+                else:
+                    for message1 in value:
+                        if message1['type'] == 'image_url':
+                            image = decode_image(message1['image_url']['url'])
+                            num_tokens += self.__count_tokens_vision(image)
+                        else:
+                            num_tokens += len(encoding.encode(message1['text']))
+            elif key == 'function_call':
+                # assistant messages calling a function carry its name and JSON arguments
+                num_tokens += len(encoding.encode(value.get('name', '')))
+                num_tokens += len(encoding.encode(value.get('arguments', '')))
+            else:
+                num_tokens += len(encoding.encode(value))
+                if key == "name":
+                    # function results keep their role, the name is an additional field
+                    num_tokens += 1 if message.get('role') == 'function' else tokens_per_name
+
+        if cache_key is not None:
+            self.message_tokens.set(cache_key, num_tokens)
         return num_tokens
 
     # no longer needed
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+
+class PluginGuard:
+    """
+    Protects the calls to a plugin with a concurrency limit (bulkhead), a hard timeout
+    and a circuit breaker, so that a slow or failing external service can't hang the function call chain.
+    The breaker opens after a number of consecutive failures and rejects calls until its cooldown
+    has elapsed, then lets calls through again and closes on the first success.
+    Only timeouts and exceptions are failures: an error result of the plugin, e.g. for an invalid input
+    of the model, comes from a working service and must not disable the plugin for everyone.
+    """
+
+    def __init__(self, name: str, max_concurrency: int = 4, timeout: float = 30.0,
+                 failure_threshold: int = 3, cooldown: float = 60.0):
+        """
+        Initializes the guard.
+        :param name: The plugin name, used in logs and errors
+        :param max_concurrency: Maximum number of calls executing at the same time
+        :param timeout: Deadline in seconds for a call, including the time waiting for a free slot
+        :param failure_threshold: Number of consecutive failures after which the breaker opens
+        :param cooldown: Number of seconds the breaker stays open
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._semaphore = None
+
+    def is_open(self) -> bool:
+        """
+        Whether the breaker is open, i.e. calls are currently rejected
+        """
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info(f'Circuit breaker for plugin {self.name} closed')
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        # A failure after the cooldown (half-open state) re-opens the breaker right away
+        if self.failures >= self.failure_threshold or self.opened_at is not None:
+            logging.warning(f'Circuit breaker for plugin {self.name} opened after {self.failures} failures')
+            self.opened_at = time.monotonic()
+
+    async def call(self, coroutine_function) -> dict:
+        """
+        Runs the plugin call, or returns a structured error the model can read if it is rejected or fails.
+        :param coroutine_function: A function returning the awaitable plugin call
+        :return: The plugin response
+        """
+        if self.is_open():
+            retry_after = int(self.cooldown - (time.monotonic() - self.opened_at)) + 1
+            return self.__error('unavailable', f'{self.name} is temporarily unavailable', retry_after)
+
+        # Created lazily, so that it is bound to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def _guarded_call():
+            async with self._semaphore:
+                return await coroutine_function()
+
+        try:
+            response = await asyncio.wait_for(_guarded_call(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f'Plugin {self.name} timed out after {self.timeout} seconds')
+            self.record_failure()
+            return self.__error('timeout', f'{self.name} did not respond in time')
+        except Exception as e:
+            logging.exception(e)
+            self.record_failure()
+            return self.__error('failed', f'{self.name} failed: {str(e)}')
+
+        self.record_success()
+        return response
+
+    def __error(self, reason: str, message: str, retry_after: int | None = None) -> dict:
+        error = {'error': message, 'reason': reason}
+        if retry_after is not None:
+            error['retry_after_seconds'] = retry_after
+        error['hint'] = 'Do not call this function again for now, answer without it'
+        return error
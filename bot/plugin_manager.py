@@ -1,4 +1,11 @@
+from __future__ import annotations
+
+import importlib.util
 import json
+import logging
+from datetime import date
+
+import httpx
 
 from plugins.gtts_text_to_speech import GTTSTextToSpeech
 from plugins.auto_tts import AutoTextToSpeech
@@ -15,6 +22,15 @@ from plugins.deepl import DeeplTranslatePlugin
 from plugins.worldtimeapi import WorldTimeApiPlugin
 from plugins.whois_ import WhoisPlugin
 from plugins.webshot import WebshotPlugin
+from bm25 import BM25Index
+from plugin_guard import PluginGuard
+from result_compaction import compact_function_result
+from spec_compiler import SpecCompiler
+from ttl_cache import TTLCache, SingleFlight
+from utils import is_direct_result, get_encoding
+
+# Prompt tokens taken by the wrapper around the function specs
+FUNCTIONS_BASE_TOKENS = 12
 
 
 class PluginManager:
@@ -42,12 +58,174 @@ class PluginManager:
             'webshot': WebshotPlugin,
         }
         self.plugins = [plugin_mapping[plugin]() for plugin in enabled_plugins if plugin in plugin_mapping]
+        self.http_client = self.__create_http_client(config)
+        self._guards = {plugin: PluginGuard(name=plugin.get_source_name(),
+                                            max_concurrency=config.get('max_concurrency', 4),
+                                            timeout=config.get('timeout', 30.0),
+                                            failure_threshold=config.get('breaker_threshold', 3),
+                                            cooldown=config.get('breaker_cooldown', 60.0))
+                        for plugin in self.plugins}
+        self._unavailable_plugins = frozenset()
+        self.encoding = get_encoding(config.get('model', 'gpt-3.5-turbo'))
+
+        self.specs_version = 0
+        self._plugin_specs = {}  # {plugin: [spec]}
+        self._specs_date = None
+        self._functions_specs = []
+        self._functions_specs_json = '[]'
+        self._function_index = {}  # {function_name: plugin}
+        self._spec_tokens = {}  # {function_name: number_of_tokens}
+        self._specs_index = BM25Index()
+        self.spec_compiler = SpecCompiler(max_description_length=config.get('max_description_length', 0),
+                                          max_enum_size=config.get('max_enum_size', 0))
+        self.__build_functions_specs()
+        self.__log_functions_specs_cost()
+
+        self.selection_top_k = config.get('selection_top_k', 0)
+        self.selections = 0
+        self.saved_spec_tokens = 0
+
+        self.result_max_tokens = config.get('result_max_tokens', 1000)
+        self.results_cache = TTLCache(max_size=config.get('cache_size', 256))
+        self.in_flight = SingleFlight()
+
+    @staticmethod
+    def __create_http_client(config) -> httpx.AsyncClient:
+        """
+        Creates the HTTP client shared by all plugins, so that repeated calls to the same host
+        reuse warm keep-alive connections instead of opening a new TCP+TLS connection each time
+        """
+        max_connections = config.get('http_max_connections', 20)
+        return httpx.AsyncClient(
+            http2=importlib.util.find_spec('h2') is not None,
+            proxies=config.get('proxy'),
+            timeout=httpx.Timeout(config.get('http_timeout', 15.0), connect=5.0),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections,
+                                keepalive_expiry=60.0),
+            headers={'User-Agent': 'chatgpt-telegram-bot'},
+            follow_redirects=True,
+        )
+
+    async def close(self):
+        """
+        Close the shared HTTP client and its pooled connections
+        """
+        await self.http_client.aclose()
 
     def get_functions_specs(self):
         """
-        Return the list of function specs that can be called by the model
+        Return the list of function specs that can be called by the model.
+        The list is cached and shared between requests, it must not be modified by the caller
         """
-        return [spec for specs in map(lambda plugin: plugin.get_spec(), self.plugins) for spec in specs]
+        self.__refresh_functions_specs()
+        return self._functions_specs
+
+    def get_functions_specs_json(self) -> str:
+        """
+        Return the function specs, pre-serialised as compact JSON
+        """
+        self.__refresh_functions_specs()
+        return self._functions_specs_json
+
+    def __build_functions_specs(self):
+        """
+        Render the specs of all plugins once and index them by function name
+        """
+        self._plugin_specs = {plugin: self.__compile_specs(plugin) for plugin in self.plugins}
+        self._specs_date = date.today()
+        self.__update_functions_specs()
+
+    def __refresh_functions_specs(self):
+        """
+        Re-render the specs of time-dependent plugins when the day has changed since they were rendered,
+        and leave out the specs of plugins whose circuit breaker is open
+        """
+        changed = False
+        today = date.today()
+        if self._specs_date != today:
+            self._specs_date = today
+            for plugin in self.plugins:
+                if plugin.is_spec_time_dependent():
+                    self._plugin_specs[plugin] = self.__compile_specs(plugin)
+                    changed = True
+
+        unavailable_plugins = frozenset(plugin for plugin in self.plugins if self._guards[plugin].is_open())
+        if unavailable_plugins != self._unavailable_plugins:
+            self._unavailable_plugins = unavailable_plugins
+            changed = True
+
+        if changed:
+            self.__update_functions_specs()
+
+    def __count_spec_tokens(self, spec) -> int:
+        return len(self.encoding.encode(json.dumps(spec, separators=(',', ':'), ensure_ascii=False)))
+
+    def __compile_specs(self, plugin) -> list:
+        return [self.spec_compiler.compile(spec) for spec in plugin.get_spec()]
+
+    def __log_functions_specs_cost(self):
+        """
+        Log the number of prompt tokens each function spec adds to every request
+        """
+        if len(self._spec_tokens) == 0:
+            return
+        for plugin in self.plugins:
+            for spec in self._plugin_specs[plugin]:
+                logging.info(f'Function spec {spec["name"]} ({plugin.get_source_name()}): '
+                             f'{self._spec_tokens[spec["name"]]} tokens')
+        logging.info(f'Function specs of {len(self.plugins)} plugins add {sum(self._spec_tokens.values())} '
+                     f'prompt tokens to every request')
+
+    def __update_functions_specs(self):
+        self._functions_specs = [spec for plugin in self.plugins if plugin not in self._unavailable_plugins
+                                 for spec in self._plugin_specs[plugin]]
+        self._functions_specs_json = json.dumps(self._functions_specs, separators=(',', ':'), ensure_ascii=False)
+        self._function_index = {spec.get('name'): plugin
+                                for plugin in reversed(self.plugins) for spec in self._plugin_specs[plugin]}
+        self._spec_tokens = {spec['name']: self.__count_spec_tokens(spec) for spec in self._functions_specs}
+        self._specs_index = BM25Index()
+        for plugin in self.plugins:
+            if plugin not in self._unavailable_plugins:
+                for spec in self._plugin_specs[plugin]:
+                    self._specs_index.add(spec['name'], self.__get_spec_search_text(plugin, spec))
+        self.specs_version += 1
+
+    @staticmethod
+    def __get_spec_search_text(plugin, spec) -> str:
+        """
+        Return the text a spec is matched against: its name, description and parameters.
+        Large enums (e.g. region codes) are left out as they would match unrelated words
+        """
+        texts = [plugin.get_source_name(), spec['name'], spec.get('description', '')]
+        for name, parameter in spec.get('parameters', {}).get('properties', {}).items():
+            texts += [name, parameter.get('description', '')]
+            if len(parameter.get('enum', [])) <= 10:
+                texts += [str(value) for value in parameter.get('enum', [])]
+        return ' '.join(texts)
+
+    def select_functions_specs(self, query: str, recently_used=()) -> list:
+        """
+        Return the function specs relevant to the query: the top-k specs ranked with BM25 over their names
+        and descriptions, plus the specs of recently used functions. All specs are returned if selection is disabled
+        :param query: The user prompt, optionally with the recent turns of the conversation
+        :param recently_used: Names of the functions recently called in the conversation
+        :return: The list of selected function specs
+        """
+        specs = self.get_functions_specs()
+        if self.selection_top_k <= 0 or len(specs) <= self.selection_top_k:
+            return specs
+
+        selected_names = {name for name, _ in self._specs_index.search(query, self.selection_top_k)}
+        selected_names.update(recently_used)
+        selected_specs = [spec for spec in specs if spec['name'] in selected_names]
+
+        saved_tokens = sum(self._spec_tokens[spec['name']] for spec in specs if spec['name'] not in selected_names)
+        self.selections += 1
+        self.saved_spec_tokens += saved_tokens
+        logging.info(f'Selected {len(selected_specs)} of {len(specs)} function specs, '
+                     f'saving {saved_tokens} prompt tokens')
+        return selected_specs
 
     async def call_function(self, function_name, helper, arguments):
         """
@@ -56,7 +234,96 @@ class PluginManager:
         plugin = self.__get_plugin_by_function_name(function_name)
         if not plugin:
             return json.dumps({'error': f'Function {function_name} not found'})
-        return json.dumps(await plugin.execute(function_name, helper, **json.loads(arguments)), default=str)
+
+        ttl = plugin.get_cache_ttl(function_name)
+        if ttl <= 0 or self.results_cache.max_size <= 0:
+            return await self.__execute(plugin, function_name, helper, arguments)
+
+        cache_key = self.__get_cache_key(function_name, arguments)
+        cached_response = self.results_cache.get(cache_key)
+        if cached_response is not None:
+            logging.info(f'Using cached result for function {function_name}')
+            return cached_response
+
+        async def _execute_and_cache():
+            response = await self.__execute(plugin, function_name, helper, arguments)
+            if self.__is_cacheable(response):
+                self.results_cache.set(cache_key, response, ttl=ttl)
+            return response
+
+        # Identical concurrent calls share a single execution
+        return await self.in_flight.do(cache_key, _execute_and_cache)
+
+    def get_cache_stats(self) -> dict:
+        """
+        Return the hit rate of the function results cache
+        """
+        return {**self.results_cache.get_stats(), 'shared': self.in_flight.shared}
+
+    def count_specs_tokens(self, specs) -> int:
+        """
+        Return the number of prompt tokens taken by the given function specs.
+        Token counts are computed once per spec version, and slightly overestimate the actual cost
+        since the API renders the specs in a more compact format than JSON
+        """
+        if len(specs) == 0:
+            return 0
+        return FUNCTIONS_BASE_TOKENS + sum(self._spec_tokens.get(spec['name']) or self.__count_spec_tokens(spec)
+                                           for spec in specs)
+
+    def get_selection_stats(self) -> dict:
+        """
+        Return the number of prompt tokens saved by the function specs selection
+        """
+        return {'selections': self.selections, 'saved_tokens': self.saved_spec_tokens}
+
+    def get_unavailable_plugins(self) -> list[str]:
+        """
+        Return the source names of the plugins whose circuit breaker is currently open
+        """
+        return [plugin.get_source_name() for plugin in self.plugins if self._guards[plugin].is_open()]
+
+    async def __execute(self, plugin, function_name, helper, arguments) -> str:
+        # Malformed arguments are a mistake of the model, checked before the call so that the circuit breaker
+        # of the plugin doesn't count them as failures
+        try:
+            parsed_arguments = json.loads(arguments)
+        except json.JSONDecodeError as e:
+            return json.dumps({'error': f'Invalid arguments for function {function_name}: {str(e)}'})
+        if not isinstance(parsed_arguments, dict):
+            return json.dumps({'error': f'Invalid arguments for function {function_name}: expected an object'})
+
+        response = await self._guards[plugin].call(
+            lambda: plugin.execute(function_name, helper, **parsed_arguments)
+        )
+        if is_direct_result(response):
+            return json.dumps(response, default=str)
+        return compact_function_result(response, self.encoding, self.result_max_tokens)
+
+    @staticmethod
+    def __get_cache_key(function_name, arguments) -> str:
+        """
+        Build the cache key from the function name and the normalised arguments,
+        so that calls differing only in whitespace or argument order share an entry
+        """
+        try:
+            parsed_arguments = json.loads(arguments)
+        except json.JSONDecodeError:
+            return f'{function_name}:{arguments.strip()}'
+        if isinstance(parsed_arguments, dict):
+            parsed_arguments = {key: value.strip() if isinstance(value, str) else value
+                                for key, value in parsed_arguments.items()}
+        return f'{function_name}:{json.dumps(parsed_arguments, sort_keys=True, separators=(",", ":"))}'
+
+    @staticmethod
+    def __is_cacheable(response: str) -> bool:
+        """
+        Errors are not cached, neither are direct results as their files are deleted once sent
+        """
+        if is_direct_result(response):
+            return False
+        parsed_response = json.loads(response)
+        return not (isinstance(parsed_response, dict) and 'error' in parsed_response)
 
     def get_plugin_source_name(self, function_name) -> str:
         """
@@ -68,5 +335,4 @@ class PluginManager:
         return plugin.get_source_name()
 
     def __get_plugin_by_function_name(self, function_name):
-        return next((plugin for plugin in self.plugins
-                     if function_name in map(lambda spec: spec.get('name'), plugin.get_spec())), None)
+        return self._function_index.get(function_name)
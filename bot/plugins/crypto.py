@@ -1,7 +1,5 @@
 from typing import Dict
 
-import requests
-
 from .plugin import Plugin
 
 
@@ -13,6 +11,9 @@ class CryptoPlugin(Plugin):
     def get_source_name(self) -> str:
         return "CoinCap"
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 60
+
     def get_spec(self) -> [Dict]:
         return [{
             "name": "get_crypto_rate",
@@ -27,4 +28,5 @@ class CryptoPlugin(Plugin):
         }]
 
     async def execute(self, function_name, helper, **kwargs) -> Dict:
-        return requests.get(f"https://api.coincap.io/v2/rates/{kwargs['asset']}").json()
+        http_client = helper.plugin_manager.http_client
+        return (await http_client.get(f"https://api.coincap.io/v2/rates/{kwargs['asset']}")).json()
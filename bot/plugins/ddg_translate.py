@@ -12,6 +12,9 @@ class DDGTranslatePlugin(Plugin):
     def get_source_name(self) -> str:
         return "DuckDuckGo Translate"
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 3600
+
     def get_spec(self) -> [Dict]:
         return [{
             "name": "translate",
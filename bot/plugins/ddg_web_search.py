@@ -4,6 +4,7 @@ from typing import Dict
 
 from duckduckgo_search import DDGS
 
+from .ddg_regions import DDG_REGIONS
 from .plugin import Plugin
 
 
@@ -17,6 +18,9 @@ class DDGWebSearchPlugin(Plugin):
     def get_source_name(self) -> str:
         return "DuckDuckGo"
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 900
+
     def get_spec(self) -> [Dict]:
         return [{
             "name": "web_search",
@@ -30,14 +34,7 @@ class DDGWebSearchPlugin(Plugin):
                     },
                     "region": {
                         "type": "string",
-                        "enum": ['xa-ar', 'xa-en', 'ar-es', 'au-en', 'at-de', 'be-fr', 'be-nl', 'br-pt', 'bg-bg',
-                                 'ca-en', 'ca-fr', 'ct-ca', 'cl-es', 'cn-zh', 'co-es', 'hr-hr', 'cz-cs', 'dk-da',
-                                 'ee-et', 'fi-fi', 'fr-fr', 'de-de', 'gr-el', 'hk-tzh', 'hu-hu', 'in-en', 'id-id',
-                                 'id-en', 'ie-en', 'il-he', 'it-it', 'jp-jp', 'kr-kr', 'lv-lv', 'lt-lt', 'xl-es',
-                                 'my-ms', 'my-en', 'mx-es', 'nl-nl', 'nz-en', 'no-no', 'pe-es', 'ph-en', 'ph-tl',
-                                 'pl-pl', 'pt-pt', 'ro-ro', 'ru-ru', 'sg-en', 'sk-sk', 'sl-sl', 'za-en', 'es-es',
-                                 'se-sv', 'ch-de', 'ch-fr', 'ch-it', 'tw-tzh', 'th-th', 'tr-tr', 'ua-uk', 'uk-en',
-                                 'us-en', 'ue-es', 've-es', 'vn-vi', 'wt-wt'],
+                        "enum": DDG_REGIONS,
                         "description": "The region to use for the search. Infer this from the language used for the"
                                        "query. Default to `wt-wt` if not specified",
                     }
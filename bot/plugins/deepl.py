@@ -1,8 +1,6 @@
 import os
 from typing import Dict
 
-import requests
-
 from .plugin import Plugin
 
 
@@ -19,6 +17,9 @@ class DeeplTranslatePlugin(Plugin):
     def get_source_name(self) -> str:
         return "DeepL Translate"
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 3600
+
     def get_spec(self) -> [Dict]:
         return [{
             "name": "translate",
@@ -48,4 +49,5 @@ class DeeplTranslatePlugin(Plugin):
             "text": kwargs['text'],
             "target_lang": kwargs['to_language']
         }
-        return requests.post(url, headers=headers, data=data).json()["translations"][0]["text"]
+        response = await helper.plugin_manager.http_client.post(url, headers=headers, data=data)
+        return response.json()["translations"][0]["text"]
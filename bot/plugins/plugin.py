@@ -22,9 +22,24 @@ class Plugin(ABC):
         """
         pass
 
+    def is_spec_time_dependent(self) -> bool:
+        """
+        Whether the function specs embed the current date and must be re-rendered when the day changes.
+        Specs of other plugins are rendered only once.
+        """
+        return False
+
+    def get_cache_ttl(self, function_name) -> int:
+        """
+        Return the number of seconds the result of the given function can be cached for,
+        or 0 if the result must not be cached (e.g. it changes on every call or is user specific)
+        """
+        return 0
+
     @abstractmethod
     async def execute(self, function_name, helper, **kwargs) -> Dict:
         """
-        Execute the plugin and return a JSON serializable response
+        Execute the plugin and return a JSON serializable response.
+        Plugins doing HTTP requests should use the shared `helper.plugin_manager.http_client`
         """
         pass
@@ -1,8 +1,6 @@
 from datetime import datetime
 from typing import Dict
 
-import requests
-
 from .plugin import Plugin
 
 
@@ -14,6 +12,12 @@ class WeatherPlugin(Plugin):
     def get_source_name(self) -> str:
         return "OpenMeteo"
 
+    def is_spec_time_dependent(self) -> bool:
+        return True
+
+    def get_cache_ttl(self, function_name) -> int:
+        return 600 if function_name == 'get_current_weather' else 1800
+
     def get_spec(self) -> [Dict]:
         latitude_param = {"type": "string", "description": "Latitude of the location"}
         longitude_param = {"type": "string", "description": "Longitude of the location"}
@@ -58,19 +62,20 @@ class WeatherPlugin(Plugin):
         ]
 
     async def execute(self, function_name, helper, **kwargs) -> Dict:
+        http_client = helper.plugin_manager.http_client
         url = f'https://api.open-meteo.com/v1/forecast' \
               f'?latitude={kwargs["latitude"]}' \
               f'&longitude={kwargs["longitude"]}' \
               f'&temperature_unit={kwargs["unit"]}'
         if function_name == 'get_current_weather':
             url += '&current_weather=true'
-            return requests.get(url).json()
+            return (await http_client.get(url)).json()
 
         elif function_name == 'get_forecast_weather':
             url += '&daily=weathercode,temperature_2m_max,temperature_2m_min,precipitation_probability_mean,'
             url += f'&forecast_days={kwargs["forecast_days"]}'
             url += '&timezone=auto'
-            response = requests.get(url).json()
+            response = (await http_client.get(url)).json()
             results = {}
             for i, time in enumerate(response["daily"]["time"]):
                 results[datetime.strptime(time, "%Y-%m-%d").strftime("%A, %B %d, %Y")] = {
@@ -1,4 +1,4 @@
-import os, requests, random, string
+import os, random, string
 from typing import Dict
 from .plugin import Plugin
 
@@ -30,11 +30,13 @@ class WebshotPlugin(Plugin):
         try:
             image_url = f'https://image.thum.io/get/maxAge/12/width/720/{kwargs["url"]}'
             
+            http_client = helper.plugin_manager.http_client
+
             # preload url first
-            requests.get(image_url)
+            await http_client.get(image_url)
 
             # download the actual image
-            response = requests.get(image_url, timeout=30)
+            response = await http_client.get(image_url, timeout=30)
 
             if response.status_code == 200:
                 if not os.path.exists("uploads/webshot"):
@@ -11,6 +11,9 @@ class WhoisPlugin(Plugin):
     def get_source_name(self) -> str:
         return "Whois"
 
+    def get_cache_ttl(self, function_name) -> int:
+        return 3600
+
     def get_spec(self) -> [Dict]:
         return [{
             "name": "get_whois",
@@ -1,4 +1,4 @@
-import os, requests
+import os
 from typing import Dict
 from datetime import datetime
 
@@ -40,7 +40,7 @@ class WorldTimeApiPlugin(Plugin):
         url = f'https://worldtimeapi.org/api/timezone/{timezone}'
 
         try:
-            wtr = requests.get(url).json().get('datetime')
+            wtr = (await helper.plugin_manager.http_client.get(url)).json().get('datetime')
             wtr_obj = datetime.strptime(wtr, "%Y-%m-%dT%H:%M:%S.%f%z")
             time_24hr = wtr_obj.strftime("%H:%M:%S")
             time_12hr = wtr_obj.strftime("%I:%M:%S %p")
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import json
+
+# Progressively stricter limits tried until a result fits its token budget: (max list items, max string length)
+COMPACTION_STEPS = ((10, None), (5, None), (3, 500), (1, 200), (1, 80))
+
+
+def compact_function_result(result, encoding, max_tokens: int) -> str:
+    """
+    Compacts a plugin result before it enters the conversation history, where it is re-sent on every turn.
+    Null and empty fields of objects are dropped and the JSON is minified. If the result still exceeds the token budget,
+    long lists are truncated with a "+N more" marker and long strings are shortened,
+    as a last resort the serialised result is cut at the budget.
+    :param result: The JSON serializable plugin result
+    :param encoding: The tiktoken encoding used to count tokens
+    :param max_tokens: The token budget of the result, 0 to disable truncation
+    :return: The compacted result, serialised as JSON
+    """
+    result = prune_empty_values(result)
+    compacted = minify(result)
+    if max_tokens <= 0 or len(encoding.encode(compacted)) <= max_tokens:
+        return compacted
+
+    for max_items, max_length in COMPACTION_STEPS:
+        compacted = minify(truncate(result, max_items, max_length))
+        if len(encoding.encode(compacted)) <= max_tokens:
+            return compacted
+
+    tokens = encoding.encode(compacted)
+    return minify({'result': encoding.decode(tokens[:max_tokens]), 'truncated': True})
+
+
+def minify(value) -> str:
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str)
+
+
+def prune_empty_values(value):
+    """
+    Recursively removes the dictionary fields whose value is None, an empty string or an empty collection.
+    List items are kept in place, even when empty, as lists are often parallel arrays
+    (e.g. hourly series with missing values) where an item is matched to the others by position.
+    Sets and tuples are converted to lists so that they serialise as JSON arrays.
+    """
+    if isinstance(value, dict):
+        pruned = {str(key): prune_empty_values(item) for key, item in value.items()}
+        return {key: item for key, item in pruned.items() if not is_empty(item)}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [prune_empty_values(item) for item in value]
+    return value
+
+
+def is_empty(value) -> bool:
+    return value is None or (isinstance(value, (str, list, dict)) and len(value) == 0)
+
+
+def truncate(value, max_items: int, max_length: int | None):
+    """
+    Recursively keeps the first max_items of every list, appending a "+N more" marker,
+    and cuts strings longer than max_length
+    """
+    if isinstance(value, dict):
+        return {key: truncate(item, max_items, max_length) for key, item in value.items()}
+    if isinstance(value, list):
+        truncated = [truncate(item, max_items, max_length) for item in value[:max_items]]
+        if len(value) > max_items:
+            truncated.append(f'+{len(value) - max_items} more')
+        return truncated
+    if isinstance(value, str) and max_length is not None and len(value) > max_length:
+        return value[:max_length] + '…'
+    return value
@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import re
+import time
+import zlib
+
+import numpy as np
+
+# Words ignored when comparing questions, as they rarely change what is asked. Question words, modals,
+# tenses and persons do ("when" or "why", "did" or "will", "my" or "your"), they are never ignored
+STOP_WORDS = frozenset("""
+a an the is are be of to in into on for with about do does please that this it its there some tell give
+explain exactly like
+""".split())
+
+# Contracted question words, once the apostrophe is removed ("what's" is "what is")
+CONTRACTIONS = {'whats': 'what', 'hows': 'how', 'whos': 'who', 'wheres': 'where', 'whens': 'when', 'whys': 'why'}
+
+
+class SemanticCache:
+    """
+    A cache of answers looked up by similarity instead of equality, so that questions differing only in
+    wording share an answer. Questions are normalised to their content words (without case, punctuation,
+    stop words and plural s), embedded locally as hashed character n-gram vectors of these words, kept as the
+    columns of a NumPy matrix, and matched by cosine similarity.
+    Only questions with the same set of content words are compared, so that questions differing in a single word
+    or number ("12 times 13" and "12 times 14") are never answered alike. The similarity then tells apart
+    questions using the same words in a different order ("100 USD to EUR" and "100 EUR to USD").
+    The candidates are found with a vectorised comparison of the word-set hashes of all entries, so that only
+    a few columns of the matrix are read per lookup.
+    Entries are only compared within the same namespace (e.g. the same model and system prompt).
+    When the cache is full, the oldest entries are overwritten.
+    """
+
+    def __init__(self, max_size: int = 10000, threshold: float = 0.9, dimensions: int = 512,
+                 ngram_sizes: tuple = (3, 4), ttl: float | None = None):
+        """
+        Initializes the cache.
+        :param max_size: Maximum number of entries
+        :param threshold: Minimum cosine similarity of a hit, between 0 and 1
+        :param dimensions: Size of the question vectors
+        :param ngram_sizes: Lengths of the character n-grams hashed into the vectors
+        :param ttl: Time-to-live of an entry in seconds, None for no expiration
+        """
+        self.max_size = max_size
+        self.threshold = threshold
+        self.dimensions = dimensions
+        self.ngram_sizes = ngram_sizes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.false_positives = 0
+        self.size = 0
+        self.next_entry = 0
+        # Incremented on every set, so that an entry of a hit can be told apart from a newer one in its slot
+        self.generation = 0
+        # One column per entry, grown on demand up to max_size columns so that a small cache stays small
+        capacity = min(max_size, 1024)
+        self.vectors = np.zeros((dimensions, capacity), dtype=np.float32)
+        self.namespaces = np.zeros(capacity, dtype=np.int64)
+        self.word_sets = np.zeros(capacity, dtype=np.int64)
+        self.generations = np.zeros(capacity, dtype=np.int64)
+        self.expires_at = np.zeros(capacity, dtype=np.float64)
+        self.answers: list = [None] * capacity
+
+    @staticmethod
+    def get_words(text: str) -> list:
+        """
+        Returns the content words of a text: casefolded, without punctuation, stop words and plural s
+        """
+        words = []
+        for word in re.findall(r'[^\W_]+', text.casefold().replace("'", '').replace('\u2019', '')):
+            word = CONTRACTIONS.get(word, word)
+            if word in STOP_WORDS:
+                continue
+            if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+                word = word[:-1]
+            words.append(word)
+        return words
+
+    def embed(self, text: str) -> np.ndarray:
+        """
+        Returns the L2-normalised hashed character n-gram vector of the content words of a text
+        """
+        text = f" {' '.join(self.get_words(text))} "
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for size in self.ngram_sizes:
+            for i in range(len(text) - size + 1):
+                digest = zlib.crc32(text[i:i + size].encode())
+                # The highest bit picks a sign, so that colliding n-grams tend to cancel out instead of adding up
+                vector[digest % self.dimensions] += 1.0 if digest & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def get(self, namespace: str, text: str) -> tuple | None:
+        """
+        Looks up the answer to the most similar cached question of the namespace.
+        :return: An (entry, answer) tuple on a hit, where entry identifies the cache entry (its slot and
+                 generation), or None on a miss
+        """
+        vector = self.embed(text)
+        dimensions = np.flatnonzero(vector)
+        if self.size > 0 and len(dimensions) > 0:
+            candidates = np.flatnonzero(
+                (self.word_sets[:self.size] == self.__hash_words(text)) &
+                (self.namespaces[:self.size] == self.__hash_namespace(namespace)) &
+                ((self.expires_at[:self.size] == 0) | (self.expires_at[:self.size] > time.monotonic())))
+            if len(candidates) > 0:
+                similarities = vector[dimensions] @ self.vectors[np.ix_(dimensions, candidates)]
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    slot = int(candidates[best])
+                    self.hits += 1
+                    return (slot, int(self.generations[slot])), self.answers[slot]
+        self.misses += 1
+        return None
+
+    def set(self, namespace: str, text: str, answer: str):
+        """
+        Caches the answer to a question, overwriting the oldest entry if the cache is full
+        """
+        if self.max_size <= 0:
+            return
+        if self.next_entry >= len(self.answers) and len(self.answers) < self.max_size:
+            self.__grow()
+        entry = self.next_entry % self.max_size
+        self.vectors[:, entry] = self.embed(text)
+        self.namespaces[entry] = self.__hash_namespace(namespace)
+        self.word_sets[entry] = self.__hash_words(text)
+        self.generation += 1
+        self.generations[entry] = self.generation
+        self.expires_at[entry] = time.monotonic() + self.ttl if self.ttl is not None else 0
+        self.answers[entry] = answer
+        self.next_entry = entry + 1
+        self.size = max(self.size, entry + 1)
+
+    def report_false_positive(self, entry: tuple):
+        """
+        Records that the answer of a hit did not match the question, and removes the entry,
+        unless a newer answer has overwritten it since the hit
+        """
+        self.false_positives += 1
+        slot, generation = entry
+        if self.generations[slot] != generation:
+            return
+        self.namespaces[slot] = 0
+        self.answers[slot] = None
+
+    def get_stats(self) -> dict:
+        """
+        Returns the cache counters, for tuning the similarity threshold
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'false_positives': self.false_positives,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+    def __grow(self):
+        entries = min(self.max_size, len(self.answers) * 2) - len(self.answers)
+        self.vectors = np.hstack((self.vectors, np.zeros((self.dimensions, entries), dtype=np.float32)))
+        self.namespaces = np.concatenate((self.namespaces, np.zeros(entries, dtype=np.int64)))
+        self.word_sets = np.concatenate((self.word_sets, np.zeros(entries, dtype=np.int64)))
+        self.generations = np.concatenate((self.generations, np.zeros(entries, dtype=np.int64)))
+        self.expires_at = np.concatenate((self.expires_at, np.zeros(entries, dtype=np.float64)))
+        self.answers.extend([None] * entries)
+
+    def __hash_words(self, text: str) -> int:
+        return zlib.crc32(' '.join(sorted(set(self.get_words(text)))).encode())
+
+    @staticmethod
+    def __hash_namespace(namespace: str) -> int:
+        # Never 0, which marks unused entries
+        return zlib.crc32(namespace.encode()) + 1
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import re
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+class SpecCompiler:
+    """
+    Compiles the function specs returned by plugins into the smaller form sent to the model on every request:
+    descriptions are normalised and trimmed, `default` values (applied by the plugins themselves) are removed,
+    enums above a size limit are dropped and identical enums are shared between specs.
+    """
+
+    def __init__(self, max_description_length: int = 0, max_enum_size: int = 0):
+        """
+        Initializes the compiler.
+        :param max_description_length: Maximum number of characters of a description, 0 for no limit
+        :param max_enum_size: Maximum number of values of an enum, larger enums are removed. 0 for no limit
+        """
+        self.max_description_length = max_description_length
+        self.max_enum_size = max_enum_size
+        self.shared_enums: dict[tuple, list] = {}
+
+    def compile(self, spec: dict) -> dict:
+        """
+        Returns a compiled copy of the spec, the original spec is left untouched
+        """
+        return self.__compile_schema(spec)
+
+    def __compile_schema(self, schema):
+        if isinstance(schema, list):
+            return [self.__compile_schema(item) for item in schema]
+        if not isinstance(schema, dict):
+            return schema
+
+        compiled = {}
+        for key, value in schema.items():
+            if key == 'default':
+                continue
+            if key == 'description' and isinstance(value, str):
+                compiled[key] = self.__compile_description(value)
+            elif key == 'enum' and isinstance(value, list):
+                if self.max_enum_size > 0 and len(value) > self.max_enum_size:
+                    continue
+                compiled[key] = self.shared_enums.setdefault(tuple(value), list(value))
+            elif key == 'properties' and isinstance(value, dict):
+                # Property names are not schema keywords, compile their schemas only
+                compiled[key] = {name: self.__compile_schema(property_schema)
+                                 for name, property_schema in value.items()}
+            else:
+                compiled[key] = self.__compile_schema(value)
+        return compiled
+
+    def __compile_description(self, description: str) -> str:
+        description = WHITESPACE_PATTERN.sub(' ', description).strip()
+        if self.max_description_length <= 0 or len(description) <= self.max_description_length:
+            return description
+        trimmed = description[:self.max_description_length].rsplit(' ', 1)[0]
+        return trimmed.rstrip(' ,;:.') + '…'
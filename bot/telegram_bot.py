@@ -1,9 +1,12 @@
 from __future__ import annotations
 
 import asyncio
+import inspect
 import logging
+import multiprocessing
 import os
 import io
+from collections import Counter
 
 from uuid import uuid4
 from telegram import BotCommandScopeAllGroupChats, Update, constants
@@ -11,17 +14,22 @@ from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResu
 from telegram import InputTextMessageContent, BotCommand
 from telegram.error import RetryAfter, TimedOut, BadRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, \
-    filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext
+    filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext, ChatMemberHandler
 
 from pydub import AudioSegment
 from PIL import Image
 
 from utils import is_group_chat, get_thread_id, message_text, wrap_with_indicator, split_into_chunks, \
     edit_message_with_retry, get_stream_cutoff_values, is_allowed, get_remaining_budget, is_admin, is_within_budget, \
+    get_budget_account, \
     get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler, is_direct_result, handle_direct_result, \
     cleanup_intermediate_files
+from budget_ledger import BudgetLedger
+from group_membership import GroupMemberships, MEMBER_STATUSES
 from openai_helper import OpenAIHelper, localized_text
-from usage_tracker import UsageTracker
+from ttl_cache import TTLCache, SingleFlight
+from usage_report import get_since_day, format_usage_report, REPORT_DAYS
+from usage_store import UsageStore
 
 
 class ChatGPTTelegramBot:
@@ -56,7 +64,13 @@ class ChatGPTTelegramBot:
         )] + self.commands
         self.disallowed_message = localized_text('disallowed', bot_language)
         self.budget_limit_message = localized_text('budget_limit', bot_language)
-        self.usage = {}
+        self.usage = UsageStore(config)
+        self.group_memberships = GroupMemberships(ttl=config['group_membership_cache_ttl'])
+        self.rejected_updates = Counter()  # {filter name: number of updates rejected by it}
+        self.budget_ledger = BudgetLedger()
+        # snapshot of the usage of all users, computed again once older than the time-to-live
+        self.usage_reports = TTLCache(max_size=1, ttl=config['usage_report_ttl'])
+        self.usage_report_flight = SingleFlight()
         self.last_message = {}
         self.inline_queries_cache = {}
 
@@ -82,7 +96,7 @@ class ChatGPTTelegramBot:
         """
         Returns token usage statistics for current day and month.
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, group_memberships=self.group_memberships):
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
                             f'is not allowed to request their usage statistics')
             await self.send_disallowed_message(update, context)
@@ -92,8 +106,7 @@ class ChatGPTTelegramBot:
                      f'requested their usage statistics')
 
         user_id = update.message.from_user.id
-        if user_id not in self.usage:
-            self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+        self.usage.get_tracker(user_id, update.message.from_user.name)
 
         tokens_today, tokens_month = self.usage[user_id].get_current_token_usage()
         images_today, images_month = self.usage[user_id].get_current_image_count()
@@ -180,15 +193,100 @@ class ChatGPTTelegramBot:
         #         f"{localized_text('stats_openai', bot_language)}"
         #         f"{self.openai.get_billing_current_month():.2f}"
         #     )
+        if is_admin(self.config, user_id):
+            text_budget += self.get_admin_stats_text()
 
         usage_text = text_current_conversation + text_today + text_month + text_budget
         await update.message.reply_text(usage_text, parse_mode=constants.ParseMode.MARKDOWN)
 
+    def get_admin_stats_text(self) -> str:
+        """
+        Returns runtime statistics about the bot caches, shown to admins in /stats
+        """
+        plugins_cache = self.openai.plugin_manager.get_cache_stats()
+        unavailable_plugins = self.openai.plugin_manager.get_unavailable_plugins()
+        specs_selection = self.openai.plugin_manager.get_selection_stats()
+        response_cache = self.openai.get_response_cache_stats()
+        response_cache_text = f"{response_cache['hits']} hits, {response_cache['misses']} misses " \
+                              f"({response_cache['hit_rate']:.0%}), {response_cache['size']} entries" \
+            if response_cache is not None else 'disabled'
+        semantic_cache = self.openai.get_semantic_cache_stats()
+        semantic_cache_text = f"{semantic_cache['hits']} hits, {semantic_cache['misses']} misses " \
+                              f"({semantic_cache['hit_rate']:.0%}), {semantic_cache['false_positives']} " \
+                              f"resent, {semantic_cache['size']} entries" \
+            if semantic_cache is not None else 'disabled'
+        usage_cache = self.usage.get_cache_stats()
+        group_memberships = self.group_memberships.get_stats()
+        rejected_updates = ', '.join(f'{name} {count}' for name, count in self.rejected_updates.most_common()) or '-'
+        budget_ledger = self.budget_ledger.get_stats()
+        return (
+            f"\n----------------------------\n"
+            f"*Admin*\n"
+            f"🔌 Plugins cache: {plugins_cache['hits']} hits, {plugins_cache['misses']} misses "
+            f"({plugins_cache['hit_rate']:.0%}), {plugins_cache['shared']} deduplicated, "
+            f"{plugins_cache['size']} entries\n"
+            f"🚧 Unavailable plugins: {', '.join(unavailable_plugins) if unavailable_plugins else '-'}\n"
+            f"✂️ Functions selection: {specs_selection['saved_tokens']} prompt tokens saved "
+            f"in {specs_selection['selections']} requests\n"
+            f"💬 Response cache: {response_cache_text}\n"
+            f"🧭 Semantic cache: {semantic_cache_text}\n"
+            f"🔗 OpenAI requests deduplicated: {self.openai.get_shared_requests_count()}\n"
+            f"📒 Usage trackers: {usage_cache['hits']} hits, {usage_cache['misses']} misses "
+            f"({usage_cache['hit_rate']:.0%}), {usage_cache['evictions']} evicted, "
+            f"{usage_cache['size']}/{usage_cache['max_size']} loaded\n"
+            f"👥 Group memberships: {group_memberships['hits']} cached, "
+            f"{group_memberships['api_calls']} Telegram API checks, {group_memberships['shared']} deduplicated\n"
+            f"🚦 Ignored updates: {rejected_updates}\n"
+            f"🧾 Budget reservations: {budget_ledger['reservations']} made, {budget_ledger['capped']} capped, "
+            f"{budget_ledger['rejected']} rejected, ${budget_ledger['reserved_cost']:.4f} in flight\n"
+        )
+
+    async def usage_all(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Returns the usage of all users to admins: top users by cost, cost per day and usage per kind.
+        """
+        if not is_admin(self.config, update.message.from_user.id):
+            logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
+                            f'is not allowed to request the usage of all users')
+            await self.send_disallowed_message(update, context)
+            return
+
+        logging.info(f'Admin {update.message.from_user.name} (id: {update.message.from_user.id}) '
+                     f'requested the usage of all users')
+        report = await self.get_usage_report()
+        await update.effective_message.reply_text(
+            message_thread_id=get_thread_id(update),
+            text=format_usage_report(report)
+        )
+
+    async def get_usage_report(self) -> dict:
+        """
+        Returns the cached snapshot of the usage of all users, or computes it in a background thread
+        if it is older than USAGE_REPORT_TTL. Concurrent requests share the same computation.
+        The worker processes summing the usage logs are spawned rather than forked: a fork of the bot
+        would copy the locks held by its other threads (usage writer, compaction, logging) and could deadlock.
+        """
+        report = self.usage_reports.get('all')
+        if report is None:
+            report = await self.usage_report_flight.do('all', lambda: asyncio.to_thread(
+                self.usage.get_report, self.config, get_since_day(REPORT_DAYS),
+                mp_context=multiprocessing.get_context('spawn')))
+            self.usage_reports.set('all', report)
+        return report
+
+    async def chat_member_update(self, update: Update, _: ContextTypes.DEFAULT_TYPE):
+        """
+        Updates the cached group membership of a user when Telegram reports a change
+        """
+        member = update.chat_member.new_chat_member
+        self.group_memberships.set_member(update.chat_member.chat.id, member.user.id,
+                                          member.status in MEMBER_STATUSES)
+
     async def resend(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Resend the last request
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, group_memberships=self.group_memberships):
             logging.warning(f'User {update.message.from_user.name}  (id: {update.message.from_user.id})'
                             f' is not allowed to resend the message')
             await self.send_disallowed_message(update, context)
@@ -209,6 +307,7 @@ class ChatGPTTelegramBot:
                      f'(id: {update.message.from_user.id})')
         with update.message._unfrozen() as message:
             message.text = self.last_message.pop(chat_id)
+        self.openai.report_unhelpful_cached_answer(chat_id=chat_id)
 
         await self.prompt(update=update, context=context)
 
@@ -216,7 +315,7 @@ class ChatGPTTelegramBot:
         """
         Resets the conversation.
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, group_memberships=self.group_memberships):
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
                             f'is not allowed to reset the conversation')
             await self.send_disallowed_message(update, context)
@@ -228,6 +327,7 @@ class ChatGPTTelegramBot:
         chat_id = update.effective_chat.id
         reset_content = message_text(update.message)
         self.openai.reset_chat_history(chat_id=chat_id, content=reset_content)
+        self.openai.clear_history_index(chat_id=chat_id)
         await update.effective_message.reply_text(
             message_thread_id=get_thread_id(update),
             text=localized_text('reset_done', self.config['bot_language'])
@@ -271,7 +371,7 @@ class ChatGPTTelegramBot:
                 user_id = update.message.from_user.id
                 self.usage[user_id].add_image_request(image_size, self.config['image_prices'])
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
+                if str(user_id) not in self.config['allowed_user_id_set'] and 'guests' in self.usage:
                     self.usage["guests"].add_image_request(image_size, self.config['image_prices'])
 
             except Exception as e:
@@ -317,7 +417,7 @@ class ChatGPTTelegramBot:
                 user_id = update.message.from_user.id
                 self.usage[user_id].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
+                if str(user_id) not in self.config['allowed_user_id_set'] and 'guests' in self.usage:
                     self.usage["guests"].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
 
             except Exception as e:
@@ -335,11 +435,11 @@ class ChatGPTTelegramBot:
         """
         Transcribe audio messages.
         """
-        if not self.config['enable_transcription'] or not await self.check_allowed_and_within_budget(update, context):
-            return
-
-        if is_group_chat(update) and self.config['ignore_group_transcriptions']:
-            logging.info(f'Transcription coming from group chat, ignoring...')
+        if not await self.filter_update(update, context, [
+            ('transcription disabled', lambda: self.config['enable_transcription']),
+            ('group transcriptions', lambda: not is_group_chat(update) or not self.config['ignore_group_transcriptions']),
+            ('access', lambda: self.check_allowed_and_within_budget(update, context)),
+        ]):
             return
 
         chat_id = update.effective_chat.id
@@ -382,8 +482,7 @@ class ChatGPTTelegramBot:
                 return
 
             user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+            self.usage.get_tracker(user_id, update.message.from_user.name)
 
             try:
                 transcript = await self.openai.transcribe(filename_mp3)
@@ -391,8 +490,7 @@ class ChatGPTTelegramBot:
                 transcription_price = self.config['transcription_price']
                 self.usage[user_id].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
 
-                allowed_user_ids = self.config['allowed_user_ids'].split(',')
-                if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+                if str(user_id) not in self.config['allowed_user_id_set'] and 'guests' in self.usage:
                     self.usage["guests"].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
 
                 # check if transcript starts with any of the prefixes
@@ -417,7 +515,7 @@ class ChatGPTTelegramBot:
                     response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=transcript)
 
                     self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
-                    if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+                    if str(user_id) not in self.config['allowed_user_id_set'] and 'guests' in self.usage:
                         self.usage["guests"].add_chat_tokens(total_tokens, self.config['token_price'])
 
                     # Split into chunks of 4096 characters (Telegram's message limit)
@@ -455,23 +553,19 @@ class ChatGPTTelegramBot:
         """
         Interpret image using vision model.
         """
-        if not self.config['enable_vision'] or not await self.check_allowed_and_within_budget(update, context):
-            return
-
         chat_id = update.effective_chat.id
         prompt = update.message.caption
+        trigger_keyword = self.config['group_trigger_keyword']
+
+        if not await self.filter_update(update, context, [
+            ('vision disabled', lambda: self.config['enable_vision']),
+            ('group vision', lambda: not is_group_chat(update) or not self.config['ignore_group_vision']),
+            ('trigger keyword', lambda: not is_group_chat(update) or (
+                prompt.lower().startswith(trigger_keyword.lower()) if prompt is not None else trigger_keyword == '')),
+            ('access', lambda: self.check_allowed_and_within_budget(update, context)),
+        ]):
+            return
 
-        if is_group_chat(update):
-            if self.config['ignore_group_vision']:
-                logging.info(f'Vision coming from group chat, ignoring...')
-                return
-            else:
-                trigger_keyword = self.config['group_trigger_keyword']
-                if (prompt is None and trigger_keyword != '') or \
-                   (prompt is not None and not prompt.lower().startswith(trigger_keyword.lower())):
-                    logging.info(f'Vision coming from group chat with wrong keyword, ignoring...')
-                    return
-        
         image = update.message.effective_attachment[-1]
         
 
@@ -515,8 +609,7 @@ class ChatGPTTelegramBot:
             
 
             user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+            self.usage.get_tracker(user_id, update.message.from_user.name)
 
             if self.config['stream']:
 
@@ -637,8 +730,7 @@ class ChatGPTTelegramBot:
             vision_token_price = self.config['vision_token_price']
             self.usage[user_id].add_vision_tokens(total_tokens, vision_token_price)
 
-            allowed_user_ids = self.config['allowed_user_ids'].split(',')
-            if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+            if str(user_id) not in self.config['allowed_user_id_set'] and 'guests' in self.usage:
                 self.usage["guests"].add_vision_tokens(total_tokens, vision_token_price)
 
         await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
@@ -647,10 +739,11 @@ class ChatGPTTelegramBot:
         """
         React to incoming messages and respond accordingly.
         """
-        if update.edited_message or not update.message or update.message.via_bot:
-            return
-
-        if not await self.check_allowed_and_within_budget(update, context):
+        if not await self.filter_update(update, context, [
+            ('update type', lambda: not update.edited_message and update.message and not update.message.via_bot),
+            ('trigger keyword', lambda: self.is_group_message_for_bot(update, context)),
+            ('access', lambda: self.check_allowed_and_within_budget(update, context)),
+        ]):
             return
 
         logging.info(
@@ -672,13 +765,18 @@ class ChatGPTTelegramBot:
                         update.message.reply_to_message.from_user.id != context.bot.id:
                     prompt = f'"{update.message.reply_to_message.text}" {prompt}'
             else:
-                if update.message.reply_to_message and update.message.reply_to_message.from_user.id == context.bot.id:
-                    logging.info('Message is a reply to the bot, allowing...')
-                else:
-                    logging.warning('Message does not start with trigger keyword, ignoring...')
-                    return
+                logging.info('Message is a reply to the bot, allowing...')
 
+        budget_account, reserved_cost = None, None
         try:
+            budget_account, reserved_cost, max_tokens, token_budget = self.reserve_chat_budget(update, chat_id, prompt)
+            if reserved_cost is None:
+                logging.warning(f'User {update.message.from_user.name} (id: {user_id}) reached their usage limit '
+                                f'with requests in flight')
+                self.rejected_updates['budget'] += 1
+                await self.send_budget_reached_message(update, context)
+                return
+
             total_tokens = 0
 
             if self.config['stream']:
@@ -687,7 +785,9 @@ class ChatGPTTelegramBot:
                     message_thread_id=get_thread_id(update)
                 )
 
-                stream_response = self.openai.get_chat_response_stream(chat_id=chat_id, query=prompt)
+                stream_response = self.openai.get_chat_response_stream(chat_id=chat_id, query=prompt,
+                                                                       max_tokens=max_tokens,
+                                                                       token_budget=token_budget)
                 i = 0
                 prev = ''
                 sent_message = None
@@ -767,7 +867,9 @@ class ChatGPTTelegramBot:
             else:
                 async def _reply():
                     nonlocal total_tokens
-                    response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=prompt)
+                    response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=prompt,
+                                                                                 max_tokens=max_tokens,
+                                                                                 token_budget=token_budget)
 
                     if is_direct_result(response):
                         return await handle_direct_result(self.config, update, response)
@@ -807,6 +909,37 @@ class ChatGPTTelegramBot:
                 text=f"{localized_text('chat_fail', self.config['bot_language'])} {str(e)}",
                 parse_mode=constants.ParseMode.MARKDOWN
             )
+        finally:
+            # The usage is recorded by now, it replaces the reservation in the remaining budget
+            if reserved_cost is not None:
+                self.budget_ledger.release(budget_account, reserved_cost)
+
+    def reserve_chat_budget(self, update: Update, chat_id: int, prompt: str) -> tuple:
+        """
+        Reserves the estimated cost of a chat request, from the token count of the prompt, function specs
+        included, and max_tokens, in the budget of the user. When the budget left is lower than the estimate,
+        the completion and the function call follow-ups are limited to the tokens that the reservation pays for.
+        :param update: Telegram update object
+        :param chat_id: The chat ID
+        :param prompt: The prompt of the request
+        :return: The budget account, the reserved cost (None if the budget is exhausted),
+                 the limit of the completion tokens and the number of tokens that the reservation pays for
+                 (both None if the estimate fits)
+        """
+        account, remaining_budget = get_budget_account(self.config, self.usage, update)
+        prompt_tokens = self.openai.count_prompt_tokens(chat_id, prompt)
+        token_price = self.config['token_price']
+        estimated_cost = (prompt_tokens + self.openai.config['max_tokens']) * token_price / 1000
+        # At least the prompt and a short answer must fit in the budget left
+        min_cost = (prompt_tokens + self.openai.config['min_max_tokens']) * token_price / 1000
+        reserved_cost = self.budget_ledger.reserve(account, remaining_budget, estimated_cost, min_cost=min_cost)
+        if reserved_cost is None:
+            return account, None, None, None
+        if remaining_budget == float('inf') or reserved_cost >= estimated_cost:
+            # The budget doesn't limit the request, nor the function calls that follow it
+            return account, reserved_cost, None, None
+        token_budget = int(reserved_cost * 1000 / token_price)
+        return account, reserved_cost, token_budget - prompt_tokens, token_budget
 
     async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -987,6 +1120,41 @@ class ChatGPTTelegramBot:
                                           text=f"{query}\n\n_{answer_tr}:_\n{localized_answer} {str(e)}",
                                           is_inline=True)
 
+    async def filter_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE, checks) -> bool:
+        """
+        Runs the checks deciding whether to handle an update in order, stopping at the first failing one.
+        Checks are ordered from the cheapest to the most expensive, so that the updates ignored anyway
+        don't cost authorization checks, and the checks rejecting an update are counted.
+        :param update: Telegram update object
+        :param context: Telegram context object
+        :param checks: list of (name, check) tuples, where check returns a boolean or an awaitable boolean
+        :return: Boolean indicating if the update passed all checks
+        """
+        for name, check in checks:
+            passed = check()
+            if inspect.isawaitable(passed):
+                passed = await passed
+            if not passed:
+                # the access check counts its own rejections
+                if name != 'access':
+                    self.rejected_updates[name] += 1
+                logging.debug(f'Update ignored by the {name} check')
+                return False
+        return True
+
+    def is_group_message_for_bot(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """
+        Checks if a message is addressed to the bot: any message of a private chat,
+        and the messages of a group chat starting with the trigger keyword or /chat, or replying to the bot
+        """
+        if not is_group_chat(update):
+            return True
+        trigger_keyword = self.config['group_trigger_keyword']
+        if message_text(update.message).lower().startswith(trigger_keyword.lower()) or \
+                update.message.text.lower().startswith('/chat'):
+            return True
+        return bool(update.message.reply_to_message and update.message.reply_to_message.from_user.id == context.bot.id)
+
     async def check_allowed_and_within_budget(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
                                               is_inline=False) -> bool:
         """
@@ -999,12 +1167,15 @@ class ChatGPTTelegramBot:
         name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
         user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
 
-        if not await is_allowed(self.config, update, context, is_inline=is_inline):
+        if not await is_allowed(self.config, update, context, is_inline=is_inline,
+                                group_memberships=self.group_memberships):
             logging.warning(f'User {name} (id: {user_id}) is not allowed to use the bot')
+            self.rejected_updates['not allowed'] += 1
             await self.send_disallowed_message(update, context, is_inline)
             return False
         if not is_within_budget(self.config, self.usage, update, is_inline=is_inline):
             logging.warning(f'User {name} (id: {user_id}) reached their usage limit')
+            self.rejected_updates['budget'] += 1
             await self.send_budget_reached_message(update, context, is_inline)
             return False
 
@@ -1044,6 +1215,13 @@ class ChatGPTTelegramBot:
         await application.bot.set_my_commands(self.group_commands, scope=BotCommandScopeAllGroupChats())
         await application.bot.set_my_commands(self.commands)
 
+    async def post_shutdown(self, _: Application) -> None:
+        """
+        Post shutdown hook for the bot.
+        """
+        await self.openai.plugin_manager.close()
+        self.usage.close()
+
     def run(self):
         """
         Runs the bot indefinitely until the user presses Ctrl+C
@@ -1053,6 +1231,7 @@ class ChatGPTTelegramBot:
             .proxy_url(self.config['proxy']) \
             .get_updates_proxy_url(self.config['proxy']) \
             .post_init(self.post_init) \
+            .post_shutdown(self.post_shutdown) \
             .concurrent_updates(True) \
             .build()
 
@@ -1063,6 +1242,7 @@ class ChatGPTTelegramBot:
         application.add_handler(CommandHandler('start', self.help))
         application.add_handler(CommandHandler('stats', self.stats))
         application.add_handler(CommandHandler('resend', self.resend))
+        application.add_handler(CommandHandler('usage_all', self.usage_all))
         application.add_handler(CommandHandler(
             'chat', self.prompt, filters=filters.ChatType.GROUP | filters.ChatType.SUPERGROUP)
         )
@@ -1078,7 +1258,9 @@ class ChatGPTTelegramBot:
             constants.ChatType.GROUP, constants.ChatType.SUPERGROUP, constants.ChatType.PRIVATE
         ]))
         application.add_handler(CallbackQueryHandler(self.handle_callback_inline_query))
+        application.add_handler(ChatMemberHandler(self.chat_member_update, ChatMemberHandler.CHAT_MEMBER))
 
         application.add_error_handler(error_handler)
 
-        application.run_polling()
+        # chat_member updates are only sent when requested explicitly
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    A size-bounded LRU cache whose entries expire after a time-to-live.
+    Keeps hit, miss and eviction counters so that the hit rate can be monitored.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float | None = None, on_evict=None):
+        """
+        Initializes the cache.
+        :param max_size: Maximum number of entries, the least recently used entry is evicted when exceeded
+        :param ttl: Default time-to-live of an entry in seconds, None for no expiration
+        :param on_evict: Function called with the key and value of every entry evicted because the cache is full
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()  # {key: (expires_at, value)}
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for the given key and marks it as recently used,
+        or the default value if the key is missing or expired
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float | None = None):
+        """
+        Caches a value, evicting the least recently used entries if the cache is full.
+        :param ttl: Time-to-live in seconds, defaults to the cache ttl
+        """
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            evicted_key, (_, evicted_value) = self._entries.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(evicted_key, evicted_value)
+
+    def peek(self, key, default=None):
+        """
+        Returns the value cached for the given key, without marking it as recently used or counting a lookup
+        """
+        entry = self._entries.get(key)
+        return default if entry is None else entry[1]
+
+    def pop(self, key, default=None):
+        """
+        Removes a key from the cache and returns its value
+        """
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and (entry[0] is None or entry[0] > time.monotonic())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the cache counters and the hit rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+
+class CallCancelledError(Exception):
+    """
+    Raised to the callers waiting for a shared call when the call was cancelled
+    """
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls: while a call for a key is in flight,
+    callers with the same key wait for its result instead of starting a new one.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls: dict = {}  # {key: asyncio.Future}
+        self._streams: dict = {}  # {key: SharedStream}
+
+    def is_in_flight(self, key) -> bool:
+        return key in self._calls or key in self._streams
+
+    async def do(self, key, coroutine_function):
+        """
+        Runs the coroutine function for the key, or waits for the call already in flight for it.
+        :param key: The deduplication key
+        :param coroutine_function: A function returning the awaitable to run
+        :return: The result of the call, shared between all callers
+        """
+        if key in self._calls:
+            self.shared += 1
+            try:
+                # Shield the shared call, so that a cancelled waiter doesn't cancel it for everyone else
+                return await asyncio.shield(self._calls[key])
+            except CallCancelledError:
+                # The caller running the call was cancelled: the first waiter runs it again, the others join it
+                self.shared -= 1
+                return await self.do(key, coroutine_function)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await coroutine_function()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            # Cancelling the future would cancel the waiters, which were not cancelled themselves
+            future.set_exception(CallCancelledError())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved, waiters (if any) will get it as well
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
+
+    async def stream(self, key, coroutine_function) -> SharedStream:
+        """
+        Like do, for calls returning an async iterator: while the call for a key is streaming,
+        callers with the same key get a replay of its items, including the ones received before they joined.
+        :param key: The deduplication key
+        :param coroutine_function: A function returning the awaitable creating the async iterator
+        :return: An async iterable over the items of the shared call
+        """
+        shared = self._streams.get(key)
+        if shared is not None:
+            self.shared += 1
+        else:
+            shared = SharedStream(coroutine_function)
+            self._streams[key] = shared
+
+            def _remove(_):
+                if self._streams.get(key) is shared:
+                    del self._streams[key]
+            shared.task.add_done_callback(_remove)
+        await shared.wait_started()
+        return shared
+
+
+class SharedStream:
+    """
+    Consumes an async iterator once, in a background task, and replays its items to any number of consumers.
+    Every iteration starts from the first item and follows the upstream iterator as new items arrive.
+    """
+
+    def __init__(self, coroutine_function):
+        """
+        Starts consuming the iterator.
+        :param coroutine_function: A function returning the awaitable creating the async iterator
+        """
+        self.items = []
+        self.done = False
+        self.error = None
+        self._started = asyncio.get_running_loop().create_future()
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self.__consume(coroutine_function))
+
+    async def wait_started(self):
+        """
+        Waits until the upstream iterator is created, raising the error if its creation failed
+        """
+        await asyncio.shield(self._started)
+
+    async def __consume(self, coroutine_function):
+        try:
+            iterator = await coroutine_function()
+            self._started.set_result(True)
+            async for item in iterator:
+                self.items.append(item)
+                self.__notify()
+        except asyncio.CancelledError:
+            # Ends the consumers with an error rather than a cancellation of their own tasks or a truncated stream
+            self.__fail(CallCancelledError('The shared stream was cancelled'))
+            raise
+        except Exception as e:
+            self.__fail(e)
+        finally:
+            self.done = True
+            self.__notify()
+
+    def __fail(self, error: Exception):
+        if not self._started.done():
+            self._started.set_exception(error)
+            # Mark the exception as retrieved, waiters (if any) will get it as well
+            self._started.exception()
+        self.error = error
+
+    def __notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def __aiter__(self):
+        position = 0
+        while True:
+            if position < len(self.items):
+                position += 1
+                yield self.items[position - 1]
+            elif self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                await self._changed.wait()
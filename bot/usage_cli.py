@@ -0,0 +1,216 @@
+"""
+Maintenance commands for the usage logs.
+
+Usage: python bot/usage_cli.py migrate [--logs-dir usage_logs] [--db-file usage.db]
+       python bot/usage_cli.py compact [--logs-dir usage_logs] [--keep-days 90]
+       python bot/usage_cli.py report [--backend json] [--logs-dir usage_logs] [--db-file usage.db]
+                                      [--top 10] [--days 14] [--workers 4]
+       python bot/usage_cli.py export [--backend json] [--logs-dir usage_logs] [--db-file usage.db]
+                                      [--output usage.csv] [--parquet usage.parquet] [--workers 4]
+
+migrate: imports the JSON usage logs into the SQLite usage ledger used with USAGE_BACKEND=sqlite.
+Imported users are recorded in the ledger and skipped next time, so the command can be run again safely.
+Users who already used the bot with USAGE_BACKEND=sqlite get their JSON usage history added to their new usage.
+
+compact: folds the days of the JSON usage logs older than --keep-days into monthly totals.
+The bot does the same in the background when USAGE_HISTORY_DAYS is set, run this command while the bot is stopped.
+
+report: prints the usage of all users, like the /usage_all admin command: the users with the highest cost,
+the cost per day of the last --days days, and the quantity and cost per kind of usage.
+The JSON usage logs are read by --workers processes, defaulting to the number of CPUs.
+
+export: writes the usage history of all users as a CSV file with one row per user, date and kind, and the columns
+user, date, kind, quantity and cost, for billing or analysis. With --parquet, also writes it as a Parquet file,
+which requires pyarrow (pip install pyarrow). The usage is streamed in batches, so memory use doesn't grow
+with the number of users. Monthly totals of compacted logs are dated on the first day of the month, and
+the cost_adjustment rows dated 0001-01-01 make the cost of each user add up to their recorded all-time cost.
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import importlib.util
+import json
+import os
+import time
+from datetime import date
+
+from dotenv import load_dotenv
+
+from usage_ledger import UsageLedger
+from usage_report import usage_to_events, get_since_day, format_usage_report, iter_usage_log_events, \
+    TOP_USERS, REPORT_DAYS
+from usage_store import UsageStore, USAGE_BACKENDS
+
+
+EXPORT_COLUMNS = ['user', 'date', 'kind', 'quantity', 'cost']
+
+
+def get_prices() -> dict:
+    return {
+        'token_price': float(os.environ.get('TOKEN_PRICE', 0.002)),
+        'image_prices': [float(i) for i in os.environ.get('IMAGE_PRICES', "0.016,0.018,0.02").split(",")],
+        'vision_token_price': float(os.environ.get('VISION_TOKEN_PRICE', '0.01')),
+        'tts_prices': [float(i) for i in os.environ.get('TTS_PRICES', "0.015,0.030").split(",")],
+        'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
+    }
+
+
+def migrate(args):
+    prices = get_prices()
+    ledger = UsageLedger(args.db_file)
+    migrated_users = ledger.get_migrated_user_ids()
+    started = time.perf_counter()
+    users = skipped = events_count = 0
+    for file_name in sorted(os.listdir(args.logs_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        user_id = file_name[:-len('.json')]
+        if user_id in migrated_users:
+            skipped += 1
+            continue
+        with open(os.path.join(args.logs_dir, file_name), 'r') as file:
+            usage = json.load(file)
+        events = usage_to_events(user_id, usage, prices)
+        ledger.import_user(user_id, usage['user_name'], events)
+        users += 1
+        events_count += len(events)
+    ledger.close()
+    print(f'Imported {events_count} events of {users} users into {args.db_file} '
+          f'in {time.perf_counter() - started:.2f}s, {skipped} users already imported')
+
+
+def compact(args):
+    store = UsageStore({'usage_logs_dir': args.logs_dir})
+    report = store.compact(args.keep_days)
+    store.close()
+    print(f'Folded {report["folded_days"]} days older than {args.keep_days} days into monthly totals '
+          f'in {report["files"]} files')
+    print(f'Size: {report["bytes_before"]} -> {report["bytes_after"]} bytes')
+    print(f'Load time: {report["load_seconds_before"]:.3f}s -> {report["load_seconds_after"]:.3f}s')
+
+
+def report(args):
+    config = {'usage_backend': args.backend, 'usage_logs_dir': args.logs_dir, 'usage_db_file': args.db_file}
+    store = UsageStore(config)
+    usage_report = store.get_report(get_prices(), get_since_day(args.days), workers=args.workers)
+    store.close()
+    print(format_usage_report(usage_report, top_n=args.top, days=args.days))
+
+
+def export(args):
+    if args.parquet and importlib.util.find_spec('pyarrow') is None:
+        print('Exporting to Parquet requires pyarrow, install it with: pip install pyarrow')
+        exit(1)
+    if args.backend == 'sqlite':
+        ledger = UsageLedger(args.db_file)
+        batches = ledger.iter_events()
+    else:
+        ledger = None
+        batches = iter_usage_log_events(args.logs_dir, get_prices(), workers=args.workers)
+
+    started = time.perf_counter()
+    rows = 0
+    users = set()
+    parquet_writer = open_parquet_writer(args.parquet) if args.parquet else None
+    try:
+        with open(args.output, 'w', newline='') as file:
+            csv_writer = csv.writer(file)
+            csv_writer.writerow(EXPORT_COLUMNS)
+            for batch in batches:
+                # users without recorded usage yet have no events
+                if not batch:
+                    continue
+                csv_writer.writerows(batch)
+                if parquet_writer is not None:
+                    write_parquet_batch(parquet_writer, batch)
+                rows += len(batch)
+                users.update(event[0] for event in batch)
+        if parquet_writer is not None:
+            parquet_writer.close()
+    except BaseException:
+        # don't leave a truncated export behind
+        if parquet_writer is not None:
+            parquet_writer.close()
+            os.remove(args.parquet)
+        if os.path.exists(args.output):
+            os.remove(args.output)
+        raise
+    finally:
+        if ledger is not None:
+            ledger.close()
+
+    seconds = time.perf_counter() - started
+    outputs = f'{args.output} and {args.parquet}' if args.parquet else args.output
+    print(f'Exported {rows} rows of {len(users)} users to {outputs} in {seconds:.2f}s')
+    print(f'Throughput: {rows / seconds:.0f} rows/s, {len(users) / seconds:.0f} users/s')
+
+
+def open_parquet_writer(parquet_file: str):
+    """
+    Creates the Parquet file of the export, with the schema of the export columns
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([('user', pa.string()), ('date', pa.date32()), ('kind', pa.string()),
+                        ('quantity', pa.float64()), ('cost', pa.float64())])
+    return pq.ParquetWriter(parquet_file, schema)
+
+
+def write_parquet_batch(parquet_writer, batch: list):
+    """
+    Appends a batch of usage rows to the Parquet file as a row group
+    """
+    import pyarrow as pa
+
+    parquet_writer.write_table(pa.table({
+        'user': [str(event[0]) for event in batch],
+        'date': [date.fromisoformat(event[1]) for event in batch],
+        'kind': [event[2] for event in batch],
+        'quantity': [float(event[3]) for event in batch],
+        'cost': [float(event[4]) for event in batch],
+    }, schema=parquet_writer.schema))
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Maintenance commands for the usage logs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='import the JSON usage logs into the SQLite usage ledger')
+    migrate_parser.add_argument('--logs-dir', default='usage_logs')
+    migrate_parser.add_argument('--db-file', default=os.environ.get('USAGE_DB_FILE', 'usage.db'))
+    migrate_parser.set_defaults(func=migrate)
+
+    compact_parser = subparsers.add_parser('compact', help='fold old days of the JSON usage logs into monthly totals')
+    compact_parser.add_argument('--logs-dir', default='usage_logs')
+    compact_parser.add_argument('--keep-days', type=int, default=int(os.environ.get('USAGE_HISTORY_DAYS', 0) or 90))
+    compact_parser.set_defaults(func=compact)
+
+    report_parser = subparsers.add_parser('report', help='print the usage of all users')
+    report_parser.add_argument('--backend', choices=USAGE_BACKENDS,
+                               default=os.environ.get('USAGE_BACKEND', 'json').lower())
+    report_parser.add_argument('--logs-dir', default='usage_logs')
+    report_parser.add_argument('--db-file', default=os.environ.get('USAGE_DB_FILE', 'usage.db'))
+    report_parser.add_argument('--top', type=int, default=TOP_USERS)
+    report_parser.add_argument('--days', type=int, default=REPORT_DAYS)
+    report_parser.add_argument('--workers', type=int, default=None)
+    report_parser.set_defaults(func=report)
+
+    export_parser = subparsers.add_parser('export', help='export the usage history of all users to CSV and Parquet')
+    export_parser.add_argument('--backend', choices=USAGE_BACKENDS,
+                               default=os.environ.get('USAGE_BACKEND', 'json').lower())
+    export_parser.add_argument('--logs-dir', default='usage_logs')
+    export_parser.add_argument('--db-file', default=os.environ.get('USAGE_DB_FILE', 'usage.db'))
+    export_parser.add_argument('--output', default='usage.csv', help='path of the CSV file')
+    export_parser.add_argument('--parquet', default=None, help='path of the Parquet file, not written by default')
+    export_parser.add_argument('--workers', type=int, default=None)
+    export_parser.set_defaults(func=export)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+from datetime import date
+
+IMAGE_SIZES = ["256x256", "512x512", "1024x1024"]
+TTS_MODELS = ['tts-1', 'tts-1-hd']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    user_name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usage_events (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    quantity REAL NOT NULL,
+    cost REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS usage_events_user_day_kind ON usage_events (user_id, day, kind);
+CREATE TABLE IF NOT EXISTS migrated_users (
+    user_id TEXT PRIMARY KEY,
+    migrated_at TEXT NOT NULL
+);
+"""
+
+
+def image_kind(image_size):
+    return f"number_images:{image_size}"
+
+
+def tts_kind(tts_model):
+    return f"tts_characters:{tts_model}"
+
+
+class UsageLedger:
+    """
+    Usage storage in a single SQLite database, as an append-only table of usage events
+    (user, day, kind, quantity, cost) indexed by user, day and kind.
+    Day, month and all-time totals are computed with indexed queries instead of loading whole usage files.
+    The database uses write-ahead logging, so that reads don't wait for the background writes.
+    """
+
+    def __init__(self, db_file="usage.db"):
+        """
+        Opens the database, creating it if needed.
+        :param db_file: path to the database file, defaults to "usage.db"
+        """
+        self.db_file = db_file
+        # The connection is shared between the event loop and the writer thread, serialised by the lock
+        self.connection = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+
+    def set_user_name(self, user_id, user_name):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO users (user_id, user_name) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET user_name = excluded.user_name",
+                (str(user_id), user_name))
+
+    def add_events(self, events):
+        """
+        Appends usage events in a single transaction.
+        :param events: iterable of (user_id, day, kind, quantity, cost) tuples
+        """
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(
+                    "INSERT INTO usage_events (user_id, day, kind, quantity, cost) VALUES (?, ?, ?, ?, ?)",
+                    ((str(user_id), str(day), kind, quantity, cost)
+                     for user_id, day, kind, quantity, cost in events))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def import_user(self, user_id, user_name, events):
+        """
+        Imports the usage history of a user from a JSON usage log, and records the import
+        in the same transaction, so that a user is imported exactly once.
+        :param events: iterable of (user_id, day, kind, quantity, cost) tuples
+        """
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.execute(
+                    "INSERT INTO users (user_id, user_name) VALUES (?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET user_name = excluded.user_name",
+                    (str(user_id), user_name))
+                self.connection.executemany(
+                    "INSERT INTO usage_events (user_id, day, kind, quantity, cost) VALUES (?, ?, ?, ?, ?)",
+                    ((str(user_id), str(day), kind, quantity, cost)
+                     for user_id, day, kind, quantity, cost in events))
+                self.connection.execute(
+                    "INSERT INTO migrated_users (user_id, migrated_at) VALUES (?, ?)",
+                    (str(user_id), str(date.today())))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def get_migrated_user_ids(self) -> set:
+        """
+        Returns the IDs of the users whose JSON usage log was imported.
+        Imports made before they were recorded are recognised by their cost adjustment events,
+        which only the import creates.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT user_id FROM migrated_users "
+                "UNION SELECT DISTINCT user_id FROM usage_events WHERE kind = 'cost_adjustment'").fetchall()
+        return {row[0] for row in rows}
+
+    def get_quantities(self, user_id, kinds, since_day, until_day=None) -> dict:
+        """
+        Sums the quantities of a user per kind over a range of days.
+        :param user_id: Telegram ID of the user
+        :param kinds: the usage kinds to sum
+        :param since_day: first day of the range, as an ISO date string
+        :param until_day: last day of the range, defaults to today
+        :return: dictionary of kind to total quantity, kinds without usage are omitted
+        """
+        until_day = until_day or str(date.today())
+        placeholders = ",".join("?" * len(kinds))
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT kind, SUM(quantity) FROM usage_events "
+                f"WHERE user_id = ? AND day BETWEEN ? AND ? AND kind IN ({placeholders}) GROUP BY kind",
+                (str(user_id), str(since_day), until_day, *kinds)).fetchall()
+        return dict(rows)
+
+    def get_cost(self, user_id, since_day=None) -> float:
+        """
+        Sums the cost of the usage of a user since a day, or of all usage
+        """
+        with self.lock:
+            if since_day is None:
+                row = self.connection.execute(
+                    "SELECT SUM(cost) FROM usage_events WHERE user_id = ?", (str(user_id),)).fetchone()
+            else:
+                row = self.connection.execute(
+                    "SELECT SUM(cost) FROM usage_events WHERE user_id = ? AND day >= ?",
+                    (str(user_id), str(since_day))).fetchone()
+        return row[0] or 0.0
+
+    def get_totals(self, since_day) -> dict:
+        """
+        Sums the usage of all users, in the format of usage_report.new_totals.
+        Runs on its own connection, so that the queries of the bot don't wait for it.
+        :param since_day: first day of the daily totals, as an ISO date string
+        """
+        connection = sqlite3.connect(self.db_file)
+        try:
+            users = dict(connection.execute("SELECT user_id, SUM(cost) FROM usage_events GROUP BY user_id"))
+            user_names = dict(connection.execute("SELECT user_id, user_name FROM users"))
+            days = dict(connection.execute(
+                "SELECT day, SUM(cost) FROM usage_events WHERE day >= ? GROUP BY day", (str(since_day),)))
+            kinds = {kind: [quantity, cost] for kind, quantity, cost in connection.execute(
+                "SELECT kind, SUM(quantity), SUM(cost) FROM usage_events GROUP BY kind")}
+        finally:
+            connection.close()
+        return {'users': users, 'user_names': user_names, 'days': days, 'kinds': kinds,
+                'files': len(users), 'errors': 0}
+
+    def iter_events(self, batch_size=10000):
+        """
+        Yields the usage per user, day and kind, summing the events of the same day, in batches.
+        Rows are read in the order of the index as they are written out, on a separate connection.
+        :param batch_size: number of rows per batch
+        :return: generator of lists of (user_id, day, kind, quantity, cost) tuples
+        """
+        connection = sqlite3.connect(self.db_file)
+        try:
+            cursor = connection.execute(
+                "SELECT user_id, day, kind, SUM(quantity), SUM(cost) FROM usage_events "
+                "GROUP BY user_id, day, kind ORDER BY user_id, day, kind")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            connection.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class SQLiteUsageTracker:
+    """
+    UsageTracker storing the usage of a user in a UsageLedger.
+    Has the same interface as UsageTracker: new usage is buffered in memory and written by the
+    UsageWriter, the getters query the ledger and add the usage not written yet.
+    """
+
+    def __init__(self, user_id, user_name, ledger: UsageLedger, writer=None):
+        """
+        Initializes the tracker of a user.
+        :param user_id: Telegram ID of the user
+        :param user_name: Telegram user name
+        :param ledger: the UsageLedger shared by all trackers
+        :param writer: UsageWriter saving the changes in the background, defaults to saving on every change
+        """
+        self.user_id = user_id
+        self.ledger = ledger
+        self.writer = writer
+        self.lock = threading.RLock()
+        self.pending_events = []  # [(user_id, day, kind, quantity, cost)]
+        ledger.set_user_name(user_id, user_name)
+
+    def add_chat_tokens(self, tokens, tokens_price=0.002):
+        """Adds used tokens from a request to a users usage history
+        :param tokens: total tokens used in last request
+        :param tokens_price: price per 1000 tokens, defaults to 0.002
+        """
+        self.__add_event("chat_tokens", tokens, round(float(tokens) * tokens_price / 1000, 6))
+
+    def get_current_token_usage(self):
+        """Get token amounts used for today and this month
+
+        :return: total number of tokens used per day and per month
+        """
+        day, month = self.__get_current_quantities(["chat_tokens"])
+        return int(day), int(month)
+
+    def add_image_request(self, image_size, image_prices="0.016,0.018,0.02"):
+        """Add image request to users usage history
+
+        :param image_size: requested image size
+        :param image_prices: prices for images of sizes ["256x256", "512x512", "1024x1024"],
+                             defaults to [0.016, 0.018, 0.02]
+        """
+        image_cost = image_prices[IMAGE_SIZES.index(image_size)]
+        self.__add_event(image_kind(image_size), 1, image_cost)
+
+    def get_current_image_count(self):
+        """Get number of images requested for today and this month.
+
+        :return: total number of images requested per day and per month
+        """
+        day, month = self.__get_current_quantities([image_kind(size) for size in IMAGE_SIZES])
+        return int(day), int(month)
+
+    def add_vision_tokens(self, tokens, vision_token_price=0.01):
+        """
+        Adds requested vision tokens to a users usage history
+        :param tokens: total tokens used in last request
+        :param vision_token_price: price per 1K tokens, defaults to 0.01
+        """
+        self.__add_event("vision_tokens", tokens, round(tokens * vision_token_price / 1000, 2))
+
+    def get_current_vision_tokens(self):
+        """Get vision tokens for today and this month.
+
+        :return: total amount of vision tokens per day and per month
+        """
+        day, month = self.__get_current_quantities(["vision_tokens"])
+        return int(day), int(month)
+
+    def add_tts_request(self, text_length, tts_model, tts_prices):
+        price = tts_prices[TTS_MODELS.index(tts_model)]
+        self.__add_event(tts_kind(tts_model), text_length, round(text_length * price / 1000, 2))
+
+    def get_current_tts_usage(self):
+        """Get length of speech generated for today and this month.
+
+        :return: total amount of characters converted to speech per day and per month
+        """
+        day, month = self.__get_current_quantities([tts_kind(model) for model in TTS_MODELS])
+        return int(day), int(month)
+
+    def add_transcription_seconds(self, seconds, minute_price=0.006):
+        """Adds requested transcription seconds to a users usage history
+        :param seconds: total seconds used in last request
+        :param minute_price: price per minute transcription, defaults to 0.006
+        """
+        self.__add_event("transcription_seconds", seconds, round(seconds * minute_price / 60, 2))
+
+    def get_current_transcription_duration(self):
+        """Get minutes and seconds of audio transcribed for today and this month.
+
+        :return: total amount of time transcribed per day and per month (4 values)
+        """
+        seconds_day, seconds_month = self.__get_current_quantities(["transcription_seconds"])
+        minutes_day, seconds_day = divmod(seconds_day, 60)
+        minutes_month, seconds_month = divmod(seconds_month, 60)
+        return int(minutes_day), round(seconds_day, 2), int(minutes_month), round(seconds_month, 2)
+
+    def get_current_cost(self):
+        """Get total USD amount of all requests of the current day and month
+
+        :return: cost of current day and month
+        """
+        today = date.today()
+        month_start = today.replace(day=1)
+        with self.lock:
+            pending_events = list(self.pending_events)
+        cost_day = self.ledger.get_cost(self.user_id, today) + \
+            sum(cost for _, day, _, _, cost in pending_events if day == str(today))
+        cost_month = self.ledger.get_cost(self.user_id, month_start) + \
+            sum(cost for _, day, _, _, cost in pending_events if day >= str(month_start))
+        cost_all_time = self.ledger.get_cost(self.user_id) + sum(event[4] for event in pending_events)
+        return {"cost_today": cost_day, "cost_month": cost_month, "cost_all_time": cost_all_time}
+
+    def save(self):
+        """
+        Writes the buffered usage events to the ledger
+        """
+        with self.lock:
+            events, self.pending_events = self.pending_events, []
+        try:
+            self.ledger.add_events(events)
+        except Exception:
+            with self.lock:
+                self.pending_events = events + self.pending_events
+            raise
+
+    def __add_event(self, kind, quantity, cost):
+        with self.lock:
+            self.pending_events.append((self.user_id, str(date.today()), kind, quantity, cost))
+        if self.writer is None:
+            self.save()
+        else:
+            self.writer.mark_dirty(self)
+
+    def __get_current_quantities(self, kinds) -> tuple:
+        """
+        Returns the total quantity of the given kinds for today and this month
+        """
+        today = str(date.today())
+        month_start = str(date.today().replace(day=1))
+        with self.lock:
+            pending_events = list(self.pending_events)
+        quantities_day = self.ledger.get_quantities(self.user_id, kinds, today)
+        quantities_month = self.ledger.get_quantities(self.user_id, kinds, month_start)
+        day = sum(quantities_day.values()) + \
+            sum(quantity for _, day, kind, quantity, _ in pending_events if kind in kinds and day == today)
+        month = sum(quantities_month.values()) + \
+            sum(quantity for _, day, kind, quantity, _ in pending_events if kind in kinds and day >= month_start)
+        return day, month
@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+
+from usage_ledger import IMAGE_SIZES, TTS_MODELS, image_kind, tts_kind
+
+# Day of the events correcting the all-time cost, before any real day so that day and month totals ignore them
+COST_ADJUSTMENT_DAY = '0001-01-01'
+
+# Number of usage files summed by a worker process at a time
+FILES_PER_TASK = 64
+
+# Defaults of the usage report
+TOP_USERS = 10
+REPORT_DAYS = 14
+
+
+def usage_day(day: str) -> str:
+    # Monthly totals of compacted logs are dated on the first day of the month
+    return f'{day}-01' if len(day) == 7 else day
+
+
+def usage_to_events(user_id, usage: dict, prices: dict) -> list:
+    """
+    Converts the usage history of a JSON usage log into ledger events, one per day and kind.
+    The cost of each day is recomputed from the prices, and a last event makes the all-time cost
+    of the ledger equal to the one of the log, which was computed from the prices in effect at the time.
+    :param user_id: Telegram ID of the user
+    :param usage: the content of the user's usage log
+    :param prices: the token_price, image_prices, vision_token_price, tts_prices and transcription_price
+    :return: list of (user_id, day, kind, quantity, cost) tuples
+    """
+    history = usage['usage_history']
+    events = []
+    for day, tokens in history.get('chat_tokens', {}).items():
+        events.append((user_id, usage_day(day), 'chat_tokens', tokens, round(tokens * prices['token_price'] / 1000, 6)))
+    for day, counts in history.get('number_images', {}).items():
+        for size, count, price in zip(IMAGE_SIZES, counts, prices['image_prices']):
+            if count:
+                events.append((user_id, usage_day(day), image_kind(size), count, count * price))
+    for day, tokens in history.get('vision_tokens', {}).items():
+        events.append((user_id, usage_day(day), 'vision_tokens', tokens,
+                       round(tokens * prices['vision_token_price'] / 1000, 2)))
+    for model, characters_per_day in history.get('tts_characters', {}).items():
+        price = prices['tts_prices'][TTS_MODELS.index(model)]
+        for day, characters in characters_per_day.items():
+            events.append((user_id, usage_day(day), tts_kind(model), characters, round(characters * price / 1000, 2)))
+    for day, seconds in history.get('transcription_seconds', {}).items():
+        events.append((user_id, usage_day(day), 'transcription_seconds', seconds,
+                       round(seconds * prices['transcription_price'] / 60, 2)))
+
+    all_time_cost = usage['current_cost'].get('all_time')
+    if all_time_cost is not None:
+        adjustment = all_time_cost - sum(event[4] for event in events)
+        if abs(adjustment) > 1e-9:
+            events.append((user_id, COST_ADJUSTMENT_DAY, 'cost_adjustment', 0, adjustment))
+    return events
+
+
+def new_totals() -> dict:
+    """
+    Returns empty usage totals:
+    users: {user_id: all-time cost}, user_names: {user_id: user name}, days: {day: cost},
+    kinds: {kind: [quantity, cost]}, and the number of users read and of files that failed to load
+    """
+    return {'users': {}, 'user_names': {}, 'days': {}, 'kinds': {}, 'files': 0, 'errors': 0}
+
+
+def merge_totals(totals: dict, other: dict):
+    """
+    Adds the usage totals of other to totals
+    """
+    for user_id, cost in other['users'].items():
+        totals['users'][user_id] = totals['users'].get(user_id, 0.0) + cost
+    totals['user_names'].update(other['user_names'])
+    for day, cost in other['days'].items():
+        totals['days'][day] = totals['days'].get(day, 0.0) + cost
+    for kind, (quantity, cost) in other['kinds'].items():
+        kind_totals = totals['kinds'].setdefault(kind, [0, 0.0])
+        kind_totals[0] += quantity
+        kind_totals[1] += cost
+    totals['files'] += other['files']
+    totals['errors'] += other['errors']
+
+
+def read_usage_file(user_file: str, prices: dict) -> tuple:
+    """
+    Reads a JSON usage log as usage events.
+    :param user_file: path of the usage log
+    :param prices: the prices, see usage_to_events
+    :return: the user name and the usage events
+    """
+    user_id = os.path.basename(user_file)[:-len('.json')]
+    with open(user_file, 'r') as file:
+        usage = json.load(file)
+    return usage['user_name'], usage_to_events(user_id, usage, prices)
+
+
+def read_usage_files(user_files: list, prices: dict) -> list:
+    """
+    Reads JSON usage logs as usage events, skipping the logs that fail to load.
+    Runs in the worker processes of iter_usage_log_events.
+    :return: list of (user_id, day, kind, quantity, cost) tuples
+    """
+    events = []
+    for user_file in user_files:
+        try:
+            events.extend(read_usage_file(user_file, prices)[1])
+        except Exception as e:
+            logging.error(f'Failed to read the usage log {user_file}: {str(e)}')
+    return events
+
+
+def sum_usage_files(user_files: list, prices: dict, since_day: str) -> dict:
+    """
+    Sums the usage of JSON usage logs. Runs in the worker processes of aggregate_usage_logs.
+    :param user_files: paths of the usage logs
+    :param prices: the prices, see usage_to_events
+    :param since_day: first day of the daily totals, as an ISO date string
+    :return: the usage totals, see new_totals
+    """
+    totals = new_totals()
+    users, days, kinds = totals['users'], totals['days'], totals['kinds']
+    for user_file in user_files:
+        try:
+            user_name, events = read_usage_file(user_file, prices)
+        except Exception as e:
+            logging.error(f'Failed to read the usage log {user_file}: {str(e)}')
+            totals['errors'] += 1
+            continue
+        user_id = os.path.basename(user_file)[:-len('.json')]
+        totals['files'] += 1
+        totals['user_names'][user_id] = user_name
+        users[user_id] = sum(event[4] for event in events)
+        for _, day, kind, quantity, cost in events:
+            if day >= since_day:
+                days[day] = days.get(day, 0.0) + cost
+            kind_totals = kinds.setdefault(kind, [0, 0.0])
+            kind_totals[0] += quantity
+            kind_totals[1] += cost
+    return totals
+
+
+def list_usage_files(logs_dir: str) -> list:
+    """
+    Returns the paths of the JSON usage logs, in chunks of FILES_PER_TASK files
+    """
+    if not os.path.isdir(logs_dir):
+        return []
+    user_files = sorted(os.path.join(logs_dir, file_name) for file_name in os.listdir(logs_dir)
+                        if file_name.endswith('.json'))
+    return [user_files[i:i + FILES_PER_TASK] for i in range(0, len(user_files), FILES_PER_TASK)]
+
+
+def aggregate_usage_logs(logs_dir: str, prices: dict, since_day: str, workers: int | None = None,
+                         mp_context=None) -> dict:
+    """
+    Sums the usage of all JSON usage logs, split in chunks summed by a pool of worker processes.
+    Days of compacted logs older than the compaction window are counted on the first day of their month.
+    :param logs_dir: directory of the usage logs
+    :param prices: the prices, see usage_to_events
+    :param since_day: first day of the daily totals, as an ISO date string
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :param mp_context: multiprocessing context of the worker processes, defaults to the platform's start method
+    :return: the usage totals, see new_totals
+    """
+    totals = new_totals()
+    chunks = list_usage_files(logs_dir)
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers <= 1:
+        for chunk in chunks:
+            merge_totals(totals, sum_usage_files(chunk, prices, since_day))
+        return totals
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+        for chunk_totals in executor.map(sum_usage_files, chunks,
+                                         [prices] * len(chunks), [since_day] * len(chunks)):
+            merge_totals(totals, chunk_totals)
+    return totals
+
+
+def iter_usage_log_events(logs_dir: str, prices: dict, workers: int | None = None):
+    """
+    Yields the usage events of all JSON usage logs, a chunk of FILES_PER_TASK files at a time, read by a pool
+    of worker processes. At most two chunks per worker are read ahead, so that memory stays bounded
+    however many logs there are.
+    :param logs_dir: directory of the usage logs
+    :param prices: the prices, see usage_to_events
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :return: generator of lists of (user_id, day, kind, quantity, cost) tuples
+    """
+    chunks = list_usage_files(logs_dir)
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers <= 1:
+        for chunk in chunks:
+            yield read_usage_files(chunk, prices)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(read_usage_files, chunk, prices))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_since_day(days: int, today=None) -> str:
+    """
+    Returns the first day of the daily totals of the last days, today included
+    """
+    return str((today or date.today()) - timedelta(days=days - 1))
+
+
+def format_quantity(quantity) -> str:
+    # Quantities summed by SQLite are floats, and transcription seconds have decimals
+    quantity = round(quantity, 2)
+    return f'{int(quantity):,}' if quantity == int(quantity) else f'{quantity:,}'
+
+
+def format_usage_report(report: dict, top_n: int = TOP_USERS, days: int = REPORT_DAYS) -> str:
+    """
+    Formats a usage report as plain text, as user names may contain Markdown characters
+    :param report: the usage totals, with the time they were computed at and how long it took
+    :param top_n: number of users listed
+    :param days: number of days listed
+    """
+    users = report['users']
+    top_users = sorted(users.items(), key=lambda item: item[1], reverse=True)[:top_n]
+    since_day = get_since_day(days)
+    lines = [
+        'Usage of all users',
+        f'💰 Total cost: ${sum(users.values()):.2f} for {len(users)} users',
+        '',
+        f'🏆 Top {len(top_users)} users by cost:',
+    ]
+    for rank, (user_id, cost) in enumerate(top_users, start=1):
+        lines.append(f'{rank}. {report["user_names"].get(user_id, "?")} ({user_id}): ${cost:.2f}')
+    lines += ['', f'📅 Cost per day, last {days} days:']
+    for day in sorted(day for day in report['days'] if day >= since_day):
+        lines.append(f'{day}: ${report["days"][day]:.2f}')
+    lines += ['', '🧮 Usage per kind:']
+    for kind, (quantity, cost) in sorted(report['kinds'].items(), key=lambda item: item[1][1], reverse=True):
+        lines.append(f'{kind}: {format_quantity(quantity)}, ${cost:.2f}')
+    created = datetime.fromtimestamp(report['created']).strftime('%Y-%m-%d %H:%M:%S')
+    errors = f', {report["errors"]} unreadable' if report['errors'] else ''
+    lines += ['', f'⏱ As of {created}, computed in {report["seconds"]:.2f}s from {report["files"]} users{errors}']
+    return '\n'.join(lines)
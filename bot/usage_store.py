@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+
+from ttl_cache import TTLCache
+from usage_ledger import UsageLedger, SQLiteUsageTracker
+from usage_report import aggregate_usage_logs
+from usage_tracker import UsageTracker, compact_usage_history
+
+USAGE_BACKENDS = ('json', 'sqlite')
+
+# Seconds between two compactions of the usage history
+COMPACTION_INTERVAL = 24 * 60 * 60
+
+
+class UsageWriter:
+    """
+    Write-behind persistence for usage trackers: changed trackers are marked dirty
+    and saved in batches by a background thread, every flush interval and on shutdown.
+    At most the usage of the last flush interval is lost if the process crashes.
+    """
+
+    def __init__(self, flush_interval: float = 5.0):
+        """
+        Initializes the writer and starts its thread.
+        :param flush_interval: Number of seconds between two flushes
+        """
+        self.flush_interval = flush_interval
+        self._dirty: dict = {}  # {id(tracker): tracker}
+        self._lock = threading.Lock()
+        # held while a tracker is saved, so that a tracker is never saved twice at the same time
+        self._save_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.__run, name='usage-writer', daemon=True)
+        self._thread.start()
+
+    def mark_dirty(self, tracker):
+        """
+        Schedules a tracker to be saved with the next flush
+        """
+        with self._lock:
+            self._dirty[id(tracker)] = tracker
+
+    def flush(self):
+        """
+        Saves all dirty trackers now
+        """
+        with self._lock:
+            tracker_ids = list(self._dirty)
+        for tracker_id in tracker_ids:
+            with self._save_lock:
+                with self._lock:
+                    tracker = self._dirty.pop(tracker_id, None)
+                if tracker is not None:
+                    self.__save(tracker)
+
+    def flush_tracker(self, tracker):
+        """
+        Saves a tracker now if it has pending changes, and waits for a save of it in progress
+        """
+        with self._save_lock:
+            with self._lock:
+                dirty = self._dirty.pop(id(tracker), None) is not None
+            if dirty:
+                self.__save(tracker)
+
+    def stop(self):
+        """
+        Stops the thread after a last flush
+        """
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def __run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def __save(self, tracker):
+        try:
+            tracker.save()
+        except Exception as e:
+            logging.error(f'Failed to save the usage of user {tracker.user_id}: {str(e)}')
+            # Retried with the next flush
+            self.mark_dirty(tracker)
+
+
+class UsageStore:
+    """
+    Creates and keeps the usage trackers of the users, and owns their persistence:
+    JSON files per user (the default) or a SQLite usage ledger.
+    Only the most recently used trackers are kept loaded, the others are saved, evicted,
+    and loaded again on their next use.
+    Supports `user_id in store` and `store[user_id]` for the users whose tracker was created.
+    """
+
+    def __init__(self, config: dict):
+        """
+        Initializes the store.
+        :param config: A dictionary containing the bot configuration
+        """
+        self.config = config
+        self.logs_dir = config.get('usage_logs_dir', 'usage_logs')
+        flush_interval = config.get('usage_flush_interval', 0)
+        self.writer = UsageWriter(flush_interval) if flush_interval > 0 else None
+        self.trackers = TTLCache(max_size=config.get('usage_cache_size', 1000),
+                                 on_evict=self.__save_evicted_tracker)  # {user_id: UsageTracker}
+        # names of the users whose tracker was created, to load it again after an eviction
+        self.user_names: dict = {}  # {user_id: user_name}
+        # guards the trackers against the compaction thread rewriting the file of a user being loaded
+        self.lock = threading.Lock()
+        self.ledger = UsageLedger(config['usage_db_file']) if config.get('usage_backend') == 'sqlite' else None
+        self._stopped = threading.Event()
+        self._compaction_thread = None
+        if config.get('usage_history_days', 0) > 0 and self.ledger is None:
+            self._compaction_thread = threading.Thread(target=self.__compact_periodically,
+                                                       name='usage-compaction', daemon=True)
+            self._compaction_thread.start()
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self.user_names
+
+    def __getitem__(self, user_id):
+        return self.get_tracker(user_id, self.user_names[user_id])
+
+    def get_tracker(self, user_id, user_name):
+        """
+        Returns the usage tracker of a user, loading it if needed
+        """
+        tracker = self.trackers.get(user_id)
+        if tracker is None:
+            with self.lock:
+                if self.ledger is not None:
+                    tracker = SQLiteUsageTracker(user_id, user_name, self.ledger, writer=self.writer)
+                else:
+                    tracker = UsageTracker(user_id, user_name, logs_dir=self.logs_dir, writer=self.writer)
+                self.trackers.set(user_id, tracker)
+                self.user_names[user_id] = user_name
+        return tracker
+
+    def get_cache_stats(self) -> dict:
+        """
+        Returns the counters of the loaded trackers cache
+        """
+        return {**self.trackers.get_stats(), 'max_size': self.trackers.max_size}
+
+    def get_report(self, prices: dict, since_day: str, workers: int | None = None, mp_context=None) -> dict:
+        """
+        Sums the usage of all users, after saving the pending changes: all-time cost per user,
+        cost per day since a day, and quantity and cost per kind.
+        The JSON usage logs are summed by a pool of worker processes, the SQLite ledger with grouped queries.
+        :param prices: the prices, to compute the cost per day and kind of the JSON usage logs
+        :param since_day: first day of the daily totals, as an ISO date string
+        :param workers: number of worker processes, defaults to the number of CPUs
+        :param mp_context: multiprocessing context of the worker processes, see aggregate_usage_logs
+        :return: the usage totals (see usage_report.new_totals), with the time they were computed at
+                 and how many seconds it took
+        """
+        started = time.perf_counter()
+        if self.writer is not None:
+            self.writer.flush()
+        if self.ledger is not None:
+            report = self.ledger.get_totals(since_day)
+        else:
+            report = aggregate_usage_logs(self.logs_dir, prices, since_day, workers, mp_context)
+        report['created'] = time.time()
+        report['seconds'] = time.perf_counter() - started
+        return report
+
+    def compact(self, keep_days: int) -> dict:
+        """
+        Folds the usage history older than keep_days into monthly totals, in all usage files.
+        :param keep_days: Number of recent days kept with daily granularity
+        :return: Totals of the compaction: files, folded days, and size and load time of the files before and after
+        """
+        report = {'files': 0, 'folded_days': 0, 'bytes_before': 0, 'bytes_after': 0,
+                  'load_seconds_before': 0.0, 'load_seconds_after': 0.0}
+        if not os.path.isdir(self.logs_dir):
+            return report
+        for file_name in sorted(os.listdir(self.logs_dir)):
+            if not file_name.endswith('.json'):
+                continue
+            user_file = os.path.join(self.logs_dir, file_name)
+            user_id = file_name[:-len('.json')]
+            user_id = int(user_id) if user_id.lstrip('-').isdigit() else user_id
+            try:
+                with self.lock:
+                    usage, load_seconds = self.__load_usage_file(user_file)
+                    report['bytes_before'] += os.path.getsize(user_file)
+                    report['load_seconds_before'] += load_seconds
+                    tracker = self.trackers.peek(user_id)
+                    if tracker is not None:
+                        # compact saves the tracker, or marks it dirty when there is a writer: save it now
+                        # through the writer, which never saves a tracker from two threads at once
+                        folded = tracker.compact(keep_days)
+                        if folded and self.writer is not None:
+                            self.writer.flush_tracker(tracker)
+                    else:
+                        folded = compact_usage_history(usage, keep_days)
+                        if folded:
+                            self.__save_usage_file(user_file, usage)
+                _, load_seconds = self.__load_usage_file(user_file)
+                report['files'] += 1
+                report['folded_days'] += folded
+                report['bytes_after'] += os.path.getsize(user_file)
+                report['load_seconds_after'] += load_seconds
+            except Exception as e:
+                logging.error(f'Failed to compact the usage of user {user_id}: {str(e)}')
+        return report
+
+    def close(self):
+        """
+        Saves the pending changes
+        """
+        self._stopped.set()
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+        if self.writer is not None:
+            self.writer.stop()
+        if self.ledger is not None:
+            self.ledger.close()
+
+    def __save_evicted_tracker(self, user_id, tracker):
+        """
+        Saves an evicted tracker before it is dropped, so that loading it again reads its latest usage
+        """
+        if self.writer is not None:
+            self.writer.flush_tracker(tracker)
+        logging.debug(f'Evicted the usage tracker of user {user_id}')
+
+    def __compact_periodically(self):
+        keep_days = self.config['usage_history_days']
+        while True:
+            report = self.compact(keep_days)
+            logging.info(f'Compacted usage history older than {keep_days} days: {report["folded_days"]} days folded '
+                         f'in {report["files"]} files, {report["bytes_before"]} -> {report["bytes_after"]} bytes, '
+                         f'load time {report["load_seconds_before"]:.3f}s -> {report["load_seconds_after"]:.3f}s')
+            if self._stopped.wait(COMPACTION_INTERVAL):
+                return
+
+    @staticmethod
+    def __load_usage_file(user_file) -> tuple:
+        started = time.perf_counter()
+        with open(user_file, 'r') as file:
+            usage = json.load(file)
+        return usage, time.perf_counter() - started
+
+    @staticmethod
+    def __save_usage_file(user_file, usage):
+        temp_file = f'{user_file}.tmp'
+        with open(temp_file, 'w') as file:
+            json.dump(usage, file)
+        os.replace(temp_file, user_file)
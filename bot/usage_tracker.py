@@ -1,7 +1,12 @@
 import os.path
 import pathlib
 import json
-from datetime import date
+import threading
+from datetime import date, timedelta
+
+import numpy as np
+
+TTS_MODELS = ['tts-1', 'tts-1-hd']
 
 
 def year_month(date_str):
@@ -9,11 +14,150 @@ def year_month(date_str):
     return str(date_str)[:7]
 
 
+def compact_usage_history(usage, keep_days, today=None):
+    """Folds the days of a usage history older than the recent window into monthly totals.
+    Monthly totals are keyed by year-month, eg: '2023-03', next to the days of the window.
+    Totals per kind, and so the all-time cost, are unchanged.
+
+    :param usage: usage dictionary of a user, compacted in place
+    :param keep_days: number of recent days kept with daily granularity
+    :param today: current date, defaults to today
+    :return: number of days folded into monthly totals
+    """
+    cutoff = str((today or date.today()) - timedelta(days=keep_days))
+    history = usage["usage_history"]
+    # older usage files don't have all kinds
+    days_per_value = [history.get(kind, {}) for kind in ("chat_tokens", "transcription_seconds", "vision_tokens")]
+    days_per_value.extend(history.get("tts_characters", {}).values())
+    folded = 0
+    for days in days_per_value:
+        for day in [day for day in days if len(day) > 7 and day < cutoff]:
+            days[year_month(day)] = days.get(year_month(day), 0) + days.pop(day)
+            folded += 1
+    images = history.get("number_images", {})
+    for day in [day for day in images if len(day) > 7 and day < cutoff]:
+        counts = images.pop(day)
+        images[year_month(day)] = [a + b for a, b in zip(images.get(year_month(day), [0, 0, 0]), counts)]
+        folded += 1
+    return folded
+
+
+class DailyUsage:
+    """
+    Usage of one kind per day, as a NumPy array with one row per day indexed by the offset of the day
+    from the first day in the array, and the monthly totals of compacted days.
+    Each row has `width` values, eg: one count per image size.
+    """
+    __slots__ = ("width", "first_day", "days", "months")
+
+    # days allocated ahead when the array grows, so that it is not copied on every new day
+    GROWTH_DAYS = 31
+
+    def __init__(self, width=1, dtype=np.int32):
+        """
+        :param width: number of values per day
+        :param dtype: NumPy type of the values
+        """
+        self.width = width
+        self.first_day = date.today().toordinal()
+        self.days = np.zeros((0, width), dtype=dtype)
+        self.months = {}  # {"2023-03": np.ndarray of width values}
+
+    @classmethod
+    def from_json(cls, values_per_day, width=1, dtype=np.int32):
+        """
+        Loads the usage from its JSON form, eg: {"2023-03-13": 520, "2023-03-14": 1532} or
+        {"2023-03-14": [0, 1, 2]} for a width of 3, where year-month keys are monthly totals
+        """
+        usage = cls(width, dtype)
+        days = {date.fromisoformat(day).toordinal(): value
+                for day, value in values_per_day.items() if len(day) > 7}
+        if days:
+            usage.first_day = min(days)
+            usage.days = np.zeros((max(days) - usage.first_day + 1, width), dtype=dtype)
+            offsets = np.fromiter((day - usage.first_day for day in days), dtype=np.int64, count=len(days))
+            usage.days[offsets] = np.array(list(days.values()), dtype=dtype).reshape(len(days), width)
+        for month, value in values_per_day.items():
+            if len(month) == 7:
+                usage.months[month] = np.array(value, dtype=np.promote_types(dtype, np.int64)).reshape(width)
+        return usage
+
+    def to_json(self) -> dict:
+        """
+        Returns the usage in its JSON form, monthly totals first and without the days without usage
+        """
+        values_per_day = {month: self.__to_json_value(value) for month, value in sorted(self.months.items())}
+        for offset in np.flatnonzero(self.days.any(axis=1)):
+            day = date.fromordinal(self.first_day + int(offset))
+            values_per_day[str(day)] = self.__to_json_value(self.days[offset])
+        return values_per_day
+
+    def add(self, day, values):
+        """
+        Adds usage to a day
+        :param day: the date
+        :param values: a number, or `width` numbers
+        """
+        offset = day.toordinal() - self.first_day
+        if offset < 0:
+            self.days = np.concatenate((np.zeros((-offset, self.width), dtype=self.days.dtype), self.days))
+            self.first_day, offset = day.toordinal(), 0
+        elif offset >= len(self.days):
+            growth = offset - len(self.days) + self.GROWTH_DAYS
+            self.days = np.concatenate((self.days, np.zeros((growth, self.width), dtype=self.days.dtype)))
+        self.days[offset] += values
+
+    def get_day_and_month(self, day) -> tuple:
+        """
+        Sums the usage of a day, and of its month up to that day, over the values of a day
+        :return: the two totals
+        """
+        offset = day.toordinal() - self.first_day
+        rows = self.days[max(offset - day.day + 1, 0):max(offset + 1, 0)]
+        usage_day = rows[-1].sum().item() if 0 <= offset < len(self.days) else 0
+        usage_month = rows.sum().item()
+        month = self.months.get(year_month(day))
+        if month is not None:
+            usage_month += month.sum().item()
+        return usage_day, usage_month
+
+    def get_total(self) -> np.ndarray:
+        """
+        Sums all usage
+        :return: array of `width` values
+        """
+        return self.days.sum(axis=0) + sum(self.months.values(), np.zeros(self.width, dtype=np.int64))
+
+    def compact(self, cutoff) -> int:
+        """
+        Folds the days before the cutoff date into monthly totals
+        :return: number of days with usage folded
+        """
+        end = min(max(cutoff.toordinal() - self.first_day, 0), len(self.days))
+        folded = 0
+        for offset in np.flatnonzero(self.days[:end].any(axis=1)):
+            month = year_month(date.fromordinal(self.first_day + int(offset)))
+            # monthly totals are kept in 64 bits, a month can overflow the 32 bits of a day,
+            # and float series (transcription seconds) keep their fractions
+            self.months[month] = self.months.get(month, 0) + \
+                self.days[offset].astype(np.promote_types(self.days.dtype, np.int64))
+            folded += 1
+        self.days = self.days[end:].copy()
+        self.first_day += end
+        return folded
+
+    def __to_json_value(self, value):
+        values = value.tolist()
+        return values[0] if self.width == 1 else values
+
+
 class UsageTracker:
     """
     UsageTracker class
     Enables tracking of daily/monthly usage per user.
     User files are stored as JSON in /usage_logs directory.
+    Days older than the compaction window are folded into monthly totals keyed by year-month, eg: "2023-02".
+    In memory, the usage of each kind is kept in a DailyUsage array instead of the nested dictionaries.
     JSON example:
     {
         "user_name": "@user_name",
@@ -40,34 +184,65 @@ class UsageTracker:
     }
     """
 
-    def __init__(self, user_id, user_name, logs_dir="usage_logs"):
+    __slots__ = ("user_id", "logs_dir", "writer", "lock", "user_file", "user_name", "current_cost", "history")
+
+    def __init__(self, user_id, user_name, logs_dir="usage_logs", writer=None):
         """
         Initializes UsageTracker for a user with current date.
         Loads usage data from usage log file.
         :param user_id: Telegram ID of the user
         :param user_name: Telegram user name
         :param logs_dir: path to directory of usage logs, defaults to "usage_logs"
+        :param writer: UsageWriter saving the changes in the background, defaults to saving on every change
         """
         self.user_id = user_id
         self.logs_dir = logs_dir
+        self.writer = writer
+        # guards the usage against the writer thread serialising it while it changes
+        self.lock = threading.RLock()
         # path to usage file of given user
         self.user_file = f"{logs_dir}/{user_id}.json"
 
         if os.path.isfile(self.user_file):
             with open(self.user_file, "r") as file:
-                self.usage = json.load(file)
-            if 'vision_tokens' not in self.usage['usage_history']:
-                self.usage['usage_history']['vision_tokens'] = {}
-            if 'tts_characters' not in self.usage['usage_history']:
-                self.usage['usage_history']['tts_characters'] = {}
+                usage = json.load(file)
         else:
             # ensure directory exists
             pathlib.Path(logs_dir).mkdir(exist_ok=True)
-            # create new dictionary for this user
-            self.usage = {
+            usage = {
                 "user_name": user_name,
                 "current_cost": {"day": 0.0, "month": 0.0, "all_time": 0.0, "last_update": str(date.today())},
-                "usage_history": {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {}, "tts_characters": {}, "vision_tokens":{}}
+                "usage_history": {}
+            }
+        self.user_name = usage["user_name"]
+        self.current_cost = usage["current_cost"]
+        history = usage["usage_history"]
+        self.history = {
+            "chat_tokens": DailyUsage.from_json(history.get("chat_tokens", {})),
+            "transcription_seconds": DailyUsage.from_json(history.get("transcription_seconds", {}),
+                                                          dtype=np.float64),
+            "number_images": DailyUsage.from_json(history.get("number_images", {}), width=3),
+            "tts_characters": {model: DailyUsage.from_json(characters)
+                               for model, characters in history.get("tts_characters", {}).items()},
+            "vision_tokens": DailyUsage.from_json(history.get("vision_tokens", {})),
+        }
+
+    def to_json(self):
+        """
+        Returns the usage in the JSON format of the usage file
+        """
+        with self.lock:
+            return {
+                "user_name": self.user_name,
+                "current_cost": dict(self.current_cost),
+                "usage_history": {
+                    "chat_tokens": self.history["chat_tokens"].to_json(),
+                    "transcription_seconds": self.history["transcription_seconds"].to_json(),
+                    "number_images": self.history["number_images"].to_json(),
+                    "tts_characters": {model: characters.to_json()
+                                       for model, characters in self.history["tts_characters"].items()},
+                    "vision_tokens": self.history["vision_tokens"].to_json(),
+                }
             }
 
     # token usage functions:
@@ -77,38 +252,20 @@ class UsageTracker:
         :param tokens: total tokens used in last request
         :param tokens_price: price per 1000 tokens, defaults to 0.002
         """
-        today = date.today()
-        token_cost = round(float(tokens) * tokens_price / 1000, 6)
-        self.add_current_costs(token_cost)
+        with self.lock:
+            token_cost = round(float(tokens) * tokens_price / 1000, 6)
+            self.add_current_costs(token_cost)
+            self.history["chat_tokens"].add(date.today(), tokens)
 
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["chat_tokens"]:
-            # add token usage to existing date
-            self.usage["usage_history"]["chat_tokens"][str(today)] += tokens
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["chat_tokens"][str(today)] = tokens
-
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.__changed()
 
     def get_current_token_usage(self):
         """Get token amounts used for today and this month
 
         :return: total number of tokens used per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["chat_tokens"]:
-            usage_day = self.usage["usage_history"]["chat_tokens"][str(today)]
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, tokens in self.usage["usage_history"]["chat_tokens"].items():
-            if today.startswith(month):
-                usage_month += tokens
-        return usage_day, usage_month
+        usage_day, usage_month = self.__get_current_usage(self.history["chat_tokens"])
+        return int(usage_day), int(usage_month)
 
     # image usage functions:
 
@@ -119,42 +276,24 @@ class UsageTracker:
         :param image_prices: prices for images of sizes ["256x256", "512x512", "1024x1024"],
                              defaults to [0.016, 0.018, 0.02]
         """
-        sizes = ["256x256", "512x512", "1024x1024"]
-        requested_size = sizes.index(image_size)
-        image_cost = image_prices[requested_size]
-        today = date.today()
-        self.add_current_costs(image_cost)
+        with self.lock:
+            sizes = ["256x256", "512x512", "1024x1024"]
+            requested_size = sizes.index(image_size)
+            image_cost = image_prices[requested_size]
+            self.add_current_costs(image_cost)
+            images = [0, 0, 0]
+            images[requested_size] = 1
+            self.history["number_images"].add(date.today(), images)
 
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["number_images"]:
-            # add token usage to existing date
-            self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["number_images"][str(today)] = [0, 0, 0]
-            self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
-
-        # write updated image number to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.__changed()
 
     def get_current_image_count(self):
         """Get number of images requested for today and this month.
 
         :return: total number of images requested per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["number_images"]:
-            usage_day = sum(self.usage["usage_history"]["number_images"][str(today)])
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, images in self.usage["usage_history"]["number_images"].items():
-            if today.startswith(month):
-                usage_month += sum(images)
-        return usage_day, usage_month
-
+        usage_day, usage_month = self.__get_current_usage(self.history["number_images"])
+        return int(usage_day), int(usage_month)
 
     # vision usage functions
     def add_vision_tokens(self, tokens, vision_token_price=0.01):
@@ -163,90 +302,48 @@ class UsageTracker:
         :param tokens: total tokens used in last request
         :param vision_token_price: price per 1K tokens transcription, defaults to 0.01
         """
-        today = date.today()
-        token_price = round(tokens * vision_token_price / 1000, 2)
-        self.add_current_costs(token_price)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["vision_tokens"]:
-            # add requested seconds to existing date
-            self.usage["usage_history"]["vision_tokens"][str(today)] += tokens
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["vision_tokens"][str(today)] = tokens
+        with self.lock:
+            token_price = round(tokens * vision_token_price / 1000, 2)
+            self.add_current_costs(token_price)
+            self.history["vision_tokens"].add(date.today(), tokens)
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.__changed()
 
     def get_current_vision_tokens(self):
         """Get vision tokens for today and this month.
 
         :return: total amount of vision tokens per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["vision_tokens"]:
-            tokens_day = self.usage["usage_history"]["vision_tokens"][str(today)]
-        else:
-            tokens_day = 0
-        month = str(today)[:7]  # year-month as string
-        tokens_month = 0
-        for today, tokens in self.usage["usage_history"]["vision_tokens"].items():
-            if today.startswith(month):
-                tokens_month += tokens
-        return tokens_day, tokens_month
+        tokens_day, tokens_month = self.__get_current_usage(self.history["vision_tokens"])
+        return int(tokens_day), int(tokens_month)
 
     # tts usage functions:
 
     def add_tts_request(self, text_length, tts_model, tts_prices):
-        tts_models = ['tts-1', 'tts-1-hd']
-        price = tts_prices[tts_models.index(tts_model)]
-        today = date.today()
-        tts_price = round(text_length * price / 1000, 2)
-        self.add_current_costs(tts_price)
-
-        if 'tts_characters' not in self.usage['usage_history']:
-            self.usage['usage_history']['tts_characters'] = {}
-        
-        if tts_model not in self.usage['usage_history']['tts_characters']:
-            self.usage['usage_history']['tts_characters'][tts_model] = {}
+        with self.lock:
+            price = tts_prices[TTS_MODELS.index(tts_model)]
+            tts_price = round(text_length * price / 1000, 2)
+            self.add_current_costs(tts_price)
 
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["tts_characters"][tts_model]:
-            # add requested text length to existing date
-            self.usage["usage_history"]["tts_characters"][tts_model][str(today)] += text_length
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["tts_characters"][tts_model][str(today)] = text_length
+            if tts_model not in self.history["tts_characters"]:
+                self.history["tts_characters"][tts_model] = DailyUsage()
+            self.history["tts_characters"][tts_model].add(date.today(), text_length)
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.__changed()
 
     def get_current_tts_usage(self):
         """Get length of speech generated for today and this month.
 
         :return: total amount of characters converted to speech per day and per month
         """
-
-        tts_models = ['tts-1', 'tts-1-hd']
-        today = date.today()
-        characters_day = 0
-        for tts_model in tts_models:
-            if tts_model in self.usage["usage_history"]["tts_characters"] and \
-                str(today) in self.usage["usage_history"]["tts_characters"][tts_model]:
-                characters_day += self.usage["usage_history"]["tts_characters"][tts_model][str(today)]
-
-        month = str(today)[:7]  # year-month as string
-        characters_month = 0
-        for tts_model in tts_models:
-            if tts_model in self.usage["usage_history"]["tts_characters"]: 
-                for today, characters in self.usage["usage_history"]["tts_characters"][tts_model].items():
-                    if today.startswith(month):
-                        characters_month += characters
+        characters_day, characters_month = 0, 0
+        for tts_model in TTS_MODELS:
+            if tts_model in self.history["tts_characters"]:
+                model_day, model_month = self.__get_current_usage(self.history["tts_characters"][tts_model])
+                characters_day += model_day
+                characters_month += model_month
         return int(characters_day), int(characters_month)
 
-
     # transcription usage functions:
 
     def add_transcription_seconds(self, seconds, minute_price=0.006):
@@ -254,59 +351,84 @@ class UsageTracker:
         :param seconds: total seconds used in last request
         :param minute_price: price per minute transcription, defaults to 0.006
         """
-        today = date.today()
-        transcription_price = round(seconds * minute_price / 60, 2)
-        self.add_current_costs(transcription_price)
+        with self.lock:
+            transcription_price = round(seconds * minute_price / 60, 2)
+            self.add_current_costs(transcription_price)
+            self.history["transcription_seconds"].add(date.today(), seconds)
+
+        self.__changed()
 
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["transcription_seconds"]:
-            # add requested seconds to existing date
-            self.usage["usage_history"]["transcription_seconds"][str(today)] += seconds
+    def __changed(self):
+        """
+        Saves the usage after a change, or marks it to be saved by the writer
+        """
+        if self.writer is None:
+            self.save()
         else:
-            # create new entry for current date
-            self.usage["usage_history"]["transcription_seconds"][str(today)] = seconds
+            self.writer.mark_dirty(self)
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+    def __get_current_usage(self, usage):
+        """
+        :param usage: DailyUsage of a kind
+        :return: usage of the kind for today and this month, summed over the values of a day
+        """
+        with self.lock:
+            return usage.get_day_and_month(date.today())
+
+    def compact(self, keep_days):
+        """Folds the days older than the recent window into monthly totals.
+
+        :param keep_days: number of recent days kept with daily granularity
+        :return: number of days folded into monthly totals
+        """
+        cutoff = date.today() - timedelta(days=keep_days)
+        with self.lock:
+            folded = sum(self.history[kind].compact(cutoff)
+                         for kind in ("chat_tokens", "transcription_seconds", "number_images", "vision_tokens"))
+            folded += sum(characters.compact(cutoff) for characters in self.history["tts_characters"].values())
+        if folded:
+            self.__changed()
+        return folded
+
+    def save(self):
+        """
+        Writes the usage to the user file. The file is replaced atomically,
+        so that a crash while writing can't leave a truncated file behind.
+        """
+        data = json.dumps(self.to_json())
+        temp_file = f"{self.user_file}.tmp"
+        with open(temp_file, "w") as outfile:
+            outfile.write(data)
+        os.replace(temp_file, self.user_file)
 
     def add_current_costs(self, request_cost):
         """
         Add current cost to all_time, day and month cost and update last_update date.
         """
         today = date.today()
-        last_update = date.fromisoformat(self.usage["current_cost"]["last_update"])
+        last_update = date.fromisoformat(self.current_cost["last_update"])
 
         # add to all_time cost, initialize with calculation of total_cost if key doesn't exist
-        self.usage["current_cost"]["all_time"] = \
-            self.usage["current_cost"].get("all_time", self.initialize_all_time_cost()) + request_cost
+        self.current_cost["all_time"] = \
+            self.current_cost.get("all_time", self.initialize_all_time_cost()) + request_cost
         # add current cost, update new day
         if today == last_update:
-            self.usage["current_cost"]["day"] += request_cost
-            self.usage["current_cost"]["month"] += request_cost
+            self.current_cost["day"] += request_cost
+            self.current_cost["month"] += request_cost
         else:
             if today.month == last_update.month:
-                self.usage["current_cost"]["month"] += request_cost
+                self.current_cost["month"] += request_cost
             else:
-                self.usage["current_cost"]["month"] = request_cost
-            self.usage["current_cost"]["day"] = request_cost
-            self.usage["current_cost"]["last_update"] = str(today)
+                self.current_cost["month"] = request_cost
+            self.current_cost["day"] = request_cost
+            self.current_cost["last_update"] = str(today)
 
     def get_current_transcription_duration(self):
         """Get minutes and seconds of audio transcribed for today and this month.
 
         :return: total amount of time transcribed per day and per month (4 values)
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["transcription_seconds"]:
-            seconds_day = self.usage["usage_history"]["transcription_seconds"][str(today)]
-        else:
-            seconds_day = 0
-        month = str(today)[:7]  # year-month as string
-        seconds_month = 0
-        for today, seconds in self.usage["usage_history"]["transcription_seconds"].items():
-            if today.startswith(month):
-                seconds_month += seconds
+        seconds_day, seconds_month = self.__get_current_usage(self.history["transcription_seconds"])
         minutes_day, seconds_day = divmod(seconds_day, 60)
         minutes_month, seconds_month = divmod(seconds_month, 60)
         return int(minutes_day), round(seconds_day, 2), int(minutes_month), round(seconds_month, 2)
@@ -318,18 +440,18 @@ class UsageTracker:
         :return: cost of current day and month
         """
         today = date.today()
-        last_update = date.fromisoformat(self.usage["current_cost"]["last_update"])
+        last_update = date.fromisoformat(self.current_cost["last_update"])
         if today == last_update:
-            cost_day = self.usage["current_cost"]["day"]
-            cost_month = self.usage["current_cost"]["month"]
+            cost_day = self.current_cost["day"]
+            cost_month = self.current_cost["month"]
         else:
             cost_day = 0.0
             if today.month == last_update.month:
-                cost_month = self.usage["current_cost"]["month"]
+                cost_month = self.current_cost["month"]
             else:
                 cost_month = 0.0
         # add to all_time cost, initialize with calculation of total_cost if key doesn't exist
-        cost_all_time = self.usage["current_cost"].get("all_time", self.initialize_all_time_cost())
+        cost_all_time = self.current_cost.get("all_time", self.initialize_all_time_cost())
         return {"cost_today": cost_day, "cost_month": cost_month, "cost_all_time": cost_all_time}
 
     def initialize_all_time_cost(self, tokens_price=0.002, image_prices="0.016,0.018,0.02", minute_price=0.006, vision_token_price=0.01, tts_prices='0.015,0.030'):
@@ -343,20 +465,20 @@ class UsageTracker:
         :param tts_prices: price per 1K characters tts per model ['tts-1', 'tts-1-hd'], defaults to [0.015, 0.030]
         :return: total cost of all requests
         """
-        total_tokens = sum(self.usage['usage_history']['chat_tokens'].values())
+        total_tokens = self.history["chat_tokens"].get_total().sum().item()
         token_cost = round(total_tokens * tokens_price / 1000, 6)
 
-        total_images = [sum(values) for values in zip(*self.usage['usage_history']['number_images'].values())]
-        image_prices_list = [float(x) for x in image_prices.split(',')]
-        image_cost = sum([count * price for count, price in zip(total_images, image_prices_list)])
+        total_images = self.history["number_images"].get_total()
+        image_prices_list = np.array([float(x) for x in image_prices.split(',')])
+        image_cost = float(total_images @ image_prices_list)
 
-        total_transcription_seconds = sum(self.usage['usage_history']['transcription_seconds'].values())
+        total_transcription_seconds = self.history["transcription_seconds"].get_total().sum().item()
         transcription_cost = round(total_transcription_seconds * minute_price / 60, 2)
 
-        total_vision_tokens = sum(self.usage['usage_history']['vision_tokens'].values())
+        total_vision_tokens = self.history["vision_tokens"].get_total().sum().item()
         vision_cost = round(total_vision_tokens * vision_token_price / 1000, 2)
 
-        total_characters = [sum(tts_model.values()) for tts_model in self.usage['usage_history']['tts_characters'].values()]
+        total_characters = [characters.get_total().sum().item() for characters in self.history["tts_characters"].values()]
         tts_prices_list = [float(x) for x in tts_prices.split(',')]
         tts_cost = round(sum([count * price / 1000 for count, price in zip(total_characters, tts_prices_list)]), 2)
 
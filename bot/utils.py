@@ -8,10 +8,11 @@ import os
 import base64
 
 import telegram
-from telegram import Message, MessageEntity, Update, ChatMember, constants
+import tiktoken
+from telegram import Message, MessageEntity, Update, constants
 from telegram.ext import CallbackContext, ContextTypes
 
-from usage_tracker import UsageTracker
+from group_membership import GroupMemberships
 
 
 def message_text(message: Message) -> str:
@@ -29,22 +30,6 @@ def message_text(message: Message) -> str:
     return message_txt if len(message_txt) > 0 else ''
 
 
-async def is_user_in_group(update: Update, context: CallbackContext, user_id: int) -> bool:
-    """
-    Checks if user_id is a member of the group
-    """
-    try:
-        chat_member = await context.bot.get_chat_member(update.message.chat_id, user_id)
-        return chat_member.status in [ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER]
-    except telegram.error.BadRequest as e:
-        if str(e) == "User not found":
-            return False
-        else:
-            raise e
-    except Exception as e:
-        raise e
-
-
 def get_thread_id(update: Update) -> int | None:
     """
     Gets the message thread id for the update, if any
@@ -148,9 +133,51 @@ async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.error(f'Exception while handling an update: {context.error}')
 
 
-async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False) -> bool:
+def parse_user_ids(user_ids: str) -> frozenset:
+    """
+    Parses a comma-separated list of user IDs, once at startup, into a set of ID strings
+    """
+    return frozenset(user_id.strip() for user_id in user_ids.split(',') if user_id.strip())
+
+
+def parse_user_budgets(allowed_user_ids: str, user_budgets: str) -> dict:
+    """
+    Parses the budgets of the allowed users, once at startup, into a map of user ID strings to budgets.
+    The budgets are listed in the order of the allowed users. If every user is allowed, the map
+    holds the budget of everyone under '*'
+    :param allowed_user_ids: The comma-separated list of allowed user IDs, or '*'
+    :param user_budgets: The comma-separated list of budgets, or '*' for no budget restrictions
+    :return: The budget per user ID, empty if there are no budget restrictions
+    """
+    if user_budgets == '*':
+        return {}
+    budgets = [float(budget) for budget in user_budgets.split(',')]
+    if allowed_user_ids == '*':
+        # same budget for all users, use value in first position of budget list
+        if len(budgets) > 1:
+            logging.warning('multiple values for budgets set with unrestricted user list '
+                            'only the first value is used as budget for everyone.')
+        return {'*': budgets[0]}
+
+    user_budget_map = {}
+    for user_index, user_id in enumerate(allowed_user_ids.split(',')):
+        user_id = user_id.strip()
+        if user_id in user_budget_map:
+            continue
+        if len(budgets) <= user_index:
+            logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
+            user_budget_map[user_id] = 0.0
+        else:
+            user_budget_map[user_id] = budgets[user_index]
+    return user_budget_map
+
+
+async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False,
+                     group_memberships: GroupMemberships | None = None) -> bool:
     """
     Checks if the user is allowed to use the bot.
+    :param group_memberships: The cache of the memberships of the allowed users in the group chats,
+                              defaults to checking every membership with the Telegram API
     """
     if config['allowed_user_ids'] == '*':
         return True
@@ -159,19 +186,18 @@ async def is_allowed(config, update: Update, context: CallbackContext, is_inline
     if is_admin(config, user_id):
         return True
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    allowed_user_ids = config['allowed_user_ids'].split(',')
     # Check if user is allowed
-    if str(user_id) in allowed_user_ids:
+    if str(user_id) in config['allowed_user_id_set']:
         return True
     # Check if it's a group a chat with at least one authorized member
     if not is_inline and is_group_chat(update):
-        admin_user_ids = config['admin_user_ids'].split(',')
-        for user in itertools.chain(allowed_user_ids, admin_user_ids):
-            if not user.strip():
-                continue
-            if await is_user_in_group(update, context, user):
-                logging.info(f'{user} is a member. Allowing group chat message...')
-                return True
+        if group_memberships is None:
+            group_memberships = GroupMemberships(ttl=0)
+        admin_user_ids = config['admin_user_id_set'] if config['admin_user_ids'] != '-' else frozenset()
+        members = itertools.chain(config['allowed_user_id_set'], admin_user_ids)
+        if await group_memberships.has_any_member(update, context, members):
+            logging.info('An allowed user is a member. Allowing group chat message...')
+            return True
         logging.info(f'Group chat messages from user {name} '
                      f'(id: {user_id}) are not allowed')
     return False
@@ -187,10 +213,8 @@ def is_admin(config, user_id: int, log_no_admin=False) -> bool:
             logging.info('No admin user defined.')
         return False
 
-    admin_user_ids = config['admin_user_ids'].split(',')
-
     # Check if user is in the admin user list
-    if str(user_id) in admin_user_ids:
+    if str(user_id) in config['admin_user_id_set']:
         return True
 
     return False
@@ -208,32 +232,22 @@ def get_user_budget(config, user_id) -> float | None:
     if is_admin(config, user_id) or config['user_budgets'] == '*':
         return float('inf')
 
-    user_budgets = config['user_budgets'].split(',')
-    if config['allowed_user_ids'] == '*':
-        # same budget for all users, use value in first position of budget list
-        if len(user_budgets) > 1:
-            logging.warning('multiple values for budgets set with unrestricted user list '
-                            'only the first value is used as budget for everyone.')
-        return float(user_budgets[0])
-
-    allowed_user_ids = config['allowed_user_ids'].split(',')
-    if str(user_id) in allowed_user_ids:
-        user_index = allowed_user_ids.index(str(user_id))
-        if len(user_budgets) <= user_index:
-            logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
-            return 0.0
-        return float(user_budgets[user_index])
-    return None
+    user_budget_map = config['user_budget_map']
+    if '*' in user_budget_map:
+        return user_budget_map['*']
+    return user_budget_map.get(str(user_id))
 
 
-def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
+def get_budget_account(config, usage, update: Update, is_inline=False) -> tuple:
     """
-    Calculate the remaining budget for a user based on their current usage.
+    Finds the budget that the usage of a user counts against, their own or the one shared by all guests,
+    and calculates what is left of it.
+    Initializes UsageTracker for user and guest when needed.
     :param config: The bot configuration object
     :param usage: The usage tracker object
     :param update: Telegram update object
     :param is_inline: Boolean flag for inline queries
-    :return: The remaining budget for the user as a float
+    :return: The account (the user ID, or 'guests') and its remaining budget
     """
     # Mapping of budget period to cost period
     budget_cost_map = {
@@ -241,24 +255,33 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
         "daily": "cost_today",
         "all-time": "cost_all_time"
     }
+    cost_period = budget_cost_map[config['budget_period']]
 
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
+    tracker = usage.get_tracker(user_id, name)
 
     # Get budget for users
     user_budget = get_user_budget(config, user_id)
-    budget_period = config['budget_period']
     if user_budget is not None:
-        cost = usage[user_id].get_current_cost()[budget_cost_map[budget_period]]
-        return user_budget - cost
+        return user_id, user_budget - tracker.get_current_cost()[cost_period]
 
     # Get budget for guests
-    if 'guests' not in usage:
-        usage['guests'] = UsageTracker('guests', 'all guest users in group chats')
-    cost = usage['guests'].get_current_cost()[budget_cost_map[budget_period]]
-    return config['guest_budget'] - cost
+    guests_tracker = usage.get_tracker('guests', 'all guest users in group chats')
+    return 'guests', config['guest_budget'] - guests_tracker.get_current_cost()[cost_period]
+
+
+def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
+    """
+    Calculate the remaining budget for a user based on their current usage.
+    :param config: The bot configuration object
+    :param usage: The usage tracker object
+    :param update: Telegram update object
+    :param is_inline: Boolean flag for inline queries
+    :return: The remaining budget for the user as a float
+    """
+    _, remaining_budget = get_budget_account(config, usage, update, is_inline=is_inline)
+    return remaining_budget
 
 
 def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
@@ -271,12 +294,7 @@ def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
     :param is_inline: Boolean flag for inline queries
     :return: Boolean indicating if the user has a positive budget
     """
-    user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
-    remaining_budget = get_remaining_budget(config, usage, update, is_inline=is_inline)
-    return remaining_budget > 0
+    return get_remaining_budget(config, usage, update, is_inline=is_inline) > 0
 
 
 def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
@@ -294,8 +312,7 @@ def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
         # add chat request to users usage tracker
         usage[user_id].add_chat_tokens(used_tokens, config['token_price'])
         # add guest chat request to guest usage tracker
-        allowed_user_ids = config['allowed_user_ids'].split(',')
-        if str(user_id) not in allowed_user_ids and 'guests' in usage:
+        if str(user_id) not in config['allowed_user_id_set'] and 'guests' in usage:
             usage["guests"].add_chat_tokens(used_tokens, config['token_price'])
     except Exception as e:
         logging.warning(f'Failed to add tokens to usage_logs: {str(e)}')
@@ -380,6 +397,16 @@ def cleanup_intermediate_files(response: any):
             os.remove(value)
 
 
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding used by the given model, falling back to cl100k_base for unknown models
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
 # Function to encode the image
 def encode_image(fileobj):
     image = base64.b64encode(fileobj.getvalue()).decode('utf-8')
@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace
+
+from group_membership import GroupMemberships
+from utils import get_user_budget, parse_user_budgets
+
+
+def test_parse_user_budgets():
+    assert parse_user_budgets('1, 2,3', '5.0,10') == {'1': 5.0, '2': 10.0, '3': 0.0}
+    assert parse_user_budgets('*', '7,8') == {'*': 7.0}
+    assert parse_user_budgets('1,2', '*') == {}
+
+
+def test_get_user_budget():
+    config = {'admin_user_id_set': frozenset({'9'}), 'admin_user_ids': '9', 'allowed_user_ids': '1,2',
+              'user_budgets': '5,10', 'user_budget_map': parse_user_budgets('1,2', '5,10')}
+    assert get_user_budget(config, 2) == 10.0
+    assert get_user_budget(config, 3) is None
+    assert get_user_budget(config, 9) == float('inf')
+
+
+def test_probes_are_bounded():
+    in_flight = 0
+    max_in_flight = 0
+
+    async def get_chat_member(chat_id, user_id):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return SimpleNamespace(status='left')
+
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=1), message=SimpleNamespace(chat_id=1))
+    context = SimpleNamespace(bot=SimpleNamespace(get_chat_member=get_chat_member))
+    memberships = GroupMemberships(max_concurrency=3)
+
+    assert not asyncio.run(memberships.has_any_member(update, context, range(20)))
+    assert memberships.api_calls == 20
+    assert max_in_flight == 3
+
+
+def test_probes_stop_at_the_first_member():
+    async def get_chat_member(chat_id, user_id):
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(status='member' if user_id == '0' else 'left')
+
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=1), message=SimpleNamespace(chat_id=1))
+    context = SimpleNamespace(bot=SimpleNamespace(get_chat_member=get_chat_member))
+    memberships = GroupMemberships(max_concurrency=3)
+
+    assert asyncio.run(memberships.has_any_member(update, context, range(20)))
+    assert memberships.api_calls == 3
@@ -0,0 +1,117 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import openai_helper
+import telegram_bot
+from budget_ledger import BudgetLedger
+from openai_helper import OpenAIHelper
+from telegram_bot import ChatGPTTelegramBot
+
+
+class FakeEncoding:
+    """
+    Stands in for the tiktoken encoding, which is downloaded on first use: one token per word
+    """
+
+    def encode(self, text):
+        return text.split()
+
+    def decode(self, tokens):
+        return ' '.join(tokens)
+
+
+class FakePluginManager:
+    def select_functions_specs(self, query, recently_used=()):
+        return [{'name': 'weather', 'description': 'Gets the weather', 'parameters': {}}]
+
+    def count_specs_tokens(self, specs):
+        return 20 * len(specs)
+
+    async def call_function(self, function_name, helper, arguments):
+        return '{"temperature": 20}'
+
+    def get_plugin_source_name(self, function_name):
+        return function_name
+
+
+class FakeCompletions:
+    """
+    Answers with a function call as long as calls are queued, then with a text answer
+    """
+
+    def __init__(self, function_calls=0):
+        self.function_calls = function_calls
+        self.requests = []
+
+    async def create(self, **kwargs):
+        self.requests.append(kwargs)
+        function_call = None
+        if self.function_calls > 0 and kwargs.get('function_call') == 'auto':
+            self.function_calls -= 1
+            function_call = SimpleNamespace(name='weather', arguments='{"city": "Paris"}')
+        message = SimpleNamespace(content=f'answer {len(self.requests)}', function_call=function_call)
+        usage = SimpleNamespace(total_tokens=10, prompt_tokens=5, completion_tokens=5)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+def make_helper(monkeypatch, completions, plugin_manager=None, **config):
+    monkeypatch.setattr(openai_helper, 'get_encoding', lambda model: FakeEncoding())
+    config = {
+        'api_key': 'test', 'model': 'gpt-3.5-turbo', 'assistant_prompt': 'You are a helpful assistant.',
+        'max_tokens': 1200, 'min_max_tokens': 256, 'max_history_size': 15, 'max_conversation_age_minutes': 180,
+        'history_strategy': 'window', 'history_window_tokens': 0, 'temperature': 0.0, 'n_choices': 1,
+        'presence_penalty': 0.0, 'frequency_penalty': 0.0, 'bot_language': 'en', 'show_usage': False,
+        'show_plugins_used': False, 'enable_functions': False, 'functions_max_consecutive_calls': 10,
+        'response_cache_size': 100, 'response_cache_ttl': 3600, 'response_cache_max_temperature': 1.0,
+        **config,
+    }
+    helper = OpenAIHelper(config, plugin_manager or FakePluginManager())
+    helper.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return helper
+
+
+def test_first_message_after_max_age_is_not_cached_with_history_index(monkeypatch, tmp_path):
+    completions = FakeCompletions()
+    helper = make_helper(monkeypatch, completions, enable_response_cache=True,
+                         enable_history_retrieval=True, history_retrieval_dir=str(tmp_path),
+                         history_retrieval_top_k=3, history_retrieval_max_tokens=100)
+
+    asyncio.run(helper.get_chat_response(chat_id=1, query='My bank PIN is 4711, remember my bank PIN'))
+    helper.last_updated[1] -= datetime.timedelta(days=1)
+
+    # A first message again, after the max age: it recalls the earlier private message
+    asyncio.run(helper.get_chat_response(chat_id=1, query='What is my bank PIN?'))
+    assert '4711' in completions.requests[-1]['messages'][-2]['content']
+
+    answer, tokens = asyncio.run(helper.get_chat_response(chat_id=2, query='What is my bank PIN?'))
+    assert len(completions.requests) == 3
+    assert tokens != 0
+
+
+def test_first_message_is_cached_without_history_index(monkeypatch):
+    completions = FakeCompletions()
+    helper = make_helper(monkeypatch, completions, enable_response_cache=True)
+
+    asyncio.run(helper.get_chat_response(chat_id=1, query='What is the capital of France?'))
+    answer, tokens = asyncio.run(helper.get_chat_response(chat_id=2, query='What is the capital of France?'))
+    assert len(completions.requests) == 1
+    assert (answer, tokens) == ('answer 1', 0)
+
+
+
+def test_unlimited_user_chains_function_calls(monkeypatch):
+    completions = FakeCompletions(function_calls=2)
+    helper = make_helper(monkeypatch, completions, enable_functions=True)
+    budget_ledger = BudgetLedger()
+    bot = SimpleNamespace(config={'token_price': 0.002}, usage={}, openai=helper, budget_ledger=budget_ledger)
+    monkeypatch.setattr(telegram_bot, 'get_budget_account', lambda config, usage, update: (1, float('inf')))
+
+    _, _, max_tokens, token_budget = ChatGPTTelegramBot.reserve_chat_budget(bot, None, 1, 'Weather in Paris?')
+    assert (max_tokens, token_budget) == (None, None)
+
+    answer, _ = asyncio.run(helper.get_chat_response(chat_id=1, query='Weather in Paris?', max_tokens=max_tokens,
+                                                     token_budget=token_budget))
+    assert answer == 'answer 3'
+    assert [request['function_call'] for request in completions.requests] == ['auto', 'auto', 'auto']
+    assert all('max_tokens' not in request for request in completions.requests[1:])
@@ -0,0 +1,40 @@
+import asyncio
+
+from plugin_guard import PluginGuard
+
+
+def call(guard, response=None, error=None):
+    async def plugin_call():
+        if error is not None:
+            raise error
+        return response
+
+    return asyncio.run(guard.call(plugin_call))
+
+
+def test_error_results_do_not_open_the_breaker():
+    guard = PluginGuard('spotify', failure_threshold=3)
+    for _ in range(5):
+        assert call(guard, {'error': 'Invalid search type'}) == {'error': 'Invalid search type'}
+
+    assert not guard.is_open()
+    assert call(guard, {'result': 'ok'}) == {'result': 'ok'}
+
+
+def test_exceptions_open_the_breaker():
+    guard = PluginGuard('spotify', failure_threshold=3)
+    for _ in range(3):
+        assert call(guard, error=ConnectionError('unreachable'))['reason'] == 'failed'
+
+    assert guard.is_open()
+    assert call(guard, {'result': 'ok'})['reason'] == 'unavailable'
+
+
+def test_timeouts_open_the_breaker():
+    guard = PluginGuard('weather', timeout=0.01, failure_threshold=1)
+
+    async def slow_call():
+        await asyncio.sleep(1)
+
+    assert asyncio.run(guard.call(slow_call))['reason'] == 'timeout'
+    assert guard.is_open()
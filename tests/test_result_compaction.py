@@ -0,0 +1,17 @@
+from result_compaction import prune_empty_values
+
+
+def test_prune_drops_empty_fields():
+    result = {'name': 'Berlin', 'region': None, 'tags': [], 'notes': '', 'details': {'population': None}}
+
+    assert prune_empty_values(result) == {'name': 'Berlin'}
+
+
+def test_prune_keeps_list_positions():
+    result = {'hourly': {'time': ['00:00', '01:00', '02:00'], 'precipitation': [0.1, None, 0.3]}}
+
+    assert prune_empty_values(result) == result
+
+
+def test_prune_converts_tuples_to_lists():
+    assert prune_empty_values({'point': (1, 2)}) == {'point': [1, 2]}
@@ -0,0 +1,90 @@
+import pytest
+
+from semantic_cache import SemanticCache
+
+# The default SEMANTIC_CACHE_THRESHOLD
+THRESHOLD = 0.9
+
+PARAPHRASES = [
+    ("What is the capital of France?", "whats the capital of france"),
+    ("How do I reverse a list in Python?", "how do i reverse a list with python"),
+    ("What's the weather like today?", "what is the weather like today"),
+    ("Can you explain what a black hole is?", "can you explain what black holes are"),
+    ("Tell me a joke", "tell me a joke please"),
+    ("What are the symptoms of the flu?", "what's a symptom of flu"),
+    ("What is the meaning of life?", "what's the meaning of life"),
+    ("Translate hello to Spanish", "translate 'hello' into spanish"),
+    ("How many legs does a spider have?", "how many legs do spiders have"),
+    ("Write a haiku about autumn", "write a haiku on autumn"),
+    ("How do I center a div in CSS?", "how do i center a div with css?"),
+    ("Give me a recipe for banana bread", "give me a banana bread recipe"),
+]
+
+DIFFERENT_QUESTIONS = [
+    ("12 times 13", "12 times 14"),
+    ("What is 2+2?", "What is 2+3?"),
+    ("What is the capital of France?", "What is the capital of Spain?"),
+    ("How do I reverse a list in Python?", "How do I sort a list in Python?"),
+    ("Translate hello to Spanish", "Translate hello to German"),
+    ("Convert 100 USD to EUR", "Convert 100 EUR to USD"),
+    ("How do I make pancakes?", "How do I make waffles?"),
+    ("What year did World War 1 start?", "What year did World War 2 start?"),
+    ("Is 17 a prime number?", "Is 21 a prime number?"),
+    ("What is the boiling point of water?", "What is the freezing point of water?"),
+    ("Why do birds fly?", "Why don't birds fly?"),
+    ("Write a python function that sorts a list of integers in ascending order",
+     "Write a python function that sorts a list of integers in descending order"),
+    # Question words, modals, tenses and persons change the question
+    ("When was Python created?", "Why was Python created?"),
+    ("Did it rain in Paris yesterday?", "Will it rain in Paris yesterday?"),
+    ("What is my name?", "What is your name?"),
+    ("What is the population of France?", "Where is the population of France?"),
+    ("Who was the president of France?", "Who is the president of France?"),
+    ("How do I make pancakes?", "How can I make pancakes?"),
+]
+
+
+@pytest.mark.parametrize('question, paraphrase', PARAPHRASES)
+def test_paraphrases_hit(question, paraphrase):
+    cache = SemanticCache(threshold=THRESHOLD)
+    cache.set('namespace', question, 'answer')
+
+    assert cache.get('namespace', paraphrase)[1] == 'answer'
+
+
+@pytest.mark.parametrize('question, other_question', DIFFERENT_QUESTIONS)
+def test_different_questions_miss(question, other_question):
+    cache = SemanticCache(threshold=THRESHOLD)
+    cache.set('namespace', question, 'answer')
+
+    assert cache.get('namespace', other_question) is None
+
+
+def test_namespaces_are_separate():
+    cache = SemanticCache(threshold=THRESHOLD)
+    cache.set('namespace', 'What is the capital of France?', 'answer')
+
+    assert cache.get('other namespace', 'What is the capital of France?') is None
+
+
+def test_false_positive_removes_the_entry():
+    cache = SemanticCache(threshold=THRESHOLD)
+    cache.set('namespace', 'Tell me a joke', 'answer')
+    entry, _ = cache.get('namespace', 'tell me a joke please')
+
+    cache.report_false_positive(entry)
+
+    assert cache.get('namespace', 'tell me a joke please') is None
+    assert cache.get_stats()['false_positives'] == 1
+
+
+def test_false_positive_keeps_a_newer_entry_in_the_same_slot():
+    cache = SemanticCache(max_size=1, threshold=THRESHOLD)
+    cache.set('namespace', 'Tell me a joke', 'answer')
+    entry, _ = cache.get('namespace', 'tell me a joke please')
+    cache.set('namespace', 'What is the capital of France?', 'Paris')
+
+    cache.report_false_positive(entry)
+
+    assert cache.get('namespace', 'whats the capital of france')[1] == 'Paris'
+    assert cache.get_stats()['false_positives'] == 1
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from ttl_cache import CallCancelledError, SingleFlight
+
+
+def test_waiter_takes_over_a_cancelled_call():
+    async def main():
+        single_flight = SingleFlight()
+        calls = []
+
+        async def call(name):
+            calls.append(name)
+            await asyncio.sleep(0.01)
+            return name
+
+        leader = asyncio.create_task(single_flight.do('key', lambda: call('leader')))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(single_flight.do('key', lambda name=name: call(name)))
+                   for name in ('first', 'second')]
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return calls, await asyncio.gather(*waiters)
+
+    calls, results = asyncio.run(main())
+    assert calls == ['leader', 'first']
+    assert results == ['first', 'first']
+
+
+def test_cancelled_stream_fails_its_consumers():
+    async def main():
+        single_flight = SingleFlight()
+
+        async def items():
+            yield 1
+            await asyncio.sleep(1)
+            yield 2
+
+        async def start():
+            return items()
+
+        shared = await single_flight.stream('key', start)
+        consumed = []
+
+        async def consume():
+            async for item in shared:
+                consumed.append(item)
+
+        consumer = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        shared.task.cancel()
+        with pytest.raises(CallCancelledError):
+            await consumer
+        return consumed
+
+    assert asyncio.run(main()) == [1]
@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+
+import pytest
+
+import usage_cli
+from usage_ledger import UsageLedger
+
+
+def write_usage_log(logs_dir, user_id, usage_history):
+    usage = {'user_name': f'@user_{user_id}', 'usage_history': usage_history,
+             'current_cost': {'day': 0.0, 'month': 0.0, 'all_time': 0.0, 'last_update': '2026-10-19'}}
+    with open(os.path.join(logs_dir, f'{user_id}.json'), 'w') as file:
+        json.dump(usage, file)
+
+
+def export_args(tmp_path, parquet=None):
+    return argparse.Namespace(backend='json', logs_dir=str(tmp_path / 'usage_logs'), db_file=None,
+                              output=str(tmp_path / 'usage.csv'), parquet=parquet, workers=1)
+
+
+def test_export_skips_users_without_usage(tmp_path):
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    os.mkdir(tmp_path / 'usage_logs')
+    write_usage_log(tmp_path / 'usage_logs', 1, {})
+    parquet_file = str(tmp_path / 'usage.parquet')
+
+    usage_cli.export(export_args(tmp_path, parquet=parquet_file))
+
+    assert pq.read_table(parquet_file).num_rows == 0
+    with open(tmp_path / 'usage.csv') as file:
+        assert file.read().splitlines() == [','.join(usage_cli.EXPORT_COLUMNS)]
+
+
+def test_export_removes_partial_files_on_failure(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+
+    def failing_events(*args, **kwargs):
+        yield [('1', '2026-10-19', 'chat_tokens', 10, 0.00002)]
+        raise OSError('disk error')
+
+    monkeypatch.setattr(usage_cli, 'iter_usage_log_events', failing_events)
+    parquet_file = str(tmp_path / 'usage.parquet')
+
+    with pytest.raises(OSError):
+        usage_cli.export(export_args(tmp_path, parquet=parquet_file))
+
+    assert not os.path.exists(parquet_file)
+    assert not os.path.exists(tmp_path / 'usage.csv')
+
+
+def test_migrate_imports_users_with_new_usage_once(tmp_path):
+    logs_dir = tmp_path / 'usage_logs'
+    os.mkdir(logs_dir)
+    write_usage_log(logs_dir, 1, {'chat_tokens': {'2026-01-10': 1000}})
+    db_file = str(tmp_path / 'usage.db')
+    # usage recorded by the bot after USAGE_BACKEND=sqlite was set, before the migration
+    ledger = UsageLedger(db_file)
+    ledger.add_events([('1', '2026-10-19', 'chat_tokens', 500, 0.001)])
+    ledger.close()
+    args = argparse.Namespace(logs_dir=str(logs_dir), db_file=db_file)
+
+    usage_cli.migrate(args)
+    usage_cli.migrate(args)
+
+    ledger = UsageLedger(db_file)
+    assert ledger.get_quantities('1', ['chat_tokens'], '2026-01-01', '2026-12-31') == {'chat_tokens': 1500}
+    assert ledger.get_migrated_user_ids() == {'1'}
+    ledger.close()
@@ -0,0 +1,34 @@
+from datetime import date
+
+import numpy as np
+import pytest
+
+from usage_tracker import DailyUsage, compact_usage_history
+
+
+def test_compact_keeps_fractional_seconds():
+    days = {'2026-04-02': 12.7, '2026-04-03': 30.9, '2026-05-01': 4.0}
+    usage = DailyUsage.from_json(days, dtype=np.float64)
+
+    folded = usage.compact(date(2026, 5, 1))
+
+    assert folded == 2
+    assert usage.to_json() == {'2026-04': pytest.approx(43.6), '2026-05-01': 4.0}
+
+
+def test_compact_matches_file_compaction():
+    days = {'2026-04-02': 12.7, '2026-04-03': 30.9}
+    usage = DailyUsage.from_json(days, dtype=np.float64)
+    usage.compact(date(2026, 5, 1))
+    file_usage = {'usage_history': {'transcription_seconds': dict(days)}}
+    compact_usage_history(file_usage, keep_days=0, today=date(2026, 5, 1))
+
+    assert usage.to_json() == file_usage['usage_history']['transcription_seconds']
+
+
+def test_compact_keeps_integer_counts():
+    usage = DailyUsage.from_json({'2026-04-02': [0, 1, 2], '2026-04-03': [1, 0, 0]}, width=3)
+
+    usage.compact(date(2026, 5, 1))
+
+    assert usage.to_json() == {'2026-04': [1, 1, 2]}